@@ -0,0 +1,156 @@
+import threading
+import time
+
+
+class Bar(object):
+    """
+    Bar of a pair's top of book over [start, start + interval).
+    Spread is time weighted: each spread counts for the time it stayed the top of book, until the next update or the
+    end of the bar.
+    """
+
+    __slots__ = ('start', 'interval', 'bid', 'ask', 'mid', 'bid_qty', 'ask_qty', 'update_count',
+                 'last_time', 'last_spread', 'spread_time', 'first_time')
+
+    def __init__(self, start, interval, row):
+        self.start = start
+        self.interval = interval
+        mid = (row['bid'] + row['ask']) / 2.
+        # [open, high, low, close]
+        self.bid = [row['bid']] * 4
+        self.ask = [row['ask']] * 4
+        self.mid = [mid] * 4
+        self.bid_qty = row['bid_qty']
+        self.ask_qty = row['ask_qty']
+        self.update_count = 1
+        self.first_time = self.last_time = row['timestamp']
+        self.last_spread = row['ask'] - row['bid']
+        self.spread_time = 0.
+
+    def update(self, row):
+        t = row['timestamp']
+        self.spread_time += self.last_spread * (t - self.last_time)
+        self.last_time = t
+        self.last_spread = row['ask'] - row['bid']
+        for ohlc, value in ((self.bid, row['bid']), (self.ask, row['ask']), (self.mid, (row['bid'] + row['ask']) / 2.)):
+            if value > ohlc[1]:
+                ohlc[1] = value
+            if value < ohlc[2]:
+                ohlc[2] = value
+            ohlc[3] = value
+        self.bid_qty = row['bid_qty']
+        self.ask_qty = row['ask_qty']
+        self.update_count += 1
+
+    def to_row(self, ccy):
+        # type: (str) -> dict
+        end = self.start + self.interval * 1000
+        duration = end - self.first_time
+        spread_time = self.spread_time + self.last_spread * (end - self.last_time)
+        row = {
+            'timestamp': self.start,
+            'ccy_id': ccy,
+            'interval_s': self.interval,
+            'bid': self.bid[3],
+            'bid_qty': self.bid_qty,
+            'ask': self.ask[3],
+            'ask_qty': self.ask_qty,
+            'twa_spread': spread_time / duration if duration > 0 else self.last_spread,
+            'update_count': self.update_count,
+        }
+        for name, ohlc in (('bid', self.bid), ('ask', self.ask), ('mid', self.mid)):
+            row[name + '_open'], row[name + '_high'], row[name + '_low'], row[name + '_close'] = ohlc
+        return row
+
+
+class BarAggregator(object):
+    """
+    Streaming aggregation of the top of book rows recorded by record_best_bid_ask into time bars, one per pair and
+    interval (in seconds). Bars are built incrementally on each row and emitted into market_data_histo when their
+    interval closes, either on the first row past the end of the bar or by the background timer when the pair is quiet.
+    The timer goes by clock, the time the rows are stamped with (the handler's clock, the recorded time while
+    replaying), and waits grace seconds past the end of a bar for the rows still in flight. A bar is emitted once:
+    rows that come after their bar was emitted are dropped and counted in late_rows.
+    listeners: functions called with every emitted bar row
+    """
+
+    def __init__(self, db_interface, bars_logger, intervals=(1, 60, 3600), table='market_data_histo', clock=time.time,
+                 grace=1.):
+        # type: (CrateDbInterface, Logger, (int), str, function, float) -> object
+        self.db = db_interface
+        self.logger = bars_logger
+        self.intervals = tuple(intervals)
+        self.table = table
+        self.clock = clock
+        self.grace = grace
+        # bars: dict((ccy, interval)) -> Bar
+        self.bars = {}
+        # emitted_until: dict((ccy, interval)) -> end of the last bar emitted (ms)
+        self.emitted_until = {}
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.thread = None
+        self.emitted = 0
+        self.late_rows = 0
+
+    def on_top_of_book(self, ccy, row):
+        # type: (str, dict) -> None
+        # row: as recorded in raw_market_data_histo, timestamp in ms
+        t = row['timestamp']
+        closed = []
+        late = False
+        with self.lock:
+            for interval in self.intervals:
+                key = (ccy, interval)
+                start = t - t % (interval * 1000)
+                bar = self.bars.get(key)
+                if bar is not None and bar.start == start:
+                    bar.update(row)
+                    continue
+                if start < (bar.start if bar is not None else self.emitted_until.get(key, 0)):
+                    # its bar is already emitted (or replaced by a later one): it would be emitted a second time
+                    late = True
+                    continue
+                if bar is not None:
+                    closed.append(bar.to_row(ccy))
+                    self.emitted_until[key] = bar.start + interval * 1000
+                self.bars[key] = Bar(start, interval, row)
+            if late:
+                self.late_rows += 1
+        if late:
+            self.logger.debug("[BarAggregator] Late row of %s at %s dropped", ccy, t)
+        for bar_row in closed:
+            self.emit(bar_row)
+
+    def close_expired(self, now_ms=None):
+        # emits the bars whose interval is over by more than grace
+        now_ms = now_ms or int((self.clock() - self.grace) * 1000)
+        closed = []
+        with self.lock:
+            for (ccy, interval), bar in self.bars.items():
+                end = bar.start + interval * 1000
+                if end <= now_ms:
+                    closed.append(bar.to_row(ccy))
+                    del self.bars[(ccy, interval)]
+                    self.emitted_until[(ccy, interval)] = end
+        for bar_row in closed:
+            self.emit(bar_row)
+
+    def emit(self, bar_row):
+        self.emitted += 1
+        self.db.write(self.table, bar_row)
+        for listener in self.listeners:
+            listener(bar_row)
+
+    def start(self, period=1.):
+        def run():
+            while True:
+                time.sleep(period)
+                try:
+                    self.close_expired()
+                except Exception as e:
+                    self.logger.warning("[BarAggregator] Couldn't close expired bars: %s", e)
+        self.thread = threading.Thread(target=run, name="BarAggregator")
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info("[BarAggregator] Aggregating bars of {}s".format(", ".join(str(i) for i in self.intervals)))
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the market data hot paths: Orderbook, frame decoding and dispatch, the message listener and the DB writes.
+Runs on synthetic feeds (synthetic_feed.SyntheticFeed) and against an in-process CrateDB stand-in (local_crate), reports
+throughput and latency percentiles, saves them as JSON and flags regressions against a saved baseline.
+
+    python benchmark.py --depth 10 --pairs 3 --updates 20000 --output results.json
+    python benchmark.py --baseline results.json      # exits with 1 if any benchmark regressed
+Each benchmark runs --repeat times and reports the median of every figure, single runs being too noisy to compare.
+"""
+
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+
+from cexio_interface import CexioMarketDataHandler
+from db_interface import CrateDbInterface
+from feed_recorder import ReplaySink
+from instrumentation import LatencyHistogram, PipelineInstrumentation, monotonic
+from local_crate import LocalCrateConnection
+from orderbook import Orderbook
+from ladder_orderbook import LadderOrderbook
+from synthetic_feed import SyntheticFeed
+from tests import get_quiet_logger
+
+# p99 latencies under this many us are too noisy to be compared with the baseline
+min_comparable_latency_us = 20
+
+
+class Timings(object):
+
+    def __init__(self):
+        self.histogram = LatencyHistogram()
+        self.start = monotonic()
+        self.ops = 0
+
+    def time(self, f, *args):
+        start = monotonic()
+        f(*args)
+        self.histogram.record(monotonic() - start)
+        self.ops += 1
+
+    def result(self, ops=None, seconds=None):
+        seconds = seconds if seconds is not None else monotonic() - self.start
+        ops = ops if ops is not None else self.ops
+        summary = self.histogram.summary()
+        return {
+            'ops': ops,
+            'seconds': seconds,
+            'ops_per_sec': ops / seconds if seconds else 0.,
+            'p50_us': summary['p50_us'],
+            'p90_us': summary['p90_us'],
+            'p99_us': summary['p99_us'],
+            'max_us': summary['max_us'],
+        }
+
+
+def new_feed(args):
+    return SyntheticFeed(["BTC:{}".format(ccy) for ccy in ('USD', 'EUR', 'GBP', 'RUB', 'JPY', 'CAD', 'AUD', 'CHF',
+                                                           'PLN', 'SEK', 'NOK', 'DKK')][:args.pairs]
+                         + ["ETH:{}".format(i) for i in xrange(max(0, args.pairs - 12))],
+                         depth=args.depth, seed=args.seed)
+
+
+book_engines = {'dict': Orderbook, 'ladder': LadderOrderbook}
+
+
+def new_handler(db, feed, workers=4, book_engine='dict'):
+    handler = CexioMarketDataHandler('key', 'secret', db, get_quiet_logger('benchmark.cexio'), workers)
+    handler.book_factory = book_engines[book_engine]
+    handler.instrumentation = PipelineInstrumentation()
+    handler.ws = ReplaySink()
+    handler.is_connected = True
+    for pair in feed.pairs:
+        handler.add_orderbook(pair, feed.depth)
+        handler.handle_message(*handler.decode_frame(feed.snapshot_frame(pair)))
+    return handler
+
+
+def bench_orderbook(args):
+    logger = get_quiet_logger('benchmark.orderbook')
+    feed = new_feed(args)
+    pair = feed.pairs[0]
+    results = {}
+
+    snapshot = feed.snapshot(pair)
+    timings = Timings()
+    for _ in xrange(max(1, args.updates / 10)):
+        timings.time(book_engines[args.book_engine](pair, args.depth, logger).build, snapshot)
+    results['orderbook.build'] = timings.result()
+
+    book = book_engines[args.book_engine](pair, args.depth, logger)
+    book.build(feed.snapshot(pair))
+    updates = [feed.update(pair) for _ in xrange(args.updates)]
+    timings = Timings()
+    for update in updates:
+        timings.time(book.update, update)
+    results['orderbook.update'] = timings.result()
+
+    for name in ('get_sorted', 'is_crossed', 'best_bid', 'best_ask'):
+        f = getattr(book, name)
+        timings = Timings()
+        for _ in xrange(args.updates):
+            timings.time(f)
+        results['orderbook.{}'.format(name)] = timings.result()
+    return results
+
+
+def bench_decoding(args):
+    feed = new_feed(args)
+    db = CrateDbInterface(get_quiet_logger('benchmark.db'), LocalCrateConnection(keep_rows=False))
+    handler = new_handler(db, feed, book_engine=args.book_engine)
+    frames = list(feed.update_frames(args.updates))
+    results = {}
+
+    timings = Timings()
+    for frame in frames:
+        timings.time(handler.decode_frame, frame)
+    results['cexio.decode_frame'] = timings.result()
+
+    timings = Timings()
+    for frame in frames:
+        timings.time(handler.decoder.peek_event, frame)
+    results['cexio.peek_event'] = timings.result()
+
+    # decode + dispatch inline, md_update_act included, with rows going through the bulk writer
+    handler = new_handler(db, new_feed(args), book_engine=args.book_engine)
+    writer = db.start_bulk_writer()
+    writer.instrumentation = handler.instrumentation
+    timings = Timings()
+    for frame in frames:
+        timings.time(lambda f: handler.handle_message(*handler.decode_frame(f)), frame)
+    results['cexio.decode_and_dispatch'] = timings.result()
+    db.stop_bulk_writer()
+    return results
+
+
+def bench_listener(args):
+    feed = new_feed(args)
+    db = CrateDbInterface(get_quiet_logger('benchmark.db'), LocalCrateConnection(keep_rows=False))
+    handler = new_handler(db, feed, args.workers, args.book_engine)
+    db.start_bulk_writer()
+    frames = list(feed.update_frames(args.updates))
+    handled_before = sum(handler.instrumentation.update_counts.values())
+
+    handler.dispatcher.start()
+    start = monotonic()
+    interval = 1. / args.rate if args.rate else 0.
+    for i, frame in enumerate(frames):
+        if interval:
+            wait = start + i * interval - monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        handler.on_message(None, frame)
+    while sum(handler.instrumentation.update_counts.values()) - handled_before < len(frames):
+        time.sleep(0.001)
+    seconds = monotonic() - start
+    db.stop_bulk_writer()
+
+    # per message latency, from frame received to handled, all pairs together
+    timings = Timings()
+    merged = timings.histogram
+    for pair in feed.pairs:
+        h = handler.instrumentation.histogram(pair, 'md_update', 'total')
+        merged.counts = [a + b for a, b in zip(merged.counts, h.counts)]
+        merged.count += h.count
+        merged.total += h.total
+        merged.max = max(merged.max, h.max)
+    return {'cexio.listener_throughput': timings.result(ops=len(frames), seconds=seconds)}
+
+
+def bench_db(args):
+    logger = get_quiet_logger('benchmark.db')
+    feed = new_feed(args)
+    pair = feed.pairs[0]
+    rows = []
+    for i in xrange(args.updates):
+        data = feed.update(pair)
+        rows.append({'timestamp': 1500000000000 + i, 'ccy_id': pair, 'bid': data['id'], 'bid_qty': 1.5,
+                     'ask': data['id'] + 0.1, 'ask_qty': 2.5})
+    results = {}
+
+    db = CrateDbInterface(logger, LocalCrateConnection(keep_rows=False))
+    timings = Timings()
+    queries = []
+    for row in rows:
+        timings.time(lambda r: queries.append(db.insert_query('raw_market_data_histo', r)), row)
+    results['db.insert_query'] = timings.result()
+
+    timings = Timings()
+    for query in queries:
+        timings.time(db.run_query, query)
+    results['db.run_query'] = timings.result()
+
+    db = CrateDbInterface(logger, LocalCrateConnection(keep_rows=False, per_row_latency=args.db_row_latency))
+    writer = db.start_bulk_writer()
+    writer.instrumentation = PipelineInstrumentation()
+    timings = Timings()
+    for row in rows:
+        timings.time(db.write, 'raw_market_data_histo', row)
+    db.stop_bulk_writer()
+    results['db.bulk_write'] = timings.result(seconds=monotonic() - timings.start)
+    return results
+
+
+benchmarks = {
+    'orderbook': bench_orderbook,
+    'decoding': bench_decoding,
+    'listener': bench_listener,
+    'db': bench_db,
+}
+
+
+def median_results(runs):
+    # type: ([dict]) -> dict
+    # median of each figure of each benchmark across runs
+    results = {}
+    for name in runs[0]:
+        results[name] = dict((key, sorted(run[name][key] for run in runs)[len(runs) // 2]) for key in runs[0][name])
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # type: (dict, dict, float) -> [str]
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            regressions.append("{}: throughput {:.0f}/s vs {:.0f}/s in baseline".format(name, result['ops_per_sec'], base['ops_per_sec']))
+        if base['p99_us'] >= min_comparable_latency_us and result['p99_us'] > base['p99_us'] * (1 + tolerance):
+            regressions.append("{}: p99 {}us vs {}us in baseline".format(name, result['p99_us'], base['p99_us']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--depth', type=int, default=10, help="order book depth")
+    parser.add_argument('--pairs', type=int, default=3, help="number of pairs in the synthetic feed")
+    parser.add_argument('--updates', type=int, default=20000, help="md_updates per benchmark")
+    parser.add_argument('--rate', type=float, default=0, help="listener feed rate in msg/sec, 0 for as fast as possible")
+    parser.add_argument('--workers', type=int, default=4, help="pair workers of the listener")
+    parser.add_argument('--db-row-latency', type=float, default=0., help="per row latency of the DB stand-in (s)")
+    parser.add_argument('--book-engine', choices=sorted(book_engines), default='dict', help="order book implementation")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', action='append', choices=sorted(benchmarks), help="run only these benchmarks")
+    parser.add_argument('--output', default='benchmark_results.json', help="where to save the results")
+    parser.add_argument('--baseline', help="results file to compare with")
+    parser.add_argument('--repeat', type=int, default=5, help="runs of each benchmark, the median is reported")
+    parser.add_argument('--tolerance', type=float, default=0.3, help="accepted relative regression")
+    args = parser.parse_args(argv)
+
+    runs = []
+    for _ in xrange(max(args.repeat, 1)):
+        run = {}
+        for name in args.only or sorted(benchmarks):
+            run.update(benchmarks[name](args))
+        runs.append(run)
+    results = median_results(runs)
+
+    print "{:<32}{:>12}{:>10}{:>10}{:>10}{:>10}".format('benchmark', 'ops/sec', 'p50 us', 'p90 us', 'p99 us', 'max us')
+    for name, r in sorted(results.iteritems()):
+        print "{:<32}{:>12.0f}{:>10}{:>10}{:>10}{:>10}".format(name, r['ops_per_sec'], r['p50_us'], r['p90_us'], r['p99_us'], r['max_us'])
+
+    with open(args.output, 'w') as f:
+        json.dump({'meta': {'time': time.time(), 'python': platform.python_version(), 'machine': platform.node(),
+                            'args': vars(args)},
+                   'results': results}, f, indent=2, sort_keys=True)
+    print "Results saved to {}".format(args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print "REGRESSION {}".format(regression)
+        if regressions:
+            return 1
+        print "No regression against {}".format(args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+import numpy as np
+
+
+class BookAnalytics(object):
+    """
+    Multi-level metrics of an Orderbook computed over NumPy arrays of its levels (best level first).
+    The arrays and every metric are cached against the book's update_nb: repeated queries between two updates are
+    dict lookups, and the first query after an update rebuilds the arrays once for all metrics.
+    depth: nb of levels per side taken into account, defaults to the book's depth
+    """
+
+    def __init__(self, order_book, depth=None):
+        # type: (Orderbook, int) -> object
+        self.order_book = order_book
+        self.depth = depth or order_book.depth
+        self.cache_update_nb = None
+        self.cache = {}
+
+    def _cached(self, key, compute):
+        if self.cache_update_nb != self.order_book.update_nb:
+            self.cache = {}
+            self.cache_update_nb = self.order_book.update_nb
+        try:
+            return self.cache[key]
+        except KeyError:
+            value = self.cache[key] = compute()
+            return value
+
+    def levels(self):
+        # type: () -> {'bids': (prices, qties), 'asks': (prices, qties)}
+        def compute():
+            top = self.order_book.top(self.depth)
+            out = {}
+            for side in ('bids', 'asks'):
+                levels = np.array(top[side], dtype=np.float64).reshape(-1, 2)
+                out[side] = (levels[:, 0], levels[:, 1])
+            return out
+        return self._cached('levels', compute)
+
+    def in_depth_limit(self):
+        # type: () -> (float, float, float, float)
+        # (total bid qty, average bid price, average ask price, total ask qty) over the depth, as in_depth_limit did
+        def compute():
+            levels = self.levels()
+            bid_px, bid_qty = levels['bids']
+            ask_px, ask_qty = levels['asks']
+            return bid_qty.sum(), bid_px.mean(), ask_px.mean(), ask_qty.sum()
+        return self._cached('in_depth_limit', compute)
+
+    def vwap(self, side):
+        # type: (str) -> float
+        # volume weighted average price of the side over the depth
+        def compute():
+            px, qty = self.levels()[side]
+            total = qty.sum()
+            return float(np.dot(px, qty) / total) if total > 0 else float('nan')
+        return self._cached(('vwap', side), compute)
+
+    def weighted_mid(self):
+        # type: () -> float
+        # mid weighted by the opposite top of book quantities (leans towards the side about to be taken)
+        def compute():
+            levels = self.levels()
+            bid_px, bid_qty = levels['bids']
+            ask_px, ask_qty = levels['asks']
+            if not len(bid_px) or not len(ask_px):
+                return float('nan')
+            return float((bid_px[0] * ask_qty[0] + ask_px[0] * bid_qty[0]) / (bid_qty[0] + ask_qty[0]))
+        return self._cached('weighted_mid', compute)
+
+    def imbalance(self, levels=None):
+        # type: (int) -> float
+        # (bid qty - ask qty) / (bid qty + ask qty) over the first `levels` levels, in [-1, 1]
+        def compute():
+            book = self.levels()
+            bid_qty = book['bids'][1][:levels].sum()
+            ask_qty = book['asks'][1][:levels].sum()
+            total = bid_qty + ask_qty
+            return float((bid_qty - ask_qty) / total) if total > 0 else 0.
+        return self._cached(('imbalance', levels), compute)
+
+    def depth_curve(self, side):
+        # type: (str) -> (np.array, np.array, np.array)
+        # (prices, cumulative qty, cumulative notional) walking the side from the best level
+        def compute():
+            px, qty = self.levels()[side]
+            return px, np.cumsum(qty), np.cumsum(px * qty)
+        return self._cached(('depth_curve', side), compute)
+
+    def slippage(self, side, size):
+        # type: (str, float) -> dict
+        # Cost of taking `size` from `side` ('asks' to buy, 'bids' to sell) within the depth:
+        # average fill price, filled qty, slippage against the best price (absolute and in bps)
+        def compute():
+            px, cum_qty, cum_notional = self.depth_curve(side)
+            if not len(px):
+                return {'avg_price': float('nan'), 'filled': 0., 'slippage': float('nan'), 'slippage_bps': float('nan')}
+            if size <= 0:
+                # nothing to take: no slippage, rather than 0/0
+                return {'avg_price': float(px[0]), 'filled': 0., 'slippage': 0., 'slippage_bps': 0.}
+            # first level where the cumulative qty covers the size
+            i = int(np.searchsorted(cum_qty, size))
+            if i >= len(px):
+                filled, notional = cum_qty[-1], cum_notional[-1]
+            else:
+                prev_qty = cum_qty[i - 1] if i > 0 else 0.
+                prev_notional = cum_notional[i - 1] if i > 0 else 0.
+                filled, notional = size, prev_notional + (size - prev_qty) * px[i]
+            avg_price = notional / filled
+            slippage = abs(avg_price - px[0])
+            return {'avg_price': float(avg_price), 'filled': float(filled), 'slippage': float(slippage),
+                    'slippage_bps': float(slippage / px[0] * 10000)}
+        return self._cached(('slippage', side, size), compute)
@@ -0,0 +1,182 @@
+import os
+import struct
+import threading
+import time
+from bisect import bisect_right
+
+from orderbook import Orderbook
+
+# One file per pair, made of records: header (type, timestamp, update id, nb of levels) + levels (side, price, qty).
+# Snapshot records hold the whole book, delta records the levels of an md_update (qty 0 removes the level).
+# The .idx file next to it lists (timestamp, offset) of every snapshot so readers can seek to the closest one.
+record_header = struct.Struct('<BdqI')
+level_struct = struct.Struct('<Bdd')
+index_struct = struct.Struct('<dQ')
+SNAPSHOT = 1
+DELTA = 2
+BID = 0
+ASK = 1
+
+
+def history_path(directory, pair):
+    return os.path.join(directory, "{}.obh".format(pair.replace(':', '_')))
+
+
+def pack_levels(bids, asks):
+    # type: ([(float, float)], [(float, float)]) -> str
+    return ''.join([level_struct.pack(BID, price, qty) for price, qty in bids] +
+                   [level_struct.pack(ASK, price, qty) for price, qty in asks])
+
+
+class BookHistoryWriter(object):
+    """
+    Order book history as periodic full snapshots plus the binary deltas of every md_update.
+    A snapshot is written on every order-book-subscribe, then again after snapshot_every deltas or snapshot_interval
+    seconds, whichever comes first, so reconstructing the book at any time only replays a bounded number of deltas.
+    Records are stamped with the timestamp argument (the handler passes its clock, the recorded time while replaying),
+    the current time by default.
+    """
+
+    def __init__(self, directory, history_logger, snapshot_every=1000, snapshot_interval=60.):
+        self.directory = directory
+        self.logger = history_logger
+        self.snapshot_every = snapshot_every
+        self.snapshot_interval = snapshot_interval
+        # files: dict(pair) -> (data file, index file)
+        self.files = {}
+        # last_snapshot: dict(pair) -> (time, nb of deltas written since)
+        self.last_snapshot = {}
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _files(self, pair):
+        files = self.files.get(pair)
+        if files is None:
+            with self.lock:
+                files = self.files.get(pair)
+                if files is None:
+                    path = history_path(self.directory, pair)
+                    files = self.files[pair] = (open(path, 'ab'), open(path + '.idx', 'ab'))
+                    self.logger.info("[BookHistory] Writing {} history to {}".format(pair, path))
+        return files
+
+    def write_snapshot(self, pair, order_book, update_id, timestamp=None):
+        # type: (str, Orderbook, int, float) -> None
+        timestamp = timestamp or time.time()
+        data_file, index_file = self._files(pair)
+        top = order_book.top()
+        bids, asks = top['bids'], top['asks']
+        offset = data_file.tell()
+        data_file.write(record_header.pack(SNAPSHOT, timestamp, update_id, len(bids) + len(asks)))
+        data_file.write(pack_levels(bids, asks))
+        data_file.flush()
+        index_file.write(index_struct.pack(timestamp, offset))
+        index_file.flush()
+        self.last_snapshot[pair] = (timestamp, 0)
+
+    def write_delta(self, pair, data, order_book, timestamp=None):
+        # type: (str, dict, Orderbook, float) -> None
+        # data: the md_update data, already applied to order_book
+        timestamp = timestamp or time.time()
+        last_time, deltas = self.last_snapshot.get(pair, (0., self.snapshot_every))
+        if deltas >= self.snapshot_every or timestamp - last_time >= self.snapshot_interval:
+            self.write_snapshot(pair, order_book, data['id'], timestamp)
+            return
+        data_file, _ = self._files(pair)
+        data_file.write(record_header.pack(DELTA, timestamp, data['id'], len(data['bids']) + len(data['asks'])))
+        data_file.write(pack_levels(data['bids'], data['asks']))
+        self.last_snapshot[pair] = (last_time, deltas + 1)
+
+    def flush(self):
+        with self.lock:
+            for data_file, index_file in self.files.values():
+                data_file.flush()
+                index_file.flush()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            for data_file, index_file in self.files.values():
+                data_file.close()
+                index_file.close()
+            self.files = {}
+
+
+class BookHistoryReader(object):
+    """
+    Rebuilds the book of a pair at any point in time from a BookHistoryWriter directory:
+    seeks to the last snapshot before the timestamp and applies the deltas that follow it.
+    """
+
+    def __init__(self, directory, history_logger):
+        self.directory = directory
+        self.logger = history_logger
+
+    def snapshot_index(self, pair):
+        # type: (str) -> ([float], [int])
+        timestamps, offsets = [], []
+        with open(history_path(self.directory, pair) + '.idx', 'rb') as f:
+            content = f.read()
+        for i in xrange(len(content) // index_struct.size):
+            timestamp, offset = index_struct.unpack_from(content, i * index_struct.size)
+            timestamps.append(timestamp)
+            offsets.append(offset)
+        return timestamps, offsets
+
+    def records(self, pair, offset=0):
+        # yields (type, timestamp, update id, [(side, price, qty)]) from offset on
+        with open(history_path(self.directory, pair), 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(record_header.size)
+                if len(header) < record_header.size:
+                    return
+                record_type, timestamp, update_id, n = record_header.unpack(header)
+                body = f.read(n * level_struct.size)
+                if len(body) < n * level_struct.size:
+                    return
+                yield record_type, timestamp, update_id, [level_struct.unpack_from(body, i * level_struct.size) for i in xrange(n)]
+
+    def iter_books(self, pair, start, end):
+        # yields (timestamp, update id, bids, asks) for every record between start and end, bids/asks: dict(price) -> qty
+        # each a copy the caller can keep
+        for timestamp, update_id, bids, asks in self._replay(pair, start, end):
+            yield timestamp, update_id, dict(bids), dict(asks)
+
+    def _replay(self, pair, start, end):
+        # as iter_books, but yields the book being rebuilt, which changes with the next record
+        timestamps, offsets = self.snapshot_index(pair)
+        i = bisect_right(timestamps, start) - 1
+        if i < 0:
+            if not offsets:
+                return
+            i = 0
+        bids, asks = {}, {}
+        for record_type, timestamp, update_id, levels in self.records(pair, offsets[i]):
+            if timestamp > end:
+                return
+            if record_type == SNAPSHOT:
+                bids, asks = {}, {}
+            for side, price, qty in levels:
+                book_side = bids if side == BID else asks
+                if qty == 0:
+                    book_side.pop(price, None)
+                else:
+                    book_side[price] = qty
+            if timestamp >= start:
+                yield timestamp, update_id, bids, asks
+
+    def book_at(self, pair, timestamp, depth=None):
+        # type: (str, float, int) -> Orderbook
+        # None if there's no history for the pair before timestamp
+        timestamps, offsets = self.snapshot_index(pair)
+        i = bisect_right(timestamps, timestamp) - 1
+        if i < 0:
+            return None
+        bids, asks = {}, {}
+        for _, _, bids, asks in self._replay(pair, timestamps[i], timestamp):
+            pass
+        order_book = Orderbook(pair, depth or max(len(bids), len(asks)), self.logger)
+        order_book.build({'bids': bids.items(), 'asks': asks.items()})
+        return order_book
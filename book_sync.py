@@ -0,0 +1,84 @@
+from collections import deque
+import time
+
+
+class BookSync(object):
+    """
+    Sequence state of one pair's book. md_update ids are consecutive after the snapshot id, so any other id means
+    a delta was lost and the book can't be trusted anymore.
+    While resyncing, the (stale) book is kept as is, deltas are buffered, and once the new snapshot is built the
+    buffered deltas newer than it are replayed. Snapshot requests are sent at most once per min_interval seconds,
+    and again if no snapshot came back within timeout seconds.
+        last_id: id of the last snapshot or delta applied, None before the first snapshot
+    A new BookSync waits for the snapshot of its subscription as a resync of reason 'subscribe', so the deltas that
+    come before it are buffered rather than applied to an empty book.
+        buffer: deque of the md_update data received while resyncing, at most max_buffer of them
+    """
+
+    def __init__(self, pair, min_interval=1., timeout=5., max_buffer=10000):
+        # type: (str, float, float, int) -> object
+        self.pair = pair
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self.last_id = None
+        self.buffer = deque(maxlen=max_buffer)
+        self.resyncing = False
+        self.reason = None
+        # time the book became stale, of the last snapshot request of the current resync
+        self.stale_since = None
+        self.requested_at = None
+        self.request_sent = False
+        # timer of the resync check scheduled by the handler (see CexioMarketDataHandler.schedule_resync_check)
+        self.check_timer = None
+        self.subscribed()
+
+    def check(self, update_id):
+        # type: (int) -> str
+        # 'apply', 'duplicate' (already applied) or 'gap'
+        if self.last_id is None or update_id == self.last_id + 1:
+            return 'apply'
+        if update_id <= self.last_id:
+            return 'duplicate'
+        return 'gap'
+
+    def start(self, reason, now=None):
+        if not self.resyncing:
+            self.resyncing = True
+            self.request_sent = False
+            self.reason = reason
+            self.stale_since = now or time.time()
+            self.buffer.clear()
+
+    def subscribed(self, now=None):
+        # the subscription was just sent: it is the snapshot request
+        self.start('subscribe', now)
+        self.requested(now)
+
+    def request_due(self, now=None):
+        # type: (float) -> bool
+        # True when a snapshot request should be sent now, rate limited to one per min_interval; the caller then
+        # calls requested()
+        if not self.resyncing:
+            return False
+        if self.requested_at is None:
+            return True
+        elapsed = (now or time.time()) - self.requested_at
+        return elapsed >= (self.timeout if self.request_sent else self.min_interval)
+
+    def requested(self, now=None):
+        self.requested_at = now or time.time()
+        self.request_sent = True
+
+    def finish(self, snapshot_id, now=None):
+        # type: (int, float) -> ([dict], float)
+        # called once the snapshot is built: returns the buffered deltas to replay and how long the book was stale
+        self.last_id = snapshot_id
+        replay = [data for data in self.buffer if data['id'] > snapshot_id]
+        self.buffer.clear()
+        stale_time = (now or time.time()) - self.stale_since if self.resyncing else 0.
+        self.resyncing = False
+        self.reason = None
+        self.stale_since = None
+        self.requested_at = None
+        self.request_sent = False
+        return replay, stale_time
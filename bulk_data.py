@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+"""
+Bulk export and import of the CrateDB tables, to back them up before a reset, rebuild an environment or backfill
+history without replaying feeds.
+Exports are compressed columnar chunks (numpy .npz, one array per column, at most chunk_rows rows each), partitioned by
+table, pair and UTC day: <dir>/<table>/<pair>/<YYYY-MM-DD>/chunk-00000.npz. A day is marked done once fully exported,
+so an interrupted export can be resumed; the current UTC day is still filling and is exported again by the next run.
+Imports read them back, or third-party CSV tick dumps, and send them as parallel bulk inserts, a bounded number of
+chunks in memory at a time. Rows Crate rejects in a bulk insert (e.g. duplicate keys) are counted as failed rows.
+
+    python bulk_data.py export --dir backup [--tables raw_market_data_histo] [--pairs BTC:USD] [--start 2018-01-01]
+    python bulk_data.py import --dir backup [--workers 4]
+    python bulk_data.py import-csv --file ticks.csv --pair BTC:USD --columns time:timestamp,bid:bid,ask:ask
+"""
+
+import argparse
+import calendar
+import csv
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from db_interface import CrateDbInterface
+
+day_ms = 86400 * 1000
+column_regex = re.compile(r'^\s*(\w+)\s+(\w+)')
+# numpy dtype of the Crate column types
+crate_dtypes = {'timestamp': np.int64, 'integer': np.int64, 'long': np.int64, 'float': np.float64,
+                'double': np.float64, 'string': str}
+
+
+def table_columns(table):
+    # type: (str) -> [(column, crate type)]
+    # from the CREATE TABLE statement of CrateDbInterface.init_tables
+    sql = CrateDbInterface.init_tables[table]
+    body = sql[sql.index('(') + 1:sql.lower().rindex('primary key')]
+    return [column_regex.match(part).groups() for part in body.split(',') if column_regex.match(part)]
+
+
+def parse_timestamp(value):
+    # type: (str) -> int
+    # ms since epoch from epoch seconds or ms, or an ISO date/time (UTC)
+    value = value.strip()
+    try:
+        number = float(value)
+        # epoch seconds until year 2286, ms after
+        return int(number * 1000) if number < 1e10 else int(number)
+    except ValueError:
+        pass
+    value = value.replace('T', ' ').rstrip('Z')
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            dt = datetime.strptime(value, fmt)
+            return calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond // 1000
+        except ValueError:
+            continue
+    raise ValueError("Unsupported timestamp {}".format(value))
+
+
+def pair_directory(pair):
+    return pair.replace(':', '_')
+
+
+class Progress(object):
+    """
+    Per chunk progress and throughput, shared by the worker threads.
+    """
+
+    def __init__(self, progress_logger, total_chunks=None):
+        self.logger = progress_logger
+        self.total_chunks = total_chunks
+        self.chunks = 0
+        self.rows = 0
+        self.failed_chunks = 0
+        self.failed_rows = 0
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def chunk_done(self, name, rows, seconds, ok=True, failed_rows=0):
+        # failed_rows: rows of the chunk that weren't written, a chunk with failed rows counts as failed
+        with self.lock:
+            self.chunks += 1
+            self.rows += rows - failed_rows if ok else 0
+            self.failed_rows += failed_rows if ok else rows
+            self.failed_chunks += 0 if ok and not failed_rows else 1
+            elapsed = time.time() - self.start
+            chunks, total_rows = self.chunks, self.rows
+        self.logger.info("[BulkData] {} {}: {} rows in {:.3f}s ({:.0f} rows/s), {}{} chunks, {} rows, {:.0f} rows/s overall".format(
+            name, 'done' if ok and not failed_rows else 'FAILED' if not ok else "{} rows FAILED".format(failed_rows),
+            rows, seconds, rows / seconds if seconds else 0., chunks,
+            "/{}".format(self.total_chunks) if self.total_chunks else '', total_rows, total_rows / elapsed if elapsed else 0.))
+
+    def summary(self):
+        # type: () -> dict
+        elapsed = time.time() - self.start
+        return {'chunks': self.chunks, 'failed_chunks': self.failed_chunks, 'rows': self.rows,
+                'failed_rows': self.failed_rows, 'seconds': elapsed, 'rows_per_sec': self.rows / elapsed if elapsed else 0.}
+
+
+class BulkExporter(object):
+    """
+    Streams tables out of CrateDB into npz chunks. Rows are read with keyset pagination on the timestamp, chunk_rows at
+    a time, so memory stays bounded by one chunk whatever the size of the table.
+    """
+
+    def __init__(self, db_interface, export_logger, directory, chunk_rows=100000):
+        # type: (CrateDbInterface, Logger, str, int) -> object
+        self.db = db_interface
+        self.logger = export_logger
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+
+    def export(self, tables=None, pairs=None, start=None, end=None):
+        # type: ([str], [str], int, int) -> dict
+        # start/end: ms, whole UTC days are exported
+        progress = Progress(self.logger)
+        today = int(time.time() * 1000) // day_ms * day_ms
+        cursor = self.db.new_cursor()
+        if cursor is None:
+            raise IOError("DB unavailable")
+        try:
+            for table in tables or sorted(CrateDbInterface.init_tables):
+                for pair, first, last in self.pair_ranges(cursor, table):
+                    if pairs and pair not in pairs:
+                        continue
+                    day = max(first, start or first) // day_ms * day_ms
+                    while day <= min(last, end or last):
+                        self.export_day(cursor, table, pair, day, progress, complete=day < today)
+                        day += day_ms
+        finally:
+            cursor.close()
+        summary = progress.summary()
+        self.logger.info("[BulkData] Export to {} done: {}".format(self.directory, summary))
+        return summary
+
+    def pair_ranges(self, cursor, table):
+        # type: (Cursor, str) -> [(pair, first timestamp, last timestamp)]
+        cursor.execute("SELECT ccy_id, min(timestamp), max(timestamp) FROM {} GROUP BY ccy_id".format(table))
+        return [(pair, int(first), int(last)) for pair, first, last in cursor.fetchall() if first is not None]
+
+    def export_day(self, cursor, table, pair, day, progress, complete=True):
+        # complete: no more rows can come for this day, it is marked done once exported
+        day_name = datetime.utcfromtimestamp(day // 1000).strftime('%Y-%m-%d')
+        directory = os.path.join(self.directory, table, pair_directory(pair), day_name)
+        if os.path.isfile(os.path.join(directory, '_done')):
+            self.logger.debug("[BulkData] %s %s %s already exported", table, pair, day_name)
+            return
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        columns = table_columns(table)
+        query = "SELECT {} FROM {} WHERE ccy_id = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp LIMIT ?".format(
+            ", ".join(name for name, _ in columns), table)
+        start, end = day, day + day_ms
+        chunk = 0
+        while start < end:
+            t0 = time.time()
+            cursor.execute(query, [pair, start, end, self.chunk_rows])
+            rows = cursor.fetchall()
+            if len(rows) == self.chunk_rows:
+                # the next chunk starts at the last timestamp: its rows may not all be in this one
+                last = rows[-1][0]
+                rows = [row for row in rows if row[0] != last]
+                if not rows:
+                    raise ValueError("More than {} rows at {} in {}, raise chunk_rows".format(self.chunk_rows, last, table))
+                start = last
+            else:
+                start = end
+            if not rows:
+                break
+            self.write_chunk(os.path.join(directory, "chunk-{:05d}.npz".format(chunk)), columns, rows)
+            progress.chunk_done("{} {} {} chunk {}".format(table, pair, day_name, chunk), len(rows), time.time() - t0)
+            chunk += 1
+        if complete:
+            open(os.path.join(directory, '_done'), 'w').close()
+
+    def write_chunk(self, path, columns, rows):
+        arrays = {}
+        for i, (name, crate_type) in enumerate(columns):
+            values = [row[i] for row in rows]
+            dtype = crate_dtypes.get(crate_type, str)
+            if dtype is str:
+                arrays[name] = np.array([value if value is not None else '' for value in values])
+            else:
+                arrays[name] = np.array([value if value is not None else np.nan for value in values], dtype=np.float64 if None in values else dtype)
+        # written under a temporary name: a chunk file is either complete or missing
+        tmp_path = path[:-4] + '.tmp.npz'
+        np.savez_compressed(tmp_path, **arrays)
+        os.rename(tmp_path, path)
+
+
+class BulkImporter(object):
+    """
+    Loads npz chunks or CSV files into CrateDB as bulk inserts of batch_size rows, workers chunks in parallel (one
+    cursor per worker thread). At most workers + 1 chunks are in memory at a time.
+    """
+
+    def __init__(self, db_interface, import_logger, workers=4, batch_size=5000):
+        # type: (CrateDbInterface, Logger, int, int) -> object
+        self.db = db_interface
+        self.logger = import_logger
+        self.workers = workers
+        self.batch_size = batch_size
+        self.local = threading.local()
+
+    def cursor(self):
+        cursor = getattr(self.local, 'cursor', None)
+        if cursor is None:
+            cursor = self.local.cursor = self.db.new_cursor()
+        return cursor
+
+    def insert(self, table, columns, rows):
+        # type: (str, tuple, list) -> int
+        # number of rows that weren't inserted: whole failed batches, and the rows Crate rejected in the others
+        query = self.db.bulk_insert_query(table, columns)
+        failed = 0
+        for i in xrange(0, len(rows), self.batch_size):
+            batch = rows[i:i + self.batch_size]
+            cursor = self.cursor()
+            if self.db.run_bulk_query(query, batch, cursor):
+                failed += CrateDbInterface.bulk_failures(cursor)
+            else:
+                failed += len(batch)
+        return failed
+
+    def run(self, tasks, total_chunks=None):
+        # tasks: iterable of (name, function() -> (table, columns, rows)), consumed lazily
+        progress = Progress(self.logger, total_chunks)
+        # at most workers + 1 chunks loaded: the producer waits for a free slot before loading the next one
+        slots = threading.Semaphore(self.workers + 1)
+
+        def load_and_insert(task):
+            name, load = task
+            try:
+                t0 = time.time()
+                table, columns, rows = load()
+                failed_rows = self.insert(table, columns, rows)
+                progress.chunk_done(name, len(rows), time.time() - t0, failed_rows=failed_rows)
+            except Exception as e:
+                self.logger.warning("[BulkData] Chunk {} failed: {}".format(name, e))
+                progress.chunk_done(name, 0, 0., False)
+            finally:
+                slots.release()
+
+        # tasks are iterated here rather than by pool.imap, which hangs if the iterator raises (e.g. a bad CSV header)
+        pool = ThreadPool(self.workers)
+        try:
+            for task in tasks:
+                slots.acquire()
+                pool.apply_async(load_and_insert, (task,))
+        finally:
+            pool.close()
+            pool.join()
+        summary = progress.summary()
+        self.logger.info("[BulkData] Import done: {}".format(summary))
+        return summary
+
+    def import_directory(self, directory, tables=None, pairs=None):
+        # type: (str, [str], [str]) -> dict
+        paths = []
+        for table in sorted(os.listdir(directory)):
+            if table not in CrateDbInterface.init_tables or (tables and table not in tables):
+                continue
+            for root, _, files in os.walk(os.path.join(directory, table)):
+                if pairs and os.path.basename(os.path.dirname(root)) not in [pair_directory(p) for p in pairs]:
+                    continue
+                paths.extend((table, os.path.join(root, f)) for f in sorted(files)
+                             if f.startswith('chunk-') and f.endswith('.npz') and not f.endswith('.tmp.npz'))
+        self.logger.info("[BulkData] Importing {} chunks from {}".format(len(paths), directory))
+        tasks = (("{} {}".format(table, os.path.relpath(path, directory)), lambda t=table, p=path: self.load_chunk(t, p))
+                 for table, path in paths)
+        return self.run(tasks, len(paths))
+
+    def load_chunk(self, table, path):
+        # type: (str, str) -> (str, tuple, list)
+        with np.load(path) as chunk:
+            columns = tuple(name for name, _ in table_columns(table) if name in chunk.files)
+            arrays = [chunk[name] for name in columns]
+        # tolist() converts to python values, which is what the crate client serializes
+        values = [array.tolist() for array in arrays]
+        for i, (name, array) in enumerate(zip(columns, arrays)):
+            if array.dtype.kind == 'f':
+                values[i] = [None if value != value else value for value in values[i]]
+        return table, columns, zip(*values)
+
+    def import_csv(self, path, table='raw_market_data_histo', pair=None, mapping=None, chunk_rows=100000,
+                   delimiter=','):
+        # type: (str, str, str, dict, int, str) -> dict
+        # mapping: dict(csv column) -> table column, defaults to the csv columns named as the table's
+        # pair: ccy_id of every row when the file has none
+        table_types = dict(table_columns(table))
+
+        def chunks():
+            with open(path, 'rb') as f:
+                reader = csv.reader(f, delimiter=delimiter)
+                header = [name.strip() for name in next(reader)]
+                selected = [(i, (mapping or {}).get(name, name)) for i, name in enumerate(header)]
+                selected = [(i, column) for i, column in selected if column in table_types]
+                columns = tuple(column for _, column in selected)
+                if pair is not None and 'ccy_id' not in columns:
+                    columns += ('ccy_id',)
+                if 'timestamp' not in columns:
+                    raise ValueError("No timestamp column in {} (columns: {})".format(path, header))
+                converters = [(i, parse_timestamp if table_types[column] == 'timestamp' else
+                               int if table_types[column] in ('integer', 'long') else
+                               float if table_types[column] in ('float', 'double') else str)
+                              for i, column in selected]
+                rows = []
+                n = 0
+                for line in reader:
+                    if not line:
+                        continue
+                    row = [convert(line[i]) if line[i] != '' else None for i, convert in converters]
+                    if pair is not None and len(row) < len(columns):
+                        row.append(pair)
+                    rows.append(tuple(row))
+                    if len(rows) == chunk_rows:
+                        yield "{} chunk {}".format(os.path.basename(path), n), (lambda r=rows: (table, columns, r))
+                        rows = []
+                        n += 1
+                if rows:
+                    yield "{} chunk {}".format(os.path.basename(path), n), (lambda r=rows: (table, columns, r))
+
+        self.logger.info("[BulkData] Importing {} into {}".format(path, table))
+        return self.run(chunks())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=('export', 'import', 'import-csv'))
+    parser.add_argument('--dir', help="export directory")
+    parser.add_argument('--file', action='append', help="CSV file(s) for import-csv")
+    parser.add_argument('--host', default='localhost:4200', help="CrateDB host")
+    parser.add_argument('--tables', help="comma separated tables, all by default")
+    parser.add_argument('--pairs', help="comma separated pairs, all by default")
+    parser.add_argument('--start', help="first day to export, YYYY-MM-DD")
+    parser.add_argument('--end', help="last day to export, YYYY-MM-DD")
+    parser.add_argument('--table', default='raw_market_data_histo', help="table of import-csv")
+    parser.add_argument('--pair', help="ccy_id of the CSV rows if the file has none")
+    parser.add_argument('--columns', help="CSV to table columns, e.g. time:timestamp,best_bid:bid")
+    parser.add_argument('--delimiter', default=',')
+    parser.add_argument('--chunk-rows', type=int, default=100000, help="rows per chunk")
+    parser.add_argument('--batch-size', type=int, default=5000, help="rows per bulk insert")
+    parser.add_argument('--workers', type=int, default=4, help="parallel inserts")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger('BulkData')
+    from crate import client
+    db = CrateDbInterface(logger, client.connect(args.host))
+    tables = args.tables.split(',') if args.tables else None
+    pairs = args.pairs.split(',') if args.pairs else None
+    if args.command == 'export':
+        exporter = BulkExporter(db, logger, args.dir, args.chunk_rows)
+        exporter.export(tables, pairs, parse_timestamp(args.start) if args.start else None,
+                        parse_timestamp(args.end) if args.end else None)
+        return 0
+    importer = BulkImporter(db, logger, args.workers, args.batch_size)
+    if args.command == 'import':
+        summary = importer.import_directory(args.dir, tables, pairs)
+    else:
+        mapping = dict(item.split(':', 1) for item in args.columns.split(',')) if args.columns else None
+        summaries = [importer.import_csv(path, args.table, args.pair, mapping, args.chunk_rows, args.delimiter)
+                     for path in args.file or []]
+        summary = {'failed_chunks': sum(s['failed_chunks'] for s in summaries)}
+    return 1 if summary['failed_chunks'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+import threading
+from collections import deque
+import instrumentation
+from instrumentation import monotonic
+
+
+class BulkWriter(object):
+    """
+    Buffered writer for CrateDbInterface.
+    Rows are queued per (table, columns) and a background thread sends them as parameterized bulk inserts
+    (Crate bulk_args), flushing a queue as soon as it holds max_batch rows or its oldest row is max_age seconds old.
+    Each queue holds at most max_backlog rows: when the DB can't keep up the oldest rows are dropped and counted,
+    so memory stays bounded and write() never blocks the caller. Rows Crate rejects in a bulk insert that succeeded
+    (rowcount -2, e.g. a duplicate key) are counted as failed, not written.
+    With a SpillLog, nothing is dropped: failed batches and the oldest rows of a full queue go to the spill log, and
+    while the DB is down due batches are spilled without trying it. Every retry_interval seconds the writer replays
+    the spill log (up to replay_batches batches per round, between two flushes of live rows); the first batch
+    replayed successfully marks the DB as back. Spilled rows are older than the queued ones, so once the DB is back
+    the spill log is fully replayed before live rows are sent, and live rows are spilled behind it while it can't be.
+    """
+
+    def __init__(self, db_interface, writer_logger, max_batch=500, max_age=0.5, max_backlog=100000, spill=None,
+                 retry_interval=5., replay_batches=20):
+        # type: (CrateDbInterface, Logger, int, float, int, SpillLog, float, int) -> object
+        self.db = db_interface
+        self.logger = writer_logger
+        self.max_batch = max_batch
+        self.max_age = max_age
+        self.max_backlog = max_backlog
+        self.spill = spill
+        self.retry_interval = retry_interval
+        self.replay_batches = replay_batches
+        self.db_down = False
+        self.last_replay = 0.
+        self.cursor = None
+        # queues: dict((table, columns)) -> deque([(enqueue_time, row_tuple)])
+        self.queues = {}
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.instrumentation = instrumentation.pipeline
+        self.stats = {
+            'rows_queued': 0,
+            'rows_written': 0,
+            'rows_dropped': 0,
+            'rows_failed': 0,
+            'rows_spilled': 0,
+            'rows_replayed': 0,
+            'batches': 0,
+            'batches_failed': 0,
+            'last_flush_latency': 0.,
+            'max_flush_latency': 0.,
+            'total_flush_latency': 0.,
+            'max_row_age': 0.,
+        }
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="BulkWriter")
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info("[BulkWriter] Started (max_batch={}, max_age={}s, max_backlog={})".format(self.max_batch, self.max_age, self.max_backlog))
+
+    def stop(self, flush=True):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if flush:
+            self.flush()
+        self.logger.info("[BulkWriter] Stopped, stats: {}".format(self.get_stats()))
+
+    def write(self, table, data_dict):
+        # type: (str, dict) -> None
+        columns = tuple(sorted(data_dict))
+        with self.cond:
+            queue = self.queues.get((table, columns))
+            if queue is None:
+                queue = self.queues[(table, columns)] = deque()
+            overflow = None
+            if len(queue) >= self.max_backlog:
+                if self.spill is None:
+                    queue.popleft()
+                    self.stats['rows_dropped'] += 1
+                else:
+                    overflow = [queue.popleft()[1] for _ in xrange(min(self.max_batch, len(queue)))]
+            queue.append((monotonic(), tuple(data_dict[c] for c in columns)))
+            self.stats['rows_queued'] += 1
+            if len(queue) == self.max_batch:
+                self.cond.notify()
+        if overflow:
+            self._spill(table, columns, overflow)
+
+    def _spill(self, table, columns, rows):
+        try:
+            self.spill.append(table, columns, rows)
+        except Exception as e:
+            self.logger.error("[BulkWriter] Couldn't spill %s rows of %s, rows lost: %s", len(rows), table, e)
+            with self.cond:
+                self.stats['rows_dropped'] += len(rows)
+            return
+        with self.cond:
+            self.stats['rows_spilled'] += len(rows)
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.running:
+                    break
+                self.cond.wait(self.max_age / 2.)
+            if self.cursor is None:
+                # own cursor, None while the DB can't be reached
+                self.cursor = self.db.new_cursor()
+            self.flush(self.cursor, only_due=True)
+            if self.spill is not None and self.spill.pending() and monotonic() - self.last_replay >= self.retry_interval:
+                self.replay(self.cursor)
+
+    def replay(self, cursor=None, max_batches=None):
+        # type: (Cursor, int) -> int
+        # replays spilled batches until one fails, at most replay_batches of them (all if max_batches is 0)
+        self.last_replay = monotonic()
+        if max_batches is None:
+            max_batches = self.replay_batches
+
+        def write_batch(table, columns, rows):
+            if not self.db.run_bulk_query(self.db.bulk_insert_query(table, columns), rows, cursor):
+                return False
+            rejected = self.db.bulk_failures(cursor if cursor is not None else self.db.cursor)
+            if rejected:
+                # retrying them wouldn't help: counted as failed, the batch is done
+                with self.cond:
+                    self.stats['rows_failed'] += rejected
+                self.logger.warning("[BulkWriter] %s of %s replayed rows rejected by %s, rows lost", rejected, len(rows),
+                                    table)
+            return True
+
+        replayed = self.spill.replay(write_batch, max_batches or None)
+        pending = self.spill.pending()
+        with self.cond:
+            self.stats['rows_replayed'] += replayed
+            if replayed and self.db_down:
+                self.db_down = False
+                self.logger.info("[BulkWriter] DB is back, replaying spilled rows (%s left)", pending)
+        if replayed and not pending:
+            self.logger.info("[BulkWriter] Spill log fully replayed")
+        return replayed
+
+    def _take_batches(self, only_due):
+        now = monotonic()
+        batches = []
+        with self.cond:
+            for (table, columns), queue in self.queues.iteritems():
+                while queue and (not only_due or len(queue) >= self.max_batch or now - queue[0][0] >= self.max_age):
+                    n = min(self.max_batch, len(queue))
+                    batch = [queue.popleft() for _ in xrange(n)]
+                    batches.append((table, columns, batch))
+        return batches
+
+    def flush(self, cursor=None, only_due=False):
+        batches = self._take_batches(only_due)
+        if self.spill is not None and not self.db_down and self.spill.pending():
+            self.replay(cursor, 0)
+            if self.spill.pending():
+                self._set_db_down()
+        for table, columns, batch in batches:
+            rows = [row for _, row in batch]
+            if self.db_down:
+                self._spill(table, columns, rows)
+                continue
+            start = monotonic()
+            ok = self.db.run_bulk_query(self.db.bulk_insert_query(table, columns), rows, cursor)
+            end = monotonic()
+            # rows Crate rejected one by one (e.g. a duplicate key) in a bulk insert that succeeded
+            rejected = self.db.bulk_failures(cursor if cursor is not None else self.db.cursor) if ok else 0
+            latency = end - start
+            with self.cond:
+                self.stats['batches'] += 1
+                self.stats['last_flush_latency'] = latency
+                self.stats['total_flush_latency'] += latency
+                self.stats['max_flush_latency'] = max(self.stats['max_flush_latency'], latency)
+                self.stats['max_row_age'] = max(self.stats['max_row_age'], end - batch[0][0])
+                if ok:
+                    self.stats['rows_written'] += len(rows) - rejected
+                    self.stats['rows_failed'] += rejected
+                else:
+                    self.stats['batches_failed'] += 1
+                    self.stats['rows_failed'] += len(rows)
+            if ok and 'ccy_id' in columns:
+                pair_index = columns.index('ccy_id')
+                for enqueue_time, row in batch:
+                    self.instrumentation.record_persisted(row[pair_index], table, end - enqueue_time)
+            if not ok and self.spill is not None:
+                self._set_db_down()
+                self._spill(table, columns, rows)
+            elif not ok:
+                self.logger.warning("[BulkWriter] Bulk insert of %s rows into %s failed, rows lost", len(rows), table)
+            if rejected:
+                self.logger.warning("[BulkWriter] %s of %s rows rejected by %s, rows lost", rejected, len(rows), table)
+
+    def _set_db_down(self):
+        if not self.db_down:
+            self.db_down = True
+            self.logger.warning("[BulkWriter] DB unavailable, spilling rows to %s until it is back", self.spill.directory)
+
+    def backlog(self):
+        # type: () -> dict
+        backlog = {}
+        with self.cond:
+            for (table, _), queue in self.queues.iteritems():
+                backlog[table] = backlog.get(table, 0) + len(queue)
+        return backlog
+
+    def get_stats(self):
+        # type: () -> dict
+        with self.cond:
+            stats = dict(self.stats)
+        stats['backlog'] = self.backlog()
+        stats['db_down'] = self.db_down
+        stats['spill_pending'] = self.spill.pending() if self.spill is not None else 0
+        stats['avg_flush_latency'] = stats['total_flush_latency'] / stats['batches'] if stats['batches'] else 0.
+        return stats
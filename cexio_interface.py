@@ -1,13 +1,25 @@
 import hmac
 import hashlib
 import time
-import json, yaml
+import json
 import thread
+import threading
 from collections import OrderedDict
 from db_interface import CrateDbInterface
 import Queue
 from orderbook import Orderbook
-
+from book_analytics import BookAnalytics
+from book_sync import BookSync
+from tob_ring import TopOfBookRing
+from msg_decoder import MessageDecoder
+from dispatcher import ShardedDispatcher
+from request_manager import RequestManager
+from subscription_manager import SubscriptionManager
+import instrumentation
+import metrics
+
+import logging
+import numpy as np
 import websocket
 
 web_socket_url = 'wss://ws.cex.io/ws/'
@@ -21,8 +33,8 @@ class CexioInterface(object):
         CexioTraderBot
     """
 
-    def __init__(self, key, secret, db_interface, cexio_logger):
-#       type: (String, String, CrateDbInterface, Logger) -> object
+    def __init__(self, key, secret, db_interface, cexio_logger, shard_workers=4):
+#       type: (String, String, CrateDbInterface, Logger, int) -> object
         self.key = key
         self.secret = secret
         self.logger = cexio_logger
@@ -34,71 +46,177 @@ class CexioInterface(object):
             "auth": self.auth_act
             }
         self.is_connected = False
+        # set once the exchange accepted our auth, see wait_until_ready()
+        self.authenticated = threading.Event()
         self.db = db_interface
+        self.url = web_socket_url
+        # set by event_loop.WebSocketEventLoop.add(), None when running on run_forever/listener threads
+        self.event_loop = None
+        # messages sent before authentication while on an event loop, flushed by auth_act
+        self.outbox = []
+        self.outbox_lock = threading.Lock()
+        # msg_queue is the control lane, messages for a pair go through the dispatcher's pair lanes
         self.msg_queue = Queue.Queue()
+        self.listener_started = False
+        self.dispatcher = ShardedDispatcher(self, cexio_logger, shard_workers)
+        self.decoder = MessageDecoder()
+        self.instrumentation = instrumentation.pipeline
+        self.metrics = metrics.registry
+        # oid-correlated requests, see CexioTraderBot
+        self.requests = RequestManager(self.send, cexio_logger)
+        # local time of the last ping and its delay from the server time
+        self.last_ping_time = None
+        self.ping_delay = None
+        # set a feed_recorder.FeedRecorder to capture the raw frames
+        self.feed_recorder = None
+        # time of the data written to the DB, the recorded receive time while replaying (see feed_recorder.FeedReplayer)
+        self.clock = time.time
+        # set by stop(): no more reconnections
+        self.stopped = False
+        self.ws_thread = None
 
     def start(self):
         self.logger.info("Starting new {}".format(type(self)))
+        if not self.listener_started:
+            self.listener_started = True
+            thread.start_new_thread(self.start_msg_listener, ())
+        self.dispatcher.start()
+        if self.event_loop is not None:
+            # the loop owns the websocket and reconnects it by itself
+            return
         websocket.enableTrace(False)
-        self.ws = websocket.WebSocketApp(web_socket_url,
+        self.ws = websocket.WebSocketApp(self.url,
                                   on_message = self.on_message,
                                   on_error = self.on_error,
                                   on_close = self.on_close)
         self.ws.on_open = self.on_open
-        thread.start_new_thread(self.ws.run_forever, ())
-        thread.start_new_thread(self.start_msg_listener, ())
+        self.start_ws_thread()
         time.sleep(1)
 
 
-    def restart(self):
+    def restart(self, reason='restart'):
+        # subscriptions are restored once the new connection is authenticated, see CexioMarketDataHandler.auth_act
+        # the one place counting the reconnections of run_forever connections (on_reconnect for the event loop)
+        if self.stopped:
+            return
         self.logger.info("Launching new start ({})".format(type(self)))
+        self.metrics.inc('cexio_reconnects_total', reason=reason)
         self.start()
-        self.subscribe_orderbook('BTC', 'USD', 5)
-        self.subscribe_orderbook('BTC', 'EUR', 5)
-        self.subscribe_orderbook('BTC', 'GBP', 5)
 
 
+    def start_ws_thread(self):
+        self.ws_thread = threading.Thread(target=self.ws.run_forever, name="WebSocket")
+        self.ws_thread.daemon = True
+        self.ws_thread.start()
+
+    def stop(self, timeout=5.):
+        # closes the websocket (without reconnecting) and stops the listener and the pair workers once they are done
+        # with the messages already queued
+        self.logger.info("Stopping {}".format(type(self)))
+        self.stopped = True
+        self.requests.stop()
+        if self.event_loop is None and getattr(self, 'ws', None) is not None:
+            self.ws.keep_running = False
+            self.ws.close()
+            if self.ws_thread is not None and self.ws_thread is not threading.current_thread():
+                self.ws_thread.join(timeout)
+        if self.listener_started:
+            self.msg_queue.put(None)
+        self.dispatcher.stop(timeout)
+
     def start_msg_listener(self):
         while True:
             self.logger.debug("Msg listener: waiting for new message...")
-            next_msg = self.msg_queue.get()
-            start_action = time.time()
-            self.logger.debug("Message listener: next msg: {}".format(next_msg))
-            if next_msg['e'] in self.actions_on_msg_map.keys():
-                self.logger.debug("Message {} recognised, launching {}".format(next_msg, self.actions_on_msg_map[next_msg['e']]))
-                self.actions_on_msg_map[next_msg['e']](next_msg)
-            else:
-                self.logger.warning("Unknown message: {}, will be discarded".format(next_msg))
-            end_action = time.time()
-            self.logger.debug("Msg listener took {} to process msg: {}".format(end_action - start_action, next_msg))
+            item = self.msg_queue.get()
+            if item is None:
+                self.listener_started = False
+                return
+            action, next_msg, trace = item
+            if trace is not None:
+                self.instrumentation.mark(trace, 'dequeued')
+            self.logger.debug("Message listener: next msg: %s", next_msg)
+            # an exception (e.g. a send on a socket that just dropped) mustn't end the listener: the connected/auth
+            # messages of the reconnection would never be handled
+            try:
+                self.handle_message(action, next_msg, trace)
+            except Exception as e:
+                self.logger.warning("[Listener] Exception while handling %s: %s", next_msg, e)
+
+    def handle_message(self, action, msg, trace):
+        action(msg)
+        if trace is None:
+            # internal action (e.g. a resync check), not a message from the exchange
+            return
+        self.instrumentation.mark(trace, 'handled')
+        self.instrumentation.record_trace(self.get_pair(msg), msg['e'], trace)
+
+    def get_pair(self, msg):
+        data = msg.get('data')
+        return data.get('pair') if isinstance(data, dict) else None
 
     def restart_ws(self):
         self.logger.info("Restarting WebSocket")
-        thread.start_new_thread(self.ws.run_forever, ())
+        self.start_ws_thread()
         time.sleep(1)
 
     def on_message(self, ws, message):
-        msg = yaml.load(message)
-        #self.msg_queue.put(msg)
-        self.logger.debug("[WS] on_message event, msg = {}".format(msg))
-        start_time = time.time()
-        if msg['e'] in self.actions_on_msg_map.keys():
-            # ping can't wait, so it bypasses the message queue
-            if msg['e'] == 'ping':
-                self.pong_act(msg)
+        trace = self.instrumentation.new_trace()
+        if self.feed_recorder is not None:
+            self.feed_recorder.record(message)
+        decoded = self.decode_frame(message, trace)
+        if decoded is not None:
+            pair = self.get_pair(decoded[1])
+            self.instrumentation.mark(trace, 'enqueued')
+            if pair is not None:
+                self.instrumentation.record_queue_depth(self.dispatcher.put(pair, decoded), pair)
             else:
-                self.logger.debug("Message {} recognised, launching {}".format(msg, self.actions_on_msg_map[msg['e']]))
-                self.msg_queue.put(msg)
-                #self.actions_on_msg_map[msg['e']](msg)
-        else:
-            self.logger.warning("Unknown message: {}, will be discarded".format(msg))
-        end_time = time.time()
-        self.logger.debug("on_message: Message stacked, handled or discarded, ready to accept new message (took {}s)".format(end_time - start_time))
+                self.msg_queue.put(decoded)
+                self.instrumentation.record_queue_depth(self.msg_queue.qsize())
+
+    def decode_frame(self, message, trace=None):
+        # type: (str, list) -> (function, dict, list)
+        # Returns (action, msg, trace), or None if the frame was already dealt with (ping) or discarded
+        if trace is None:
+            trace = self.instrumentation.new_trace()
+        event = self.decoder.peek_event(message)
+        # ping can't wait, so it bypasses the message queue (and the decoding)
+        if event == 'ping':
+            self.record_ping(message)
+            self.pong_act(None)
+            return None
+        msg = None
+        if self.requests.waits_for(event):
+            # responses are matched on their oid before event dispatch
+            msg = self.decoder.decode(message)
+            if self.requests.resolve(msg):
+                return None
+        elif event is not None and event not in self.actions_on_msg_map:
+            self.logger.warning("Unknown message: %s, will be discarded", message)
+            return None
+        if msg is None:
+            msg = self.decoder.decode(message)
+        self.instrumentation.mark(trace, 'decoded')
+        self.logger.debug("[WS] on_message event, msg = %s", msg)
+        action = self.actions_on_msg_map.get(msg.get('e'))
+        if action is None:
+            self.logger.warning("Unknown message: %s, will be discarded", msg)
+            return None
+        self.logger.debug("Message %s recognised, launching %s", msg, action)
+        return action, msg, trace
 
     def connected_act(self, msg):
         self.is_connected = True
         self.logger.info("[WS] Websocket connected")
 
+    def record_ping(self, message):
+        self.last_ping_time = time.time()
+        try:
+            server_time = self.decoder.decode(message).get('time')
+            if server_time is not None:
+                self.ping_delay = self.last_ping_time - float(server_time) / 1000.
+        except ValueError:
+            pass
+
     def pong_act(self, msg):
         self.logger.debug("Sending pong")
         self.ws.send(json.dumps({
@@ -107,21 +225,52 @@ class CexioInterface(object):
 
     def disconnecting_act(self, msg):
         self.is_connected = False
+        self.authenticated.clear()
+        self.requests.cancel_all('disconnected')
         self.logger.info("[WS] Disconnecting...")
 
     def auth_act(self, msg):
+        if msg.get('ok', 'ok') != 'ok':
+            self.logger.warning("[WS] Authentication refused: %s", msg)
+            return
         self.logger.info("[WS] Authenticated to exchange")
+        with self.outbox_lock:
+            self.authenticated.set()
+            outbox, self.outbox = self.outbox, []
+        for out_msg in outbox:
+            self.ws.send(out_msg)
+
+    def wait_until_ready(self, timeout=None):
+        # type: (float) -> bool
+        return self.authenticated.wait(timeout)
+
+    def send(self, msg):
+        # On an event loop, messages sent before authentication are held until auth_act
+        if self.event_loop is not None:
+            with self.outbox_lock:
+                if not self.authenticated.is_set():
+                    self.outbox.append(msg)
+                    return
+        self.ws.send(msg)
+
+    def on_reconnect(self):
+        # called by the event loop once a dropped websocket has been reopened
+        self.metrics.inc('cexio_reconnects_total', reason='reconnect')
 
     def on_error(self, ws, error):
         #type: (websocket.WebSocketApp, str)
-        self.logger.warning("[WS] on_error event, err = {}".format(error))
-        self.logger.debug("ws = {}".format(ws))
+        if self.stopped:
+            return
+        self.logger.warning("[WS] on_error event, err = %s", error)
+        self.logger.debug("ws = %s", ws)
         self.logger.debug("Need to reconnect. Launching restart")
         self.is_connected = False
-        self.restart()
+        self.authenticated.clear()
+        self.requests.cancel_all('disconnected')
+        self.restart('error')
 
     def on_close(self, ws, message):
-        self.logger.info("[WS] on_close event, msg = {}".format(message))
+        self.logger.info("[WS] on_close event, msg = %s", message)
         self.logger.warning("Websocket closed")
 
     def on_open(self, ws):
@@ -133,7 +282,7 @@ class CexioInterface(object):
         return int(time.time())
 
     def get_ms_timestamp(self):
-        return int(time.time()*1000)
+        return int(self.clock()*1000)
 
     def create_signature(self):  # (string key, string secret)
         timestamp = self.get_timestamp()  # UNIX timestamp in seconds
@@ -148,22 +297,50 @@ class CexioInterface(object):
                 'auth': {'key': self.key, 'signature': signature, 'timestamp': timestamp,}, 'oid': 'auth', })
 
     def connect(self):
-        self.logger.info("[WS] Connecting to websocket: " + web_socket_url)
+        self.logger.info("[WS] Connecting to websocket: " + self.url)
         self.ws.send(self.auth_request())
 
 class CexioMarketDataHandler(CexioInterface):
     """
     CexioMarketDataHandler allows to deal with all Market data tasks
     """
-    def __init__(self, key, secret, db_interface, cexio_logger):
-        CexioInterface.__init__(self, key, secret, db_interface, cexio_logger)
+    def __init__(self, key, secret, db_interface, cexio_logger, shard_workers=4):
+        CexioInterface.__init__(self, key, secret, db_interface, cexio_logger, shard_workers)
         self.ccy_order_books = {}
+        # book_factory(ccy, depth, logger) builds the books: Orderbook, or ladder_orderbook.LadderOrderbook (exact integer
+        # pricing, slower)
+        self.book_factory = Orderbook
         self.ccy_depth = {}
         #ccy_order_books_buffer: dict(ccy) -> {timestamp: [(bid_qty, bid, ask, ask_qty)]}
         self.ccy_order_books_buffer = {}
         self.actions_on_msg_map['tick'] = self.tick_act
         self.actions_on_msg_map['md_update'] = self.md_update_act
         self.actions_on_msg_map['order-book-subscribe'] = self.order_book_snapshot_act
+        self.actions_on_msg_map['order-book-unsubscribe'] = self.order_book_unsubscribe_act
+        # set a book_history.BookHistoryWriter to keep the book history as snapshots + deltas, stamped with self.clock
+        self.book_history = None
+        # set a bar_aggregator.BarAggregator to build the market_data_histo bars
+        self.bar_aggregator = None
+        # set a conflation.TopOfBookConflator to only persist top of book changes
+        self.conflator = None
+        # set a shm_book.ShmBookPublisher to share the live books with other processes
+        self.shm_publisher = None
+        # set a cross_view.CrossView to follow the implied crosses between the pairs of an asset
+        self.cross_view = None
+        # analytics: dict(ccy) -> BookAnalytics, see get_analytics()
+        self.analytics = {}
+        # tob_rings: dict(ccy) -> TopOfBookRing of the last tob_ring_size top of book rows, 0 to disable
+        self.tob_rings = {}
+        self.tob_ring_size = 4096
+        # last_update_time: dict(ccy) -> time of the last snapshot or update applied to the book
+        self.last_update_time = {}
+        # book_sync: dict(ccy) -> BookSync, md_update id tracking and resync state
+        self.book_sync = {}
+        # at most one snapshot request per pair every resync_interval seconds, sent again after resync_timeout
+        self.resync_interval = 1.
+        self.resync_timeout = 5.
+        # declared order book subscriptions, sent on each authentication
+        self.subscriptions = SubscriptionManager(self, cexio_logger)
         self.debug_number_of_updates = {}
         self.debug_init_time = {}
         self.logger.debug("actions_in_msg_map for {} = {}".format(type(self), self.actions_on_msg_map.keys()))
@@ -171,69 +348,191 @@ class CexioMarketDataHandler(CexioInterface):
         #Methods you want to relaunch on reconnect.
         self.methods_to_relaunch_on_reconnect = []
 
+    def stop(self, timeout=5.):
+        for sync in self.book_sync.values():
+            if sync.check_timer is not None:
+                sync.check_timer.cancel()
+        CexioInterface.stop(self, timeout)
+
     def tick_act(self, msg):
         # see: https://cex.io/websocket-api#ticker-subscription
         self.logger.warning("tick_act ! ####To Be Implemented###")
         pass
 
+    def auth_act(self, msg):
+        CexioInterface.auth_act(self, msg)
+        if self.authenticated.is_set():
+            self.subscriptions.subscribe_all()
+
     def order_book_snapshot_act(self, msg):
+        if msg.get('ok', 'ok') != 'ok':
+            self.logger.warning("[WS] Order book subscription refused: %s", msg)
+            return
         ccy = msg['data']['pair']
-        self.logger.info("[WS] order_book_snapshot received for {}".format(ccy))
+        self.logger.info("[WS] order_book_snapshot received for %s", ccy)
         self.ccy_order_books[ccy].build(msg['data'])
-        self.logger.debug("Orderbook for {} is now: \n{}".format(ccy, self.ccy_order_books[ccy]))
+        self.last_update_time[ccy] = time.time()
+        if self.shm_publisher is not None:
+            self.shm_publisher.publish(ccy, self.ccy_order_books[ccy], msg['data'].get('id', 0))
+        if self.book_history is not None:
+            self.book_history.write_snapshot(ccy, self.ccy_order_books[ccy], msg['data'].get('id', 0), self.clock())
+        self.logger.debug("Orderbook for %s is now: \n%s", ccy, self.ccy_order_books[ccy])
         self.record_best_bid_ask(ccy)
-        self.ccy_order_books[ccy].update_nb += 1
+        sync = self.get_book_sync(ccy)
+        resync_reason, requested_at = sync.reason, sync.requested_at
+        replay, stale_time = sync.finish(msg['data'].get('id', 0))
+        if sync.check_timer is not None:
+            sync.check_timer.cancel()
+            sync.check_timer = None
+        if resync_reason not in (None, 'subscribe'):
+            now = time.time()
+            self.metrics.inc('cexio_book_stale_seconds_total', stale_time, pair=ccy)
+            if requested_at is not None:
+                self.metrics.set('cexio_resync_latency_seconds', now - requested_at, pair=ccy)
+            self.logger.info("[WS] %s resynced (%s) after %.3fs stale, replaying %s buffered updates", ccy, resync_reason,
+                             stale_time, len(replay))
+        for data in replay:
+            self.md_update_act({'e': 'md_update', 'data': data})
+        self.subscriptions.on_snapshot(ccy)
+
+    def order_book_unsubscribe_act(self, msg):
+        self.logger.debug("[WS] order_book_unsubscribe acknowledged: %s", msg)
 
     def md_update_act(self, msg):
         self.logger.debug("[WS] md_update received")
         ccy = str(msg['data']['pair'])
-        self.logger.debug("update for: {}".format(ccy))
-        # commenting to test ws disconnection
-        self.logger.debug("Orderbook before update:"
-                          " \nbids {}: {}\nasks {}: {}".format(ccy, self.ccy_order_books[ccy].get_sorted()['bids'],
-                                                         ccy, self.ccy_order_books[ccy].get_sorted()['asks']))
-        self.ccy_order_books[ccy].update(msg['data'])
+        self.logger.debug("update for: %s", ccy)
+        if ccy not in self.ccy_order_books:
+            self.logger.debug("[WS] Dropping update %s for %s, not subscribed", msg['data']['id'], ccy)
+            return
+        sync = self.get_book_sync(ccy)
+        if sync.resyncing:
+            sync.buffer.append(msg['data'])
+            self.request_snapshot(ccy)
+            return
+        status = sync.check(msg['data']['id'])
+        if status == 'duplicate':
+            self.logger.debug("[WS] Dropping update %s for %s, already applied", msg['data']['id'], ccy)
+            return
+        if status == 'gap':
+            self.logger.warning("[WS] Sequence gap on %s: update %s after %s", ccy, msg['data']['id'], sync.last_id)
+            self.start_resync(ccy, 'gap')
+            sync.buffer.append(msg['data'])
+            return
+        sync.last_id = msg['data']['id']
+        order_book = self.ccy_order_books[ccy]
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            sorted_book = order_book.get_sorted()
+            self.logger.debug("Orderbook before update: \nbids %s: %s\nasks %s: %s",
+                              ccy, sorted_book['bids'], ccy, sorted_book['asks'])
+        order_book.update(msg['data'])
+        self.last_update_time[ccy] = time.time()
+        if self.shm_publisher is not None:
+            self.shm_publisher.publish(ccy, order_book, msg['data']['id'])
+        if self.book_history is not None:
+            self.book_history.write_delta(ccy, msg['data'], order_book, self.clock())
         self.record_best_bid_ask(ccy)
-        self.logger.debug("Orderbook after update:"
-                          " \nbids {}: {}\nasks {}: {}".format(ccy, self.ccy_order_books[ccy].get_sorted()['bids'],
-                                                         ccy, self.ccy_order_books[ccy].get_sorted()['asks']))
-        self.ccy_order_books[ccy].update_nb += 1
-        self.logger.debug("orderbook update #{} for {} (average of {} updates/sec)".format(self.ccy_order_books[ccy].update_nb, ccy, self.ccy_order_books[ccy].update_nb/(time.time() - self.ccy_order_books[ccy].init_time)))
-        if not self.ccy_order_books[ccy].is_valid():
+        if debug:
+            sorted_book = order_book.get_sorted()
+            self.logger.debug("Orderbook after update: \nbids %s: %s\nasks %s: %s",
+                              ccy, sorted_book['bids'], ccy, sorted_book['asks'])
+            self.logger.debug("orderbook update #%s for %s", order_book.update_nb, ccy)
+        if not order_book.is_valid():
+            self.start_resync(ccy, 'invalid')
+
+    def get_book_sync(self, ccy):
+        # type: (str) -> BookSync
+        sync = self.book_sync.get(ccy)
+        if sync is None:
+            sync = self.book_sync[ccy] = BookSync(ccy, self.resync_interval, self.resync_timeout)
+        return sync
+
+    def start_resync(self, ccy, reason):
+        # the book is kept (stale) until the new snapshot, updates are buffered meanwhile
+        self.logger.info("[WS] Resyncing %s (%s)", ccy, reason)
+        self.metrics.inc('cexio_resyncs_total', pair=ccy, reason=reason)
+        self.get_book_sync(ccy).start(reason)
+        self.request_snapshot(ccy)
+
+    def request_snapshot(self, ccy):
+        sync = self.book_sync[ccy]
+        if sync.request_due():
+            sync.requested()
             self.resubscribe_orderbook(ccy)
+            self.schedule_resync_check(ccy, sync.timeout)
+        elif sync.check_timer is None:
+            self.schedule_resync_check(ccy, sync.min_interval)
+
+    def schedule_resync_check(self, ccy, delay):
+        # runs resync_check_act on the pair's lane after delay, in case no update comes to trigger the request
+        sync = self.book_sync[ccy]
+        if sync.check_timer is not None:
+            sync.check_timer.cancel()
+
+        def check():
+            self.dispatcher.put(ccy, (self.resync_check_act, {'e': 'resync-check', 'data': {'pair': ccy}}, None))
+        sync.check_timer = threading.Timer(delay, check)
+        sync.check_timer.daemon = True
+        sync.check_timer.start()
+
+    def resync_check_act(self, msg):
+        ccy = msg['data']['pair']
+        sync = self.book_sync[ccy]
+        sync.check_timer = None
+        if sync.resyncing:
+            self.request_snapshot(ccy)
 
-    """ TODO: needs to be refactored to new Orderbook objects"""
     def record_best_bid_ask(self, ccy):
-        self.logger.debug("ccy = {}".format(ccy))
+        self.logger.debug("ccy = %s", ccy)
         try:
+            order_book = self.ccy_order_books[ccy]
+            bid, bid_qty = order_book.best_bid()
+            ask, ask_qty = order_book.best_ask()
+            if bid is None or ask is None:
+                raise ValueError("one side of the book is empty")
             data_dict = {
                 'timestamp': self.get_ms_timestamp(),
                 'ccy_id': ccy,
-                'bid': self.ccy_order_books[ccy].get_sorted()['bids'].keys()[0],
-                'bid_qty': self.ccy_order_books[ccy].get_sorted()['bids'].values()[0],
-                'ask': self.ccy_order_books[ccy].get_sorted()['asks'].keys()[0],
-                'ask_qty': self.ccy_order_books[ccy].get_sorted()['asks'].values()[0]
+                'bid': bid,
+                'bid_qty': bid_qty,
+                'ask': ask,
+                'ask_qty': ask_qty
             }
-            self.logger.debug("Orderbook sorted = \nbids: {}\nasks: {}".format(self.ccy_order_books[ccy].get_sorted()['bids'], self.ccy_order_books[ccy].get_sorted()['asks']))
-            self.logger.debug("Datadict about to be insterted in raw_market_data_histo: {}".format(data_dict))
-            query = self.db.insert_query('raw_market_data_histo', data_dict)
-            self.db.run_query(query)
+            self.logger.debug("Datadict about to be insterted in raw_market_data_histo: %s", data_dict)
+            if self.tob_ring_size:
+                ring = self.tob_rings.get(ccy)
+                if ring is None:
+                    ring = self.tob_rings[ccy] = TopOfBookRing(self.tob_ring_size)
+                ring.append(data_dict['timestamp'] / 1000., bid, bid_qty, ask, ask_qty)
+            if self.conflator is not None:
+                self.conflator.offer(ccy, data_dict)
+            else:
+                self.db.write('raw_market_data_histo', data_dict)
+            if self.bar_aggregator is not None:
+                self.bar_aggregator.on_top_of_book(ccy, data_dict)
+            if self.cross_view is not None:
+                self.cross_view.on_top_of_book(ccy, bid, ask)
         except Exception as e:
-            self.logger.debug("Couldn't record_best_bid_ask for {}".format(ccy))
-            self.logger.debug("Exception thrown: \n{}".format(e))
-            self.logger.debug("Orderbook was: \n{}".format(self.ccy_order_books[ccy]))
+            self.logger.debug("Couldn't record_best_bid_ask for %s", ccy)
+            self.logger.debug("Exception thrown: \n%s", e)
+            self.logger.debug("Orderbook was: \n%s", self.ccy_order_books[ccy])
 
 
 
     def record_order_book_histo(self, ccy):
+        if self.book_history is not None:
+            self.logger.debug("Recording order_book snapshot in book history")
+            self.book_history.write_snapshot(ccy, self.ccy_order_books[ccy], self.get_book_sync(ccy).last_id or 0,
+                                             self.clock())
+            return
         self.logger.debug("Recording order_book in order_book_histo")
         data_dict = {
             'timestamp': self.get_ms_timestamp(),
             'ccy_id': ccy,
-            'order_book': self.ccy_order_books[ccy]
+            'order_book': str(self.ccy_order_books[ccy])
         }
-        query = self.db.insert_query('order_book_histo', data_dict)
-        self.db.run_query(query)
+        self.db.write('order_book_histo', data_dict)
 
     def start_listening(self):
         self.start()
@@ -247,17 +546,43 @@ class CexioMarketDataHandler(CexioInterface):
             "e": "subscribe",
             "rooms": ["tickers"]
         })
-        self.ws.send(msg)
+        self.send(msg)
+
+    def add_orderbook(self, ccy, depth):
+        # new empty book, waiting for its snapshot: updates are buffered until then (see BookSync)
+        sync = self.book_sync.get(ccy)
+        if sync is not None and sync.check_timer is not None:
+            sync.check_timer.cancel()
+        self.ccy_order_books[ccy] = self.book_factory(ccy, depth, self.logger)
+        self.book_sync[ccy] = BookSync(ccy, self.resync_interval, self.resync_timeout)
+
+    def reset_orderbook(self, ccy, depth):
+        # add_orderbook on the pair's lane once the workers run, so the worker never sees the book swapped in the
+        # middle of an update, and the snapshot of the subscription sent next is queued after the reset
+        if not self.dispatcher.threads:
+            self.add_orderbook(ccy, depth)
+            return
+        self.dispatcher.put(ccy, (self.reset_orderbook_act, {'e': 'order-book-reset', 'data': {'pair': ccy, 'depth': depth}}, None))
+
+    def reset_orderbook_act(self, msg):
+        self.add_orderbook(msg['data']['pair'], msg['data']['depth'])
 
     def subscribe_orderbook(self, symbol1, symbol2, depth = 5):
+        # subscribes right away, and declares the pair so it is subscribed again after a reconnection
         ccy = "{}:{}".format(symbol1, symbol2)
-        self.ccy_order_books[ccy] = Orderbook(ccy, depth, self.logger)
-        self.logger.info("[WS] Subscribing to pair {}".format(ccy))
+        self.subscriptions.declare(ccy, depth)
+        self.reset_orderbook(ccy, depth)
+        self.send_orderbook_subscribe(symbol1, symbol2, depth)
+
+    def send_orderbook_subscribe(self, symbol1, symbol2, depth = 5):
+        ccy = "{}:{}".format(symbol1, symbol2)
+        if not self.authenticated.is_set():
+            # never reconnects from here (restart() may already be reconnecting): auth_act subscribes every declared
+            # pair once the connection is back
+            self.logger.info("[WS] Not authenticated, subscription to %s left to the next auth", ccy)
+            return
+        self.logger.info("[WS] Subscribing to pair %s", ccy)
         self.debug_init_time[ccy] = time.time()
-        if not self.is_connected:
-            self.start()
-            self.logger.warning("Not connected, trying to reconnect")
-            time.sleep(2)
         oid = "{}_orderbook_{}{}".format(str(self.get_timestamp()), symbol1, symbol2)
         msg = json.dumps({
             "e": "order-book-subscribe",
@@ -271,12 +596,16 @@ class CexioMarketDataHandler(CexioInterface):
             },
             "oid": oid
         })
-        self.ws.send(msg)
+        self.send(msg)
 
     def resubscribe_orderbook(self, pair, depth = 5):
+        # asks for a new snapshot, the current book stays in place until it arrives
+        if not self.authenticated.is_set():
+            self.logger.info("[WS] Not authenticated, resubscription to %s left to the next auth", pair)
+            return
+        self.metrics.inc('cexio_resubscribes_total', pair=pair)
         self.unsubscribe_orderbook(pair)
-        self.subscribe_orderbook(pair[:3], pair[4:], self.ccy_order_books[pair].depth)
-        pass
+        self.send_orderbook_subscribe(pair[:3], pair[4:], self.ccy_order_books[pair].depth)
 
     def unsubscribe_orderbook(self, pair):
         symbol1 = pair[:3]
@@ -292,40 +621,42 @@ class CexioMarketDataHandler(CexioInterface):
             },
             "oid": oid
         })
-        self.ws.send(msg)
+        self.send(msg)
 
     def build_order_book(self, data):
         order_book = {'bids': OrderedDict(), 'asks': OrderedDict()}
-        self.logger.debug("[build_order_book] Initialising order book to: {}".format(order_book))
-        self.logger.debug("[build_order_book] Building order book for {}".format(data['pair']))
+        self.logger.debug("[build_order_book] Initialising order book to: %s", order_book)
+        self.logger.debug("[build_order_book] Building order book for %s", data['pair'])
         for b in data['bids']:
             order_book['bids'][b[0]] = b[1]
         for a in data['asks']:
             order_book['asks'][a[0]] = a[1]
-        self.logger.debug("[build_order_book] returning: {}".format(order_book))
+        self.logger.debug("[build_order_book] returning: %s", order_book)
         return order_book
 
 
 
-    def in_depth_limit(self, ccy, order_book):
+    def get_tob_ring(self, ccy):
+        # type: (str) -> TopOfBookRing
+        # recent top of book of ccy and its rolling statistics, None before its first valid book
+        return self.tob_rings.get(ccy)
+
+    def get_analytics(self, ccy):
+        # type: (str) -> BookAnalytics
+        analytics = self.analytics.get(ccy)
+        if analytics is None or analytics.order_book is not self.ccy_order_books[ccy]:
+            analytics = self.analytics[ccy] = BookAnalytics(self.ccy_order_books[ccy])
+        return analytics
+
+    def in_depth_limit(self, ccy, order_book=None):
         #type: (str, {'bids': {},'asks': {}}) -> (float, float, float, float)
-        bid_qty = 0
-        bid = 0
-        ask = 0
-        ask_qty = 0
-        self.logger.debug("Calculating in depth limit for {}".format(ccy))
-        count_b = count_a = 0
-        for b, bq in order_book['bids'].iteritems():
-            bid_qty += bq
-            bid += b
-            count_b += 1
-        bid = bid/count_b
-        for a, aq in order_book['asks'].iteritems():
-            ask_qty += aq
-            ask += a
-            count_a += 1
-        ask = ask/count_a
-        return (bid_qty, bid, ask, ask_qty)
+        # order_book defaults to the live book of ccy, in which case the result is cached until its next update
+        self.logger.debug("Calculating in depth limit for %s", ccy)
+        if order_book is None:
+            return self.get_analytics(ccy).in_depth_limit()
+        bids = np.array(order_book['bids'].items(), dtype=np.float64).reshape(-1, 2)
+        asks = np.array(order_book['asks'].items(), dtype=np.float64).reshape(-1, 2)
+        return (bids[:, 1].sum(), bids[:, 0].mean(), asks[:, 0].mean(), asks[:, 1].sum())
 
 class CexioTraderBot(CexioInterface):
     """
@@ -333,17 +664,37 @@ class CexioTraderBot(CexioInterface):
     """
     def __init__(self, key, secret, db_interface, cexio_logger):
         CexioInterface.__init__(self, key, secret, db_interface, cexio_logger)
-        self.start()
 
     def update_balance(self):
+        # type: () -> ResponseFuture
         self.logger.info("Requesting updated balance...")
-        oid = str(self.get_timestamp()) + "_get-balance"
-        msg = json.dumps({
-                "e": "get-balance",
-                "data": {},
-                "oid": oid
-                })
-        self.ws.send(msg)
+        return self.get_balance(callback=self.on_balance)
+
+    def on_balance(self, future):
+        if future.error is None:
+            self.balance = future.response['data']
+            self.logger.debug("Balance updated: %s", self.balance)
+
+    # Requests return a request_manager.ResponseFuture right away: block on future.result(timeout) or pass a
+    # callback(future). Round trip latencies per request type are in self.requests.latencies.
+
+    def get_balance(self, callback=None, timeout=None):
+        # type: (function, float) -> ResponseFuture
+        return self.requests.request('get-balance', {}, timeout, callback)
+
+    def place_order(self, pair, amount, price, order_type, callback=None, timeout=None):
+        # type: (str, float, float, str, function, float) -> ResponseFuture
+        # order_type: 'buy' or 'sell', pair: 'BTC:USD'
+        data = {'pair': pair.split(':'), 'amount': amount, 'price': str(price), 'type': order_type}
+        return self.requests.request('place-order', data, timeout, callback)
+
+    def cancel_order(self, order_id, callback=None, timeout=None):
+        # type: (str, function, float) -> ResponseFuture
+        return self.requests.request('cancel-order', {'order_id': order_id}, timeout, callback)
+
+    def open_orders(self, pair, callback=None, timeout=None):
+        # type: (str, function, float) -> ResponseFuture
+        return self.requests.request('open-orders', {'pair': pair.split(':')}, timeout, callback)
 
     """def order_balance(self):
         self.logger.info("Requesting order balance...")
@@ -353,4 +704,4 @@ class CexioTraderBot(CexioInterface):
             "data": {},
             "oid": oid
         })
-        self.ws.send(msg)"""
+        self.send(msg)"""
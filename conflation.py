@@ -0,0 +1,125 @@
+import threading
+import time
+
+
+class ConflationPolicy(object):
+    """
+    suppress_unchanged: drop rows whose top of book is the same as the last persisted one
+    compare_qty: quantities are part of the top of book, otherwise only bid/ask prices are compared
+    window: seconds during which a burst of changes is collapsed into its final state, 0 persists every change
+    """
+
+    def __init__(self, suppress_unchanged=True, compare_qty=True, window=0.):
+        self.suppress_unchanged = suppress_unchanged
+        self.compare_qty = compare_qty
+        self.window = window
+
+    def key(self, row):
+        if self.compare_qty:
+            return row['bid'], row['bid_qty'], row['ask'], row['ask_qty']
+        return row['bid'], row['ask']
+
+
+class TopOfBookConflator(object):
+    """
+    Sits between record_best_bid_ask and the DB: keeps the last persisted top of book per pair and only lets real
+    changes through, optionally collapsing bursts within a conflation window (the last row of the window is
+    persisted when it closes, on the next row or from the background timer).
+        policies: dict(ccy) -> ConflationPolicy, default_policy otherwise
+        counters: dict(ccy) -> {'offered', 'persisted', 'suppressed', 'conflated'}
+    """
+
+    def __init__(self, db_interface, conflation_logger, default_policy=None, table='raw_market_data_histo'):
+        # type: (CrateDbInterface, Logger, ConflationPolicy, str) -> object
+        self.db = db_interface
+        self.logger = conflation_logger
+        self.default_policy = default_policy or ConflationPolicy()
+        self.table = table
+        self.policies = {}
+        self.last_persisted = {}
+        # pending: dict(ccy) -> (window deadline, row)
+        self.pending = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def set_policy(self, ccy, policy):
+        # type: (str, ConflationPolicy) -> None
+        with self.lock:
+            self.policies[ccy] = policy
+
+    def _counters(self, ccy):
+        counters = self.counters.get(ccy)
+        if counters is None:
+            counters = self.counters[ccy] = {'offered': 0, 'persisted': 0, 'suppressed': 0, 'conflated': 0}
+        return counters
+
+    def _persist(self, ccy, policy, row, counters):
+        # called with the lock held, returns the row to write or None
+        key = policy.key(row)
+        if policy.suppress_unchanged and self.last_persisted.get(ccy) == key:
+            counters['suppressed'] += 1
+            return None
+        self.last_persisted[ccy] = key
+        counters['persisted'] += 1
+        return row
+
+    def offer(self, ccy, row, now=None):
+        # type: (str, dict, float) -> None
+        if now is None:
+            now = time.time()
+        to_write = []
+        with self.lock:
+            policy = self.policies.get(ccy, self.default_policy)
+            counters = self._counters(ccy)
+            counters['offered'] += 1
+            pending = self.pending.get(ccy)
+            if pending is not None and pending[0] <= now:
+                del self.pending[ccy]
+                to_write.append(self._persist(ccy, policy, pending[1], counters))
+                pending = None
+            if policy.window <= 0:
+                to_write.append(self._persist(ccy, policy, row, counters))
+            elif pending is not None:
+                counters['conflated'] += 1
+                self.pending[ccy] = (pending[0], row)
+            elif policy.suppress_unchanged and self.last_persisted.get(ccy) == policy.key(row):
+                counters['suppressed'] += 1
+            else:
+                self.pending[ccy] = (now + policy.window, row)
+        for r in to_write:
+            if r is not None:
+                self.db.write(self.table, r)
+
+    def flush_expired(self, now=None, force=False):
+        # persists the pending rows whose window is over (all of them if force)
+        if now is None:
+            now = time.time()
+        to_write = []
+        with self.lock:
+            for ccy, (deadline, row) in self.pending.items():
+                if force or deadline <= now:
+                    del self.pending[ccy]
+                    to_write.append(self._persist(ccy, self.policies.get(ccy, self.default_policy), row, self._counters(ccy)))
+        for r in to_write:
+            if r is not None:
+                self.db.write(self.table, r)
+
+    def get_counters(self):
+        # type: () -> dict
+        with self.lock:
+            return dict((ccy, dict(c)) for ccy, c in self.counters.iteritems())
+
+    def start(self, period=0.05):
+        def run():
+            while True:
+                time.sleep(period)
+                try:
+                    self.flush_expired()
+                except Exception as e:
+                    self.logger.warning("[Conflation] Couldn't flush pending rows: {}".format(e))
+        self.thread = threading.Thread(target=run, name="TopOfBookConflator")
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info("[Conflation] Started, default policy: suppress_unchanged={}, window={}s".format(
+            self.default_policy.suppress_unchanged, self.default_policy.window))
@@ -0,0 +1,168 @@
+import threading
+
+# Market convention for the order of the currencies of a cross: EUR/USD, GBP/USD, EUR/GBP, USD/JPY...
+currency_order = ('EUR', 'GBP', 'AUD', 'NZD', 'USD', 'CAD', 'CHF', 'JPY', 'RUB')
+
+
+def cross_name(ccy1, ccy2):
+    # type: (str, str) -> (str, str)
+    # (base, quote) of the cross between two currencies, in market convention
+    rank1 = currency_order.index(ccy1) if ccy1 in currency_order else len(currency_order)
+    rank2 = currency_order.index(ccy2) if ccy2 in currency_order else len(currency_order)
+    return (ccy1, ccy2) if (rank1, ccy1) < (rank2, ccy2) else (ccy2, ccy1)
+
+
+def changed(old, new, threshold, relative=True):
+    # change of a value (or of any value of a tuple) beyond threshold, None being a change of its own
+    if old is None or new is None:
+        return old is not new
+    if isinstance(new, tuple):
+        return any(changed(o, n, threshold, relative) for o, n in zip(old, new))
+    return abs(new - old) > (threshold * abs(old) if relative else threshold)
+
+
+class CrossView(object):
+    """
+    Consolidated view of the pairs sharing an asset (BTC:USD, BTC:EUR, BTC:GBP...), updated incrementally on each top
+    of book change:
+        crosses: dict((ccy1, ccy2)) -> {'bid', 'ask', 'mid', 'by_asset': dict(asset) -> (bid, ask)}, rates implied by
+                 the books, e.g. EUR/USD bid = BTC:USD bid / BTC:EUR ask: what selling EUR for USD through BTC yields
+        normalized: dict(pair) -> {'bid', 'ask'}, best prices in base currency, converted at the reference rate of the
+                    quote currency if one was set (set_reference_rate), else at the implied mid
+        dislocations: dict((ccy1, ccy2)) -> relative gap between the implied crosses of different assets, or between
+                      the implied cross and the reference rate, when one can be bought below where the other is sold
+    An update of a pair only recomputes the crosses of its asset that involve its quote currency, then what depends on
+    them, so the work per tick grows with the nb of quote currencies of the asset, not the nb of pairs.
+    Listeners(kind, key, value) are called, and values replaced in emitted, only when a value moves by more than
+    threshold: relative for crosses ((bid, ask)) and normalized prices ((bid, ask)), absolute for dislocations.
+    """
+
+    def __init__(self, cross_logger, base='USD', threshold=1e-4):
+        # type: (Logger, str, float) -> object
+        self.logger = cross_logger
+        self.base = base
+        self.threshold = threshold
+        # tops: dict(pair) -> (bid, ask)
+        self.tops = {}
+        # quotes: dict(asset) -> set of quote currencies
+        self.quotes = {}
+        self.crosses = {}
+        self.normalized = {}
+        self.dislocations = {}
+        self.reference_rates = {}
+        # emitted: dict((kind, key)) -> value of the last emission
+        self.emitted = {}
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def set_reference_rate(self, ccy, rate):
+        # type: (str, float) -> None
+        # rate: value of 1 ccy in base currency, e.g. set_reference_rate('EUR', 1.17) with base USD
+        with self.lock:
+            self.reference_rates[ccy] = rate
+            for cross in self.crosses.keys():
+                if ccy in cross:
+                    self._update_dislocation(cross)
+            self._renormalize(ccy)
+
+    def on_top_of_book(self, pair, bid, ask):
+        # type: (str, float, float) -> None
+        asset, quote = pair.split(':')
+        with self.lock:
+            if self.tops.get(pair) == (bid, ask):
+                return
+            self.tops[pair] = (bid, ask)
+            quotes = self.quotes.setdefault(asset, set())
+            quotes.add(quote)
+            moved = []
+            for other in quotes:
+                if other != quote:
+                    cross = cross_name(quote, other)
+                    if self._update_cross(cross, asset):
+                        moved.append(cross)
+            self._normalize(pair)
+            for cross in moved:
+                self._update_dislocation(cross)
+                if self.base in cross:
+                    ccy = cross[0] if cross[1] == self.base else cross[1]
+                    if ccy not in self.reference_rates:
+                        self._renormalize(ccy)
+
+    def _update_cross(self, cross, asset):
+        # returns True if the consolidated cross moved beyond the threshold
+        ccy1, ccy2 = cross
+        top1 = self.tops.get("{}:{}".format(asset, ccy1))
+        top2 = self.tops.get("{}:{}".format(asset, ccy2))
+        state = self.crosses.setdefault(cross, {'bid': None, 'ask': None, 'mid': None, 'by_asset': {}})
+        if top1 is None or top2 is None or not top1[0] or not top1[1]:
+            return False
+        # 1 ccy1 = (asset price in ccy2) / (asset price in ccy1) ccy2
+        state['by_asset'][asset] = (top2[0] / top1[1], top2[1] / top1[0])
+        quotes = state['by_asset'].values()
+        state['bid'] = max(bid for bid, _ in quotes)
+        state['ask'] = min(ask for _, ask in quotes)
+        state['mid'] = sum(bid + ask for bid, ask in quotes) / (2. * len(quotes))
+        return self._emit('cross', cross, (state['bid'], state['ask']))
+
+    def _update_dislocation(self, cross):
+        state = self.crosses.get(cross)
+        if state is None or state['mid'] is None:
+            return
+        # best bid above best ask across assets, or the reference rate outside of the implied market
+        gap = state['bid'] - state['ask'] if len(state['by_asset']) > 1 else 0.
+        reference = self.reference_rate(cross)
+        if reference is not None:
+            gap = max(gap, state['bid'] - reference, reference - state['ask'])
+        dislocation = max(gap, 0.) / state['mid']
+        self.dislocations[cross] = dislocation
+        if self._emit('dislocation', cross, dislocation, relative=False) and dislocation:
+            self.logger.info("[CrossView] {}/{} dislocation of {:.4%}, implied bid {} ask {}".format(
+                cross[0], cross[1], dislocation, state['bid'], state['ask']))
+
+    def reference_rate(self, cross):
+        # type: ((str, str)) -> float
+        # reference rate of the cross from the reference rates in base currency, None if missing
+        ccy1, ccy2 = cross
+        rate1 = 1. if ccy1 == self.base else self.reference_rates.get(ccy1)
+        rate2 = 1. if ccy2 == self.base else self.reference_rates.get(ccy2)
+        return rate1 / rate2 if rate1 is not None and rate2 else None
+
+    def base_rate(self, ccy):
+        # type: (str) -> float
+        # value of 1 ccy in base currency, None if neither a reference nor an implied rate is available
+        if ccy == self.base:
+            return 1.
+        if ccy in self.reference_rates:
+            return self.reference_rates[ccy]
+        cross = cross_name(ccy, self.base)
+        state = self.crosses.get(cross)
+        if state is None or state['mid'] is None:
+            return None
+        return state['mid'] if cross[0] == ccy else 1. / state['mid']
+
+    def _normalize(self, pair):
+        top = self.tops[pair]
+        rate = self.base_rate(pair.split(':')[1])
+        value = {'bid': top[0] * rate, 'ask': top[1] * rate} if rate is not None else None
+        self.normalized[pair] = value
+        self._emit('normalized', pair, (value['bid'], value['ask']) if value else None)
+
+    def _renormalize(self, ccy):
+        # the base rate of ccy changed: the pairs quoted in ccy
+        for asset, quotes in self.quotes.iteritems():
+            if ccy in quotes:
+                self._normalize("{}:{}".format(asset, ccy))
+
+    def _emit(self, kind, key, value, relative=True):
+        # returns True if the value was emitted
+        last = self.emitted.get((kind, key))
+        if not changed(last, value, self.threshold, relative):
+            return False
+        self.emitted[(kind, key)] = value
+        self.logger.debug("[CrossView] %s %s: %s", kind, key, value)
+        for listener in self.listeners:
+            listener(kind, key, value)
+        return True
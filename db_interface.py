@@ -1,4 +1,7 @@
 from crate import client
+from bulk_writer import BulkWriter
+from market_data_reader import MarketDataReader
+from spill_log import SpillLog
 
 class CrateDbInterface(object):
     """
@@ -9,11 +12,17 @@ class CrateDbInterface(object):
         'market_data_histo': "CREATE TABLE market_data_histo (" \
                                        "timestamp timestamp, " \
                                        "ccy_id string, " \
+                                       "interval_s integer, " \
                                        "bid_qty float, " \
                                        "bid float, " \
                                        "ask float, " \
                                        "ask_qty float, " \
-                                       "primary key (timestamp, ccy_id))",
+                                       "bid_open double, bid_high double, bid_low double, bid_close double, " \
+                                       "ask_open double, ask_high double, ask_low double, ask_close double, " \
+                                       "mid_open double, mid_high double, mid_low double, mid_close double, " \
+                                       "twa_spread double, " \
+                                       "update_count integer, " \
+                                       "primary key (timestamp, ccy_id, interval_s))",
         'raw_market_data_histo': "CREATE TABLE raw_market_data_histo (" \
                              "timestamp timestamp, " \
                              "ccy_id string, " \
@@ -29,18 +38,30 @@ class CrateDbInterface(object):
                             "primary key (timestamp, ccy_id))"
     }
 
-    def __init__(self, db_logger):
-#       type: (Logger) -> object
+    def __init__(self, db_logger, connection=None):
+#       type: (Logger, Connection) -> object
+        # connection: an already opened connection (e.g. local_crate.LocalCrateConnection), defaults to localhost:4200
 
         self.logger = db_logger
-        try:
-            self.connection = client.connect("localhost:4200")
-        except:
-            self.logger.warning("Couldn't connect to DB!")
-        self.cursor = self.connection.cursor()
+        self.connection = connection
+        # cursor stays None while the DB can't be reached, see new_cursor()
+        self.cursor = self.new_cursor()
+        self.bulk_writer = None
+        self.reader = None
 
         #self.queries_stack =
 
+    def new_cursor(self):
+        # type: () -> Cursor
+        # (re)connects if needed, None if the DB can't be reached
+        try:
+            if self.connection is None:
+                self.connection = client.connect("localhost:4200")
+            return self.connection.cursor()
+        except Exception as e:
+            self.logger.warning("Couldn't connect to DB! (%s)", e)
+            return None
+
     def format_query(self, query):
         return """""""{}""""""".format(query)
 
@@ -63,17 +84,53 @@ class CrateDbInterface(object):
     def stack_query(self, query):
         pass
 
+    def start_bulk_writer(self, spill_dir=None, **kwargs):
+        # See BulkWriter for kwargs (max_batch, max_age, max_backlog, retry_interval, replay_batches)
+        # spill_dir: directory of the SpillLog taking the rows the DB can't, rows are dropped without it
+        if self.bulk_writer is None:
+            spill = SpillLog(spill_dir, self.logger) if spill_dir else None
+            self.bulk_writer = BulkWriter(self, self.logger, spill=spill, **kwargs)
+        self.bulk_writer.start()
+        return self.bulk_writer
+
+    def stop_bulk_writer(self):
+        if self.bulk_writer is not None:
+            self.bulk_writer.stop()
+            if self.bulk_writer.spill is not None:
+                self.bulk_writer.spill.close()
+            self.bulk_writer = None
+
+    def market_data_reader(self, **kwargs):
+        # type: () -> MarketDataReader
+        # See MarketDataReader for kwargs (page_size, cache_size, settle_time), the reader is shared
+        if self.reader is None:
+            self.reader = MarketDataReader(self, self.logger, **kwargs)
+        return self.reader
+
+    def write(self, table, data_dict):
+        # type: (str, dict) -> None
+        # Goes through the bulk writer when started, otherwise inserts synchronously
+        if self.bulk_writer is not None:
+            self.bulk_writer.write(table, data_dict)
+        else:
+            self.run_query(self.insert_query(table, data_dict))
+
 
     def run_query(self, query):
-        self.logger.debug("Running command:\n{}\n".format(self.format_query(query)))
+        # type: (str) -> bool
+        self.logger.debug("Running command:\n%s\n", self.format_query(query))
+        if self.cursor is None:
+            self.cursor = self.new_cursor()
         try:
             self.cursor.execute(self.format_query(query))
-        except:
-            self.logger.warning("Query {} failed!".format(query))
+            return True
+        except Exception as e:
+            self.logger.warning("Query %s failed! (%s)", query, e)
+            return False
 
     def insert_query(self, table, data_dict):
         # type: (str, dict) -> str
-        self.logger.debug("Generating INSERT query for table = {} and data = \n{}".format(table, data_dict))
+        self.logger.debug("Generating INSERT query for table = %s and data = \n%s", table, data_dict)
         query = "INSERT INTO {} ".format(table)
         keys = ""
         values = ""
@@ -81,5 +138,31 @@ class CrateDbInterface(object):
             keys += "{}, ".format(str(k).replace("\'", "\'\'"))
             values += "\'{}\', ".format(str(v).replace("\'", "\'\'"))
         query += "({}) VALUES ({})".format(keys[:-2], values[:-2])  #using [:-2] to remove the extra ", " of keys and values strings.
-        self.logger.debug("Returning query: \n{}".format(query))
+        self.logger.debug("Returning query: \n%s", query)
         return query
+
+    def bulk_insert_query(self, table, columns):
+        # type: (str, tuple) -> str
+        return "INSERT INTO {} ({}) VALUES ({})".format(table, ", ".join(columns), ", ".join("?" * len(columns)))
+
+    def run_bulk_query(self, query, rows, cursor=None):
+        # type: (str, list, Cursor) -> bool
+        # rows are sent in one request as bulk_args, cursor defaults to self.cursor (which isn't thread safe)
+        if cursor is None:
+            if self.cursor is None:
+                self.cursor = self.new_cursor()
+            cursor = self.cursor
+        try:
+            cursor.execute(query, bulk_parameters=rows)
+            return True
+        except Exception as e:
+            self.logger.warning("Bulk query %s failed for %s rows: %s", query, len(rows), e)
+            return False
+
+    @staticmethod
+    def bulk_failures(cursor):
+        # type: (Cursor) -> int
+        # rows of the last bulk query of cursor that Crate rejected (rowcount -2 in the per row results, e.g. a
+        # duplicate primary key): the request itself succeeds when only some rows fail
+        results = (getattr(cursor, '_result', None) or {}).get('results', [])
+        return sum(1 for result in results if result.get('rowcount') == -2)
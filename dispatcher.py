@@ -0,0 +1,79 @@
+import Queue
+import threading
+
+
+class ShardedDispatcher(object):
+    """
+    Runs pair messages on per-pair lanes so a burst on one pair doesn't hold back the others.
+    A pair is pinned to one of `workers` worker threads the first time it's seen (round robin), each worker has its own
+    queue, so messages of a pair are handled in order while different pairs are handled concurrently. Many pairs can
+    share a worker, so dozens of pairs don't need dozens of threads.
+    Workers are threads: the handlers share the books and the DB writer of their CexioInterface, which rules out
+    processes. Control messages (no data.pair) stay on the interface's msg_queue and listener.
+    Internal actions of a pair (resync checks, book resets) go through its lane as well, with a None trace so they
+    aren't counted as messages.
+    """
+
+    def __init__(self, cexio_interface, dispatcher_logger, workers=4):
+        # type: (CexioInterface, Logger, int) -> object
+        self.interface = cexio_interface
+        self.logger = dispatcher_logger
+        self.queues = [Queue.Queue() for _ in xrange(workers)]
+        self.threads = []
+        # shard_of_pair: dict(pair) -> index of the worker/queue
+        self.shard_of_pair = {}
+        self.lock = threading.Lock()
+
+    def shard(self, pair):
+        shard = self.shard_of_pair.get(pair)
+        if shard is None:
+            with self.lock:
+                shard = self.shard_of_pair.get(pair)
+                if shard is None:
+                    shard = self.shard_of_pair[pair] = len(self.shard_of_pair) % len(self.queues)
+                    self.logger.info("[Dispatcher] %s assigned to worker %s", pair, shard)
+        return shard
+
+    def put(self, pair, item):
+        # type: (str, (function, dict, list)) -> int
+        # returns the depth of the pair's queue after the put
+        queue = self.queues[self.shard(pair)]
+        queue.put(item)
+        return queue.qsize()
+
+    def start(self):
+        if self.threads:
+            return
+        for i, queue in enumerate(self.queues):
+            thread = threading.Thread(target=self.run_worker, args=(queue,), name="PairWorker-{}".format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.logger.info("[Dispatcher] Started {} pair workers".format(len(self.threads)))
+
+    def stop(self, timeout=5.):
+        # workers stop once done with the messages queued before
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout)
+        self.threads = []
+        self.logger.info("[Dispatcher] Stopped")
+
+    def run_worker(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            action, msg, trace = item
+            if trace is not None:
+                self.interface.instrumentation.mark(trace, 'dequeued')
+            try:
+                self.interface.handle_message(action, msg, trace)
+            except Exception as e:
+                self.logger.warning("[Dispatcher] Exception while handling %s: %s", msg, e)
+
+    def qsizes(self):
+        # type: () -> [int]
+        return [queue.qsize() for queue in self.queues]
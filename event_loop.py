@@ -0,0 +1,174 @@
+import heapq
+import itertools
+import select
+import threading
+import time
+
+import websocket
+
+
+class LoopConnection(object):
+    """
+    One websocket owned by a WebSocketEventLoop, on behalf of a CexioInterface.
+    inline: frames are decoded and handled on the loop thread instead of going through the interface's queues
+    """
+
+    def __init__(self, interface, url, inline):
+        self.interface = interface
+        self.url = url
+        self.inline = inline
+        self.ws = None
+        self.reconnects = 0
+
+    def fileno(self):
+        return self.ws.sock.fileno()
+
+
+class WebSocketEventLoop(object):
+    """
+    Single-threaded transport for CexioInterfaces, as an alternative to the run_forever/listener threads.
+    One select() loop owns the websockets of all the interfaces added to it (market data and trading alike): it opens
+    them, authenticates, answers pings inline and feeds the frames to the interfaces, either inline or through their
+    usual message lanes. Dropped connections are reopened after reconnect_delay, on a loop timer.
+    Readiness is awaited with interface.wait_until_ready() rather than slept on.
+    """
+
+    def __init__(self, loop_logger, reconnect_delay=1., recv_timeout=5.):
+        self.logger = loop_logger
+        self.reconnect_delay = reconnect_delay
+        self.recv_timeout = recv_timeout
+        self.connections = []
+        # timers: heap of (when, seq, function, args)
+        self.timers = []
+        self.timer_seq = itertools.count()
+        self.running = False
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def add(self, interface, url, inline=False):
+        # type: (CexioInterface, str, bool) -> LoopConnection
+        for connection in self.connections:
+            if connection.interface is interface:
+                return connection
+        connection = LoopConnection(interface, url, inline)
+        interface.event_loop = self
+        interface.url = url
+        with self.lock:
+            self.connections.append(connection)
+        self.call_later(0, self.open, connection)
+        return connection
+
+    def call_later(self, delay, function, *args):
+        with self.lock:
+            heapq.heappush(self.timers, (time.time() + delay, next(self.timer_seq), function, args))
+
+    def open(self, connection):
+        interface = connection.interface
+        self.logger.info("[EventLoop] Opening websocket for {}: {}".format(type(interface), connection.url))
+        try:
+            connection.ws = websocket.create_connection(connection.url, timeout=self.recv_timeout)
+        except Exception as e:
+            self.logger.warning("[EventLoop] Couldn't open websocket for %s: %s", type(interface), e)
+            connection.ws = None
+            self.call_later(self.reconnect_delay, self.open, connection)
+            return
+        interface.ws = connection.ws
+        interface.connect()
+
+    def close(self, connection, reason):
+        interface = connection.interface
+        self.logger.warning("[EventLoop] Websocket of %s closed: %s", type(interface), reason)
+        try:
+            connection.ws.close()
+        except Exception:
+            pass
+        connection.ws = None
+        interface.is_connected = False
+        interface.authenticated.clear()
+        connection.reconnects += 1
+        self.call_later(self.reconnect_delay, self.reopen, connection)
+
+    def reopen(self, connection):
+        self.open(connection)
+        if connection.ws is not None:
+            connection.interface.on_reconnect()
+
+    def on_frame(self, connection, frame):
+        interface = connection.interface
+        if not connection.inline:
+            interface.on_message(connection.ws, frame)
+            return
+        if interface.feed_recorder is not None:
+            interface.feed_recorder.record(frame)
+        decoded = interface.decode_frame(frame)
+        if decoded is not None:
+            interface.handle_message(*decoded)
+
+    def read(self, connection):
+        ws = connection.ws
+        while True:
+            try:
+                frame = ws.recv()
+            except Exception as e:
+                self.close(connection, e)
+                return
+            if not frame:
+                self.close(connection, "connection closed by peer")
+                return
+            try:
+                self.on_frame(connection, frame)
+            except Exception as e:
+                self.logger.warning("[EventLoop] Exception while handling %s: %s", frame, e)
+            # ssl can hold decrypted frames that select() won't report
+            pending = getattr(ws.sock, 'pending', None)
+            if pending is None or not pending():
+                return
+
+    def run_timers(self):
+        now = time.time()
+        while True:
+            with self.lock:
+                if not self.timers or self.timers[0][0] > now:
+                    return self.timers[0][0] - now if self.timers else None
+                _, _, function, args = heapq.heappop(self.timers)
+            try:
+                function(*args)
+            except Exception as e:
+                self.logger.warning("[EventLoop] Exception in timer %s: %s", function, e)
+
+    def run_forever(self):
+        self.running = True
+        self.logger.info("[EventLoop] Running")
+        while self.running:
+            next_timer = self.run_timers()
+            open_connections = [c for c in self.connections if c.ws is not None]
+            timeout = 0.5 if next_timer is None else min(next_timer, 0.5)
+            if not open_connections:
+                time.sleep(timeout)
+                continue
+            try:
+                readable, _, _ = select.select(open_connections, [], [], timeout)
+            except (select.error, ValueError) as e:
+                self.logger.warning("[EventLoop] select failed: %s", e)
+                continue
+            for connection in readable:
+                if connection.ws is not None:
+                    self.read(connection)
+        self.logger.info("[EventLoop] Stopped")
+
+    def start(self):
+        # runs the loop on its own (single) thread
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run_forever, name="WebSocketEventLoop")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self, timeout=5.):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+            self.thread = None
+        for connection in self.connections:
+            if connection.ws is not None:
+                connection.ws.close()
+                connection.ws = None
@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the cex.io websocket API, to load and soak test the bot on one box without the real exchange.
+Speaks the subset of the protocol the bot uses over plain RFC 6455 websockets: connected, auth, ping/pong,
+order-book-subscribe/unsubscribe (snapshots then md_update deltas), disconnecting, and the get-balance, place-order,
+cancel-order and open-orders requests. Books are synthetic_feed.SyntheticFeed books, updated at a configurable rate.
+Faults can be injected: dropped update ids, periodic disconnections, stalls, and slow consumers (a client that
+doesn't read fast enough fills its bounded outbox and is disconnected).
+
+    python fake_cexio_server.py --port 8765 --pairs BTC:USD,BTC:EUR,BTC:GBP --rate 2000
+    python fake_cexio_server.py --pairs 100 --rate 20000 --drop-rate 0.001 --soak 300   # runs the bot against it
+
+Point an interface at it with interface.url = server.url (tradebot: ws_url config key).
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import Queue
+
+from synthetic_feed import SyntheticFeed
+
+websocket_guid = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+OP_CONTINUATION, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+
+
+def encode_frame(payload, opcode=OP_TEXT):
+    # type: (str, int) -> str
+    # server frames are never masked
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def recv_exactly(sock, n):
+    data = []
+    while n:
+        chunk = sock.recv(n)
+        if not chunk:
+            raise EOFError("connection closed by peer")
+        data.append(chunk)
+        n -= len(chunk)
+    return ''.join(data)
+
+
+def read_frame(sock):
+    # type: (socket) -> (int, str)
+    # (opcode, payload) of the next complete message, fragments are reassembled
+    message_opcode = None
+    payload = []
+    while True:
+        b1, b2 = struct.unpack('!BB', recv_exactly(sock, 2))
+        fin, opcode = b1 & 0x80, b1 & 0x0F
+        length = b2 & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', recv_exactly(sock, 2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', recv_exactly(sock, 8))[0]
+        mask = recv_exactly(sock, 4) if b2 & 0x80 else None
+        data = recv_exactly(sock, length)
+        if mask:
+            data = ''.join(chr(ord(c) ^ ord(mask[i % 4])) for i, c in enumerate(data))
+        if opcode >= OP_CLOSE:
+            # control frames can come between fragments
+            return opcode, data
+        if message_opcode is None:
+            message_opcode = opcode
+        payload.append(data)
+        if fin:
+            return message_opcode, ''.join(payload)
+
+
+def handshake(sock):
+    # type: (socket) -> str
+    # answers the HTTP upgrade request, returns the requested path
+    request = ''
+    while '\r\n\r\n' not in request:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise EOFError("connection closed during handshake")
+        request += chunk
+    lines = request.split('\r\n')
+    headers = dict((k.strip().lower(), v.strip()) for k, v in (l.split(':', 1) for l in lines[1:] if ':' in l))
+    key = headers.get('sec-websocket-key')
+    if key is None:
+        sock.sendall("HTTP/1.1 400 Bad Request\r\n\r\n")
+        raise ValueError("not a websocket upgrade request")
+    accept = base64.b64encode(hashlib.sha1(key + websocket_guid).digest())
+    sock.sendall("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                 "Sec-WebSocket-Accept: {}\r\n\r\n".format(accept))
+    return lines[0].split(' ')[1] if len(lines[0].split(' ')) > 1 else '/'
+
+
+class FaultConfig(object):
+    """
+    Faults injected by a FakeCexioServer:
+        drop_rate: probability of an md_update not being sent to a subscriber (a gap in its update ids)
+        disconnect_interval: seconds between forced disconnections of every session (disconnecting then close), 0: never
+        stall_interval, stall_duration: every stall_interval seconds, updates stop for stall_duration seconds
+        max_outbox: frames a session can have waiting to be written, a slower client is disconnected as slow consumer
+        response_delay: seconds before answering a request
+    """
+
+    def __init__(self, drop_rate=0., disconnect_interval=0., stall_interval=0., stall_duration=0., max_outbox=100000,
+                 response_delay=0.):
+        self.drop_rate = drop_rate
+        self.disconnect_interval = disconnect_interval
+        self.stall_interval = stall_interval
+        self.stall_duration = stall_duration
+        self.max_outbox = max_outbox
+        self.response_delay = response_delay
+
+
+class FakeSession(object):
+    """
+    One client connection: a reader thread handling its messages, and a writer thread draining its bounded outbox so a
+    slow client never blocks the update generator.
+    """
+
+    def __init__(self, server, sock, address):
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.outbox = Queue.Queue(server.faults.max_outbox)
+        self.authenticated = False
+        self.closed = False
+        self.last_pong = time.time()
+        self.last_ping = 0.
+        # subscriptions: set of pairs
+        self.subscriptions = set()
+
+    def start(self):
+        for target, name in ((self.read_loop, 'reader'), (self.write_loop, 'writer')):
+            thread = threading.Thread(target=target, name="FakeSession-{}-{}".format(self.address[1], name))
+            thread.daemon = True
+            thread.start()
+
+    def send(self, msg):
+        # type: (dict) -> bool
+        return self.send_frame(encode_frame(json.dumps(msg)))
+
+    def send_frame(self, frame):
+        if self.closed:
+            return False
+        try:
+            self.outbox.put_nowait(frame)
+            return True
+        except Queue.Full:
+            self.server.count('slow_consumers')
+            self.server.logger.warning("[FakeCexio] {} is a slow consumer ({} frames waiting), disconnecting".format(
+                self.address, self.outbox.qsize()))
+            self.close()
+            return False
+
+    def write_loop(self):
+        while True:
+            frame = self.outbox.get()
+            if frame is None:
+                break
+            try:
+                self.sock.sendall(frame)
+                self.server.count('frames_sent')
+            except socket.error:
+                break
+        self.close()
+        try:
+            # shutdown first: the reader thread still holds the socket, close() alone wouldn't end the connection
+            self.sock.shutdown(socket.SHUT_RDWR)
+            self.sock.close()
+        except socket.error:
+            pass
+
+    def read_loop(self):
+        try:
+            handshake(self.sock)
+            self.send({'e': 'connected'})
+            while not self.closed:
+                opcode, payload = read_frame(self.sock)
+                if opcode == OP_CLOSE:
+                    break
+                if opcode == OP_PING:
+                    self.send_frame(encode_frame(payload, OP_PONG))
+                elif opcode == OP_TEXT:
+                    self.server.on_message(self, json.loads(payload))
+        except (EOFError, socket.error, ValueError) as e:
+            if not self.closed:
+                self.server.logger.info("[FakeCexio] {} gone: {}".format(self.address, e))
+        self.close()
+
+    def disconnect(self, reason):
+        # as the exchange does: a disconnecting message, then the close
+        self.send({'e': 'disconnecting', 'reason': reason})
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.server.remove_session(self)
+        try:
+            # wakes up the writer, which closes the socket once the outbox is written
+            self.outbox.put_nowait(None)
+        except Queue.Full:
+            self.sock.close()
+
+
+class FakeCexioServer(object):
+    """
+    Websocket server standing in for wss://ws.cex.io/ws/, see the module doc.
+    rate: md_updates per second over all the pairs (round robin), changes: price levels changed per update.
+    credentials: dict(key) -> secret to check the auth signatures, None to accept any.
+    """
+
+    def __init__(self, server_logger, pairs=('BTC:USD', 'BTC:EUR', 'BTC:GBP'), port=0, host='127.0.0.1', rate=100.,
+                 depth=10, changes=2, faults=None, ping_interval=15., pong_timeout=30., credentials=None, seed=0):
+        self.logger = server_logger
+        self.feed = SyntheticFeed(pairs, depth=depth, seed=seed)
+        self.rate = rate
+        self.changes = changes
+        self.faults = faults or FaultConfig()
+        self.ping_interval = ping_interval
+        self.pong_timeout = pong_timeout
+        self.credentials = credentials
+        self.random = random.Random(seed)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(64)
+        self.url = "ws://{}:{}/ws/".format(*self.listener.getsockname())
+        self.sessions = []
+        # subscribers: dict(pair) -> [FakeSession], changed under feed_lock so snapshots and updates stay in order
+        self.subscribers = dict((pair, []) for pair in self.feed.pairs)
+        self.feed_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.running = False
+        self.stats = {'connections': 0, 'frames_sent': 0, 'updates': 0, 'dropped_ids': 0, 'disconnects': 0,
+                      'slow_consumers': 0, 'requests': 0, 'stalls': 0}
+        self.balance = {'BTC': '1.00000000', 'USD': '10000.00', 'EUR': '10000.00', 'GBP': '10000.00'}
+        self.orders = {}
+        self.order_ids = iter(xrange(1, sys.maxint))
+
+    def count(self, stat, n=1):
+        with self.lock:
+            self.stats[stat] += n
+
+    def start(self):
+        self.running = True
+        for target, name in ((self.accept_loop, 'accept'), (self.generate_loop, 'generator'), (self.ping_loop, 'ping')):
+            thread = threading.Thread(target=target, name="FakeCexio-{}".format(name))
+            thread.daemon = True
+            thread.start()
+        self.logger.info("[FakeCexio] Serving {} pairs on {} at {} updates/s".format(len(self.feed.pairs), self.url, self.rate))
+
+    def stop(self):
+        self.running = False
+        self.listener.close()
+        for session in list(self.sessions):
+            session.close()
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                sock, address = self.listener.accept()
+            except socket.error:
+                break
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = FakeSession(self, sock, address)
+            with self.lock:
+                self.sessions.append(session)
+                self.stats['connections'] += 1
+            session.start()
+
+    def remove_session(self, session):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+        with self.feed_lock:
+            for subscribers in self.subscribers.itervalues():
+                if session in subscribers:
+                    subscribers.remove(session)
+
+    def generate_loop(self):
+        # updates round robin over the pairs, paced in batches of 1ms worth of updates
+        pairs = self.feed.pairs
+        i = 0
+        start = time.time()
+        sent = 0
+        next_stall = start + self.faults.stall_interval if self.faults.stall_interval else None
+        next_disconnect = start + self.faults.disconnect_interval if self.faults.disconnect_interval else None
+        while self.running:
+            now = time.time()
+            if next_stall is not None and now >= next_stall:
+                self.count('stalls')
+                self.logger.info("[FakeCexio] Stalling updates for {}s".format(self.faults.stall_duration))
+                time.sleep(self.faults.stall_duration)
+                next_stall = time.time() + self.faults.stall_interval
+                start, sent = time.time(), 0
+            if next_disconnect is not None and now >= next_disconnect:
+                self.disconnect_all("forced disconnection")
+                next_disconnect = now + self.faults.disconnect_interval
+            due = int((time.time() - start) * self.rate) - sent
+            if due <= 0:
+                time.sleep(0.001)
+                continue
+            for _ in xrange(due):
+                self.publish_update(pairs[i % len(pairs)])
+                i += 1
+            sent += due
+
+    def publish_update(self, pair):
+        with self.feed_lock:
+            data = self.feed.update(pair, self.changes)
+            subscribers = list(self.subscribers[pair])
+        self.count('updates')
+        if not subscribers:
+            return
+        frame = encode_frame(json.dumps({'e': 'md_update', 'data': data}))
+        for session in subscribers:
+            if self.faults.drop_rate and self.random.random() < self.faults.drop_rate:
+                self.count('dropped_ids')
+                continue
+            session.send_frame(frame)
+
+    def ping_loop(self):
+        while self.running:
+            time.sleep(min(self.ping_interval, 1.))
+            now = time.time()
+            for session in list(self.sessions):
+                if not session.authenticated:
+                    continue
+                if now - session.last_pong > self.pong_timeout:
+                    self.logger.info("[FakeCexio] No pong from {}, disconnecting".format(session.address))
+                    self.count('disconnects')
+                    session.disconnect("no pong")
+                elif now - session.last_ping >= self.ping_interval:
+                    session.last_ping = now
+                    session.send({'e': 'ping', 'time': int(now * 1000)})
+
+    def disconnect_all(self, reason):
+        for session in list(self.sessions):
+            self.count('disconnects')
+            session.disconnect(reason)
+
+    def check_auth(self, auth):
+        if self.credentials is None:
+            return True
+        secret = self.credentials.get(auth.get('key'))
+        if secret is None:
+            return False
+        nonce = "{}{}".format(auth.get('timestamp'), auth.get('key'))
+        return hmac.new(secret, nonce, hashlib.sha256).hexdigest() == auth.get('signature')
+
+    def on_message(self, session, msg):
+        event = msg.get('e')
+        if event == 'pong':
+            session.last_pong = time.time()
+        elif event == 'auth':
+            ok = self.check_auth(msg.get('auth', {}))
+            session.authenticated = ok
+            session.last_pong = time.time()
+            session.send({'e': 'auth', 'data': {'ok': 'ok'} if ok else {'error': 'Invalid signature'},
+                          'ok': 'ok' if ok else 'error', 'timestamp': int(time.time())})
+        elif not session.authenticated:
+            session.send({'e': event, 'data': {'error': 'Please Login'}, 'oid': msg.get('oid'), 'ok': 'error'})
+        elif event == 'order-book-subscribe':
+            self.subscribe(session, msg)
+        elif event == 'order-book-unsubscribe':
+            pair = ':'.join(msg['data']['pair'])
+            with self.feed_lock:
+                if session in self.subscribers.get(pair, ()):
+                    self.subscribers[pair].remove(session)
+            session.subscriptions.discard(pair)
+            session.send({'e': event, 'data': {'pair': pair}, 'oid': msg.get('oid'), 'ok': 'ok'})
+        elif event in ('get-balance', 'place-order', 'cancel-order', 'open-orders'):
+            self.count('requests')
+            if self.faults.response_delay:
+                timer = threading.Timer(self.faults.response_delay, self.answer_request, (session, msg))
+                timer.daemon = True
+                timer.start()
+            else:
+                self.answer_request(session, msg)
+        else:
+            self.logger.warning("[FakeCexio] Unsupported message: {}".format(msg))
+
+    def subscribe(self, session, msg):
+        pair = ':'.join(msg['data']['pair'])
+        if pair not in self.subscribers:
+            session.send({'e': 'order-book-subscribe', 'data': {'error': 'Unknown pair'}, 'oid': msg.get('oid'),
+                          'ok': 'error'})
+            return
+        # the snapshot is queued before any update following it: the subscriber sees consecutive ids
+        with self.feed_lock:
+            data = self.feed.snapshot(pair, advance=False)
+            data['timestamp'] = int(time.time())
+            session.send({'e': 'order-book-subscribe', 'data': data, 'oid': msg.get('oid'), 'ok': 'ok'})
+            if session not in self.subscribers[pair]:
+                self.subscribers[pair].append(session)
+        session.subscriptions.add(pair)
+
+    def answer_request(self, session, msg):
+        event, data, oid = msg['e'], msg.get('data') or {}, msg.get('oid')
+        if event == 'get-balance':
+            response = {'balance': dict(self.balance), 'obalance': {}, 'time': int(time.time() * 1000)}
+        elif event == 'place-order':
+            order_id = str(next(self.order_ids))
+            response = {'id': order_id, 'time': int(time.time() * 1000), 'complete': False, 'pending': str(data.get('amount')),
+                        'amount': str(data.get('amount')), 'type': data.get('type'), 'price': str(data.get('price'))}
+            with self.lock:
+                self.orders[order_id] = dict(response, pair=data.get('pair'))
+        elif event == 'cancel-order':
+            with self.lock:
+                order = self.orders.pop(str(data.get('order_id')), None)
+            if order is None:
+                session.send({'e': event, 'data': {'error': 'Error: Order not found'}, 'oid': oid, 'ok': 'error'})
+                return
+            response = {'order_id': order['id'], 'fremains': order['amount']}
+        else:
+            with self.lock:
+                response = [dict(order) for order in self.orders.itervalues() if order['pair'] == data.get('pair')]
+        session.send({'e': event, 'data': response, 'oid': oid, 'ok': 'ok'})
+
+
+def soak(server, duration, transport, logger):
+    # runs a CexioMarketDataHandler against the server for duration seconds, returns what both sides saw
+    from cexio_interface import CexioMarketDataHandler
+    from event_loop import WebSocketEventLoop
+
+    class NullDb(object):
+        def write(self, table, data_dict):
+            pass
+
+    handler = CexioMarketDataHandler('soak', 'soak', NullDb(), logger)
+    handler.url = server.url
+    for pair in server.feed.pairs:
+        handler.subscriptions.declare(pair, server.feed.depth)
+    event_loop = None
+    # handler.start() waits for the websocket to open: it is part of the time to ready
+    start = time.time()
+    if transport == 'event_loop':
+        event_loop = WebSocketEventLoop(logger)
+        event_loop.add(handler, server.url)
+        handler.start()
+        event_loop.start()
+    else:
+        handler.start()
+    ready = handler.subscriptions.wait_until_ready(30)
+    ready_time = time.time() - start
+    time.sleep(max(duration - ready_time, 0))
+    if event_loop is not None:
+        event_loop.stop()
+    handler.stop()
+    counts = handler.instrumentation.update_counts
+    return {
+        'ready': ready,
+        'ready_seconds': ready_time,
+        'server': dict(server.stats),
+        'handled': sum(n for pair, n in counts.items() if pair in server.subscribers),
+        'handled_per_sec': sum(n for pair, n in counts.items() if pair in server.subscribers) / float(duration),
+        'queue_depths': dict(handler.instrumentation.queue_depths),
+        'max_queue_depth': handler.instrumentation.max_queue_depth,
+        'valid_books': sum(1 for book in handler.ccy_order_books.values() if book.is_valid()),
+        'books': len(handler.ccy_order_books),
+        'metrics': dict(("{}{}".format(name, dict(labels) if labels else ''), value)
+                        for (name, labels), value in handler.metrics.values.items()),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--pairs', default='BTC:USD,BTC:EUR,BTC:GBP', help="pair list, or a number of synthetic pairs")
+    parser.add_argument('--rate', type=float, default=100., help="md_updates per second over all pairs")
+    parser.add_argument('--depth', type=int, default=10, help="levels per side of the books")
+    parser.add_argument('--changes', type=int, default=2, help="levels changed per md_update")
+    parser.add_argument('--ping-interval', type=float, default=15.)
+    parser.add_argument('--drop-rate', type=float, default=0., help="probability of skipping an update id")
+    parser.add_argument('--disconnect-interval', type=float, default=0., help="seconds between forced disconnections")
+    parser.add_argument('--stall-interval', type=float, default=0., help="seconds between update stalls")
+    parser.add_argument('--stall-duration', type=float, default=1.)
+    parser.add_argument('--max-outbox', type=int, default=100000, help="frames queued per client before it's dropped")
+    parser.add_argument('--response-delay', type=float, default=0., help="seconds before answering requests")
+    parser.add_argument('--soak', type=float, default=0, help="run the bot against the server for that many seconds")
+    parser.add_argument('--transport', choices=('threads', 'event_loop'), default='threads', help="bot transport for --soak")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if args.pairs.isdigit():
+        # 3 letter symbols, as the bot expects: A00:USD, A01:USD...
+        pairs = ['{}{:02d}:USD'.format(chr(ord('A') + i // 100), i % 100) for i in xrange(int(args.pairs))]
+    else:
+        pairs = args.pairs.split(',')
+    faults = FaultConfig(args.drop_rate, args.disconnect_interval, args.stall_interval, args.stall_duration,
+                         args.max_outbox, args.response_delay)
+    server = FakeCexioServer(logging.getLogger('FakeCexio'), pairs, args.port, args.host, args.rate, args.depth,
+                             args.changes, faults, args.ping_interval, seed=args.seed)
+    server.start()
+    if args.soak:
+        bot_logger = logging.getLogger('Cexio')
+        bot_logger.setLevel(logging.WARNING)
+        print json.dumps(soak(server, args.soak, args.transport, bot_logger), indent=2, sort_keys=True)
+        server.stop()
+        # lets the session threads wind down before the interpreter does
+        time.sleep(0.5)
+        return 0
+    try:
+        while True:
+            time.sleep(10)
+            server.logger.info("[FakeCexio] {} sessions, stats: {}".format(len(server.sessions), server.stats))
+    except KeyboardInterrupt:
+        server.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,173 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+# File layout: magic, then one record per frame: receive timestamp (double, seconds since epoch), frame length, frame
+feed_magic = 'CXFEED01'
+record_header = struct.Struct('<dI')
+
+
+class FeedRecorder(object):
+    """
+    Append-only recorder of the raw websocket frames received by a CexioInterface, with their receive timestamps.
+    Frames are flushed to the file every flush_every frames, and at the latest flush_interval seconds after they were
+    recorded (a background thread flushes them when the feed goes quiet): the end of a capture is what an incident
+    replay needs. close() flushes the rest.
+    """
+
+    def __init__(self, path, recorder_logger, flush_every=1000, flush_interval=1.):
+        self.path = path
+        self.logger = recorder_logger
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        is_new = not os.path.isfile(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab')
+        if is_new:
+            self.file.write(feed_magic)
+        self.lock = threading.Lock()
+        self.frames = 0
+        # frames written since the last flush
+        self.unflushed = 0
+        self.last_flush = time.time()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="FeedRecorder")
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info("[FeedRecorder] Recording raw feed to {}".format(path))
+
+    def record(self, frame, timestamp=None):
+        # type: (str, float) -> None
+        if isinstance(frame, unicode):
+            frame = frame.encode('utf-8')
+        now = time.time()
+        with self.lock:
+            if self.closed.is_set():
+                return
+            self.file.write(record_header.pack(timestamp or now, len(frame)))
+            self.file.write(frame)
+            self.frames += 1
+            self.unflushed += 1
+            if self.unflushed >= self.flush_every or now - self.last_flush >= self.flush_interval:
+                self._flush(now)
+
+    def _flush(self, now):
+        self.file.flush()
+        self.unflushed = 0
+        self.last_flush = now
+
+    def run(self):
+        while not self.closed.wait(self.flush_interval):
+            with self.lock:
+                if self.unflushed and not self.closed.is_set():
+                    self._flush(time.time())
+
+    def close(self):
+        with self.lock:
+            if self.closed.is_set():
+                return
+            self.closed.set()
+            self.file.close()
+        self.logger.info("[FeedRecorder] {} frames recorded to {}".format(self.frames, self.path))
+
+
+class FeedReader(object):
+    """
+    Memory-mapped reader of a FeedRecorder file, iterating over (receive timestamp, frame).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(feed_magic)] != feed_magic:
+            raise ValueError("{} is not a recorded feed".format(path))
+
+    def __iter__(self):
+        offset = len(feed_magic)
+        size = len(self.map)
+        while offset + record_header.size <= size:
+            timestamp, length = record_header.unpack_from(self.map, offset)
+            offset += record_header.size
+            if offset + length > size:
+                # last record was being written when the file got copied
+                break
+            yield timestamp, self.map[offset:offset + length]
+            offset += length
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class ReplaySink(object):
+    """
+    Stands in for the websocket while replaying: whatever the handler sends is counted and dropped.
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+
+class FeedReplayer(object):
+    """
+    Pushes recorded frames through a CexioMarketDataHandler, inline and in recorded order.
+    speed: 1 replays in real time, N replays N times faster, None replays as fast as possible.
+    Orderbooks are created on the fly for the pairs found in the recorded snapshots. The handler's clock is the
+    recorded receive time of the frame being replayed, so the rows written are the same whatever the speed and from one
+    replay to the next. Updates of a pair before its first snapshot (recording started mid-stream) are skipped.
+    """
+
+    def __init__(self, reader, md_handler, replay_logger, speed=None):
+        # type: (FeedReader, CexioMarketDataHandler, Logger, float) -> object
+        self.reader = reader
+        self.handler = md_handler
+        self.logger = replay_logger
+        self.speed = speed
+        self.stats = {'frames': 0, 'handled': 0, 'skipped': 0, 'no_book': 0, 'elapsed': 0.}
+
+    def run(self):
+        # type: () -> dict
+        self.handler.ws = ReplaySink()
+        self.handler.is_connected = True
+        replay_time = [None]
+        self.handler.clock = lambda: replay_time[0]
+        first_ts = None
+        start = time.time()
+        try:
+            for timestamp, frame in self.reader:
+                self.stats['frames'] += 1
+                replay_time[0] = timestamp
+                if self.speed:
+                    if first_ts is None:
+                        first_ts = timestamp
+                    wait = (timestamp - first_ts) / self.speed - (time.time() - start)
+                    if wait > 0:
+                        time.sleep(wait)
+                if self.handler.decoder.peek_event(frame) == 'ping':
+                    self.stats['skipped'] += 1
+                    continue
+                decoded = self.handler.decode_frame(frame)
+                if decoded is None:
+                    self.stats['skipped'] += 1
+                    continue
+                action, msg, trace = decoded
+                if msg['e'] == 'order-book-subscribe':
+                    pair = msg['data']['pair']
+                    if pair not in self.handler.ccy_order_books:
+                        self.handler.add_orderbook(pair, len(msg['data']['bids']))
+                elif msg['e'] == 'md_update' and msg['data']['pair'] not in self.handler.ccy_order_books:
+                    self.stats['no_book'] += 1
+                    continue
+                self.handler.handle_message(action, msg, trace)
+                self.stats['handled'] += 1
+        finally:
+            self.handler.clock = time.time
+        self.stats['elapsed'] = time.time() - start
+        self.stats['frames_per_sec'] = self.stats['frames'] / self.stats['elapsed'] if self.stats['elapsed'] else 0.
+        self.logger.info("[FeedReplayer] Replayed {} ({}): {}".format(self.reader.path, self.speed or 'max speed', self.stats))
+        return self.stats
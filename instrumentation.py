@@ -0,0 +1,211 @@
+import ctypes
+import ctypes.util
+import os
+import threading
+import time
+
+try:
+    from time import monotonic
+except ImportError:
+    # python 2: clock_gettime(CLOCK_MONOTONIC) through ctypes, falling back to time.time if librt isn't there
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        _librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        _clock_gettime = _librt.clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        _CLOCK_MONOTONIC = 1
+
+        def monotonic():
+            t = _timespec()
+            if _clock_gettime(_CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return t.tv_sec + t.tv_nsec * 1e-9
+    except (OSError, AttributeError):
+        monotonic = time.time
+
+
+# Pipeline stages, in the order a message goes through them
+stages = ('received', 'decoded', 'enqueued', 'dequeued', 'handled', 'persisted')
+
+
+class LatencyHistogram(object):
+    """
+    HDR-style log-linear histogram of latencies, recorded in microseconds.
+    Values below 2**sub_bucket_bits get one bucket each, above that every power of two is split in 2**sub_bucket_bits
+    buckets, so the relative error stays under 1/2**sub_bucket_bits (~3% by default) across the whole range.
+    """
+
+    def __init__(self, sub_bucket_bits=5, max_value_us=3600 * 1000000):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_bucket_count = 1 << sub_bucket_bits
+        self.max_value_us = max_value_us
+        self.counts = [0] * (self._index(max_value_us) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+        self.lock = threading.Lock()
+
+    def _index(self, value):
+        if value < self.sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits - 1
+        return self.sub_bucket_count * (shift + 1) + (value >> shift) - self.sub_bucket_count
+
+    def _value(self, index):
+        # lowest value of the bucket
+        if index < self.sub_bucket_count:
+            return index
+        shift = index // self.sub_bucket_count - 1
+        return (index % self.sub_bucket_count + self.sub_bucket_count) << shift
+
+    def record(self, seconds):
+        value = min(max(int(seconds * 1000000), 0), self.max_value_us)
+        index = self._index(value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, p):
+        # type: (float) -> int
+        # latency in us under which p% of the recorded values fall
+        with self.lock:
+            if self.count == 0:
+                return 0
+            target = max(1, int(round(self.count * p / 100.)))
+            seen = 0
+            for index, c in enumerate(self.counts):
+                seen += c
+                if seen >= target:
+                    return min(self._value(index), self.max)
+        return self.max
+
+    def reset(self):
+        with self.lock:
+            self.counts = [0] * len(self.counts)
+            self.count = 0
+            self.total = 0
+            self.min = None
+            self.max = 0
+
+    def summary(self):
+        # type: () -> dict
+        return {
+            'count': self.count,
+            'min_us': self.min or 0,
+            'mean_us': self.total / float(self.count) if self.count else 0.,
+            'p50_us': self.percentile(50),
+            'p90_us': self.percentile(90),
+            'p99_us': self.percentile(99),
+            'p999_us': self.percentile(99.9),
+            'max_us': self.max,
+        }
+
+
+class PipelineInstrumentation(object):
+    """
+    Latency and throughput instrumentation of the market data pipeline.
+    A message carries a trace, [(stage, monotonic timestamp)], from the websocket to its handler. Once handled, the time
+    spent between consecutive stages and end to end ('total') goes into a LatencyHistogram per (pair, event, stage).
+    Rows are traced separately from write() to their bulk insert ('persisted', keyed by pair and table).
+        histograms: dict((pair, event, stage)) -> LatencyHistogram
+        update_counts: dict(pair) -> nb of messages handled
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.update_counts = {}
+        # queue_depths: dict(lane) -> depth of the queue at the last enqueue, lanes are 'control' or a pair
+        self.queue_depths = {}
+        self.max_queue_depth = 0
+        self.lock = threading.Lock()
+        self.last_summary_time = monotonic()
+        self.last_summary_counts = {}
+        self.dump_thread = None
+
+    def new_trace(self):
+        return [('received', monotonic())]
+
+    def mark(self, trace, stage):
+        trace.append((stage, monotonic()))
+
+    def histogram(self, pair, event, stage):
+        key = (pair, event, stage)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, LatencyHistogram())
+        return histogram
+
+    def record_queue_depth(self, depth, lane='control'):
+        self.queue_depths[lane] = depth
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+
+    def record_trace(self, pair, event, trace):
+        previous_time = trace[0][1]
+        for stage, t in trace[1:]:
+            self.histogram(pair, event, stage).record(t - previous_time)
+            previous_time = t
+        self.histogram(pair, event, 'total').record(previous_time - trace[0][1])
+        with self.lock:
+            self.update_counts[pair] = self.update_counts.get(pair, 0) + 1
+
+    def record_persisted(self, pair, table, age):
+        self.histogram(pair, table, 'persisted').record(age)
+
+    def update_rates(self, reset=False):
+        # type: (bool) -> dict(pair) -> updates/sec since the start of the rate window
+        # reading doesn't move the window: only its owner resets it (the periodic dump), so other readers such as
+        # /metrics don't steal each other's windows
+        now = monotonic()
+        with self.lock:
+            elapsed = now - self.last_summary_time
+            counts = dict(self.update_counts)
+            rates = dict((pair, (n - self.last_summary_counts.get(pair, 0)) / elapsed if elapsed > 0 else 0.)
+                         for pair, n in counts.iteritems())
+            if reset:
+                self.last_summary_time = now
+                self.last_summary_counts = counts
+        return rates
+
+    def get_summary(self, reset_rates=False):
+        # type: (bool) -> dict
+        return {
+            'latencies': dict(("{}|{}|{}".format(*key), h.summary()) for key, h in self.histograms.items()),
+            'update_counts': dict(self.update_counts),
+            'update_rates': self.update_rates(reset_rates),
+            'queue_depths': dict(self.queue_depths),
+            'max_queue_depth': self.max_queue_depth,
+        }
+
+    def dump_summary(self, logger):
+        # the periodic dump owns the rate window: each line gives the rates since the previous one
+        summary = self.get_summary(reset_rates=True)
+        logger.info("[Instrumentation] queue depths: {} (max {}), updates/sec: {}".format(
+            summary['queue_depths'], summary['max_queue_depth'], summary['update_rates']))
+        for key in sorted(summary['latencies']):
+            s = summary['latencies'][key]
+            logger.info("[Instrumentation] {}: n={} p50={}us p90={}us p99={}us p99.9={}us max={}us".format(
+                key, s['count'], s['p50_us'], s['p90_us'], s['p99_us'], s['p999_us'], s['max_us']))
+
+    def start_periodic_dump(self, logger, interval=60):
+        def run():
+            while True:
+                time.sleep(interval)
+                self.dump_summary(logger)
+        self.dump_thread = threading.Thread(target=run, name="InstrumentationDump")
+        self.dump_thread.daemon = True
+        self.dump_thread.start()
+
+
+# Shared by the cexio interfaces and the DB bulk writer, can be swapped for another instance on either side
+pipeline = PipelineInstrumentation()
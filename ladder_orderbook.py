@@ -0,0 +1,290 @@
+from collections import OrderedDict
+import time
+
+# Price decimals of the CEX.IO ticks, by pair then by quote currency (0.01 for fiat, 1 satoshi for crypto quotes)
+pair_price_decimals = {'BTC:USD': 1, 'BTC:EUR': 1, 'BTC:GBP': 1}
+quote_price_decimals = {'USD': 2, 'EUR': 2, 'GBP': 2, 'RUB': 2, 'BTC': 8, 'ETH': 8}
+qty_decimals = 8
+
+
+class LadderSide(object):
+    """
+    One side of a LadderOrderbook: a preallocated array of lots indexed by key - base, where key is the tick for bids
+    and -tick for asks so that the best level is always the highest key.
+    The ladder keeps headroom slots above the best level for improving prices; levels that fall outside of it are kept
+    in far, and the ladder is moved back on the best level (recentre) when the best level is a far one.
+        lots: [lots], index = key - base (a plain list: exact ints of any size, and the fastest element access in
+              CPython, array('l') is only 32 bits on Windows)
+        best_i: index of the best level in the ladder, -1 when the ladder is empty
+        count: nb of levels in the ladder, walks stop once they have seen them all
+        far: dict(key) -> lots of the levels outside the ladder
+        far_above: nb of far levels better than the whole ladder
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.headroom = size // 4
+        self.zeros = [0] * size
+        self.lots = list(self.zeros)
+        self.base = 0
+        self.best_i = -1
+        self.count = 0
+        self.far = {}
+        self.far_above = 0
+
+    def set(self, key, lots):
+        # raises KeyError when removing a level that doesn't exist
+        i = key - self.base
+        if 0 <= i < self.size:
+            had = self.lots[i]
+            self.lots[i] = lots
+            if lots:
+                if not had:
+                    self.count += 1
+                if i > self.best_i:
+                    self.best_i = i
+            elif not had:
+                raise KeyError(key)
+            else:
+                self.count -= 1
+            if not lots and i == self.best_i:
+                lots_ = self.lots
+                i -= 1
+                while i >= 0 and not lots_[i]:
+                    i -= 1
+                self.best_i = i
+        elif lots:
+            if i >= self.size and key not in self.far:
+                self.far_above += 1
+            self.far[key] = lots
+        else:
+            del self.far[key]
+            if i >= self.size:
+                self.far_above -= 1
+
+    def is_empty(self):
+        return self.best_i < 0 and not self.far
+
+    def best_in_ladder(self):
+        return not self.far_above and (self.best_i >= 0 or not self.far)
+
+    def best_key(self):
+        # None if the side is empty
+        if self.best_i >= 0 and not self.far_above:
+            return self.base + self.best_i
+        if self.far:
+            far = max(self.far)
+            if self.best_i < 0 or far > self.base + self.best_i:
+                return far
+        return self.base + self.best_i if self.best_i >= 0 else None
+
+    def top(self, n=None):
+        # [(key, lots)] best first, all levels if n is None
+        levels = []
+        append = levels.append
+        lots_ = self.lots
+        base = self.base
+        i = self.best_i
+        n_ladder = self.count if n is None else min(n, self.count)
+        while n_ladder:
+            lots = lots_[i]
+            if lots:
+                append((base + i, lots))
+                n_ladder -= 1
+            i -= 1
+        if self.far and (self.far_above or n is None or len(levels) < n):
+            levels = sorted(levels + self.far.items(), reverse=True)[:n]
+        return levels
+
+    def levels(self):
+        # dict(key) -> lots of all levels
+        return dict(self.top())
+
+    def load(self, levels):
+        # levels: dict(key) -> lots, the ladder is placed on the best level
+        best = max(levels) if levels else 0
+        base = self.base = best - (self.size - self.headroom - 1)
+        lots_ = self.lots
+        if self.count:
+            lots_[:] = self.zeros
+        # the best level is in the ladder: the other levels are either in it or below it (far)
+        best_i = -1
+        count = 0
+        far = {}
+        for key, lots in levels.iteritems():
+            if lots:
+                i = key - base
+                if i >= 0:
+                    lots_[i] = lots
+                    count += 1
+                    if i > best_i:
+                        best_i = i
+                else:
+                    far[key] = lots
+        self.best_i = best_i
+        self.count = count
+        self.far = far
+        self.far_above = 0
+
+    def recentre(self):
+        self.load(self.levels())
+
+
+class LadderOrderbook(object):
+    """
+    Orderbook engine on fixed-point price ladders, with the same interface as orderbook.Orderbook.
+    Prices are converted to integer ticks (price_decimals) and quantities to integer lots (satoshis) as updates are
+    applied, so comparisons are exact integer operations and a qty of 0 really means 0.
+    Each side is a LadderSide of ticks_per_level ticks per subscribed level: updates write in place in preallocated
+    arrays, and the best level index is maintained on each update instead of sorting.
+    update_nb is incremented by every build/update, so it identifies the state of the book.
+    A price that isn't on an exact tick would be merged with a neighbouring level: it is rejected (logged, the level is
+    skipped and counted in off_tick), the tick size of the pair (price_decimals) is then too coarse.
+    It is for exact integer pricing, not for speed: in CPython the float to tick conversions cost more than the
+    ladder saves, and benchmark.py --book-engine ladder measures it slower than Orderbook on updates, builds and
+    get_sorted. There are no bids/asks dicts: use top(), best_bid()/best_ask() or bid_prices()/ask_prices().
+    """
+
+    def __init__(self, ccy, depth, logger, price_decimals=None, ticks_per_level=64):
+        if price_decimals is None:
+            price_decimals = pair_price_decimals.get(ccy, quote_price_decimals.get(ccy.split(':')[-1], 4))
+        self.ccy = ccy
+        self.depth = depth
+        self.update_nb = 0
+        self.init_time = time.time()
+        self.logger = logger
+        self.price_scale = 10 ** price_decimals
+        self.qty_scale = 10 ** qty_decimals
+        self.bid_side = LadderSide(max(depth, 1) * ticks_per_level)
+        self.ask_side = LadderSide(max(depth, 1) * ticks_per_level)
+        self.off_tick = 0
+
+    def __str__(self):
+        if self.bid_side.is_empty() or self.ask_side.is_empty():
+            out = "Orderbook for {} is empty!".format(self.ccy)
+        else:
+            try:
+                top = self.top()
+                zipmap = map(None, top['bids'], top['asks'])
+                ll = ["\t{}\t{}\t{}\t{}".format(bid[1], bid[0], ask[0], ask[1])
+                      for bid, ask in [(l[0] or (None, None), l[1] or (None, None)) for l in zipmap]]
+                out = "\n{}".format("\n".join(ll))
+            except Exception as e:
+                out = "Exception: {}".format(e)
+            out += "\nccy: {}\tdepth: {}\tinit_time: {}\t update_nb: {}".format(self.ccy, self.depth, self.init_time, self.update_nb)
+        return out
+
+    def to_tick(self, price):
+        # raises ValueError if price isn't a multiple of the tick size: an on-tick price parses to the double nearest
+        # to tick / price_scale, which is also what the (correctly rounded) division gives
+        price = float(price)
+        tick = int(round(price * self.price_scale))
+        if tick / float(self.price_scale) != price:
+            raise ValueError("price {} is not on a {} tick".format(price, 1. / self.price_scale))
+        return tick
+
+    def _levels(self, levels, sign):
+        # dict(key) -> lots of the on-tick levels
+        keys = {}
+        price_scale = self.price_scale
+        scale = float(price_scale)
+        qty_scale = self.qty_scale
+        for price, qty in levels:
+            # to_tick and to_lots inlined, prices and quantities are positive: int(x + .5) rounds them
+            price = float(price)
+            tick = int(price * price_scale + .5)
+            if tick / scale != price:
+                self._reject_price(price)
+                continue
+            keys[sign * tick] = int(float(qty) * qty_scale + .5)
+        return keys
+
+    def _reject_price(self, price):
+        self.off_tick += 1
+        self.logger.warning("[Orderbook] %s level rejected: price %s is not on a %s tick", self.ccy, price,
+                            1. / self.price_scale)
+
+    def to_lots(self, qty):
+        return int(round(float(qty) * self.qty_scale))
+
+    def build(self, data):
+        self.bid_side.load(self._levels(data['bids'], 1))
+        self.ask_side.load(self._levels(data['asks'], -1))
+        self.update_nb += 1
+
+    def update(self, data):
+        self.logger.debug("[Orderbook] Updating orderbook %s for update message id: %s", self.ccy, data['id'])
+        price_scale = self.price_scale
+        scale = float(price_scale)
+        qty_scale = self.qty_scale
+        # to_tick and to_lots are inlined (see _levels): this is the per level hot path
+        bid_side = self.bid_side
+        for bid, bidq in data['bids']:
+            price = float(bid)
+            tick = int(price * price_scale + .5)
+            if tick / scale != price:
+                self._reject_price(price)
+                continue
+            try:
+                bid_side.set(tick, int(float(bidq) * qty_scale + .5))
+            except KeyError:
+                self.logger.warning("[Orderbook] Trouble while popping bid! (update id: %s)", data['id'])
+        ask_side = self.ask_side
+        for ask, askq in data['asks']:
+            price = float(ask)
+            tick = int(price * price_scale + .5)
+            if tick / scale != price:
+                self._reject_price(price)
+                continue
+            try:
+                ask_side.set(-tick, int(float(askq) * qty_scale + .5))
+            except KeyError:
+                self.logger.warning("[Orderbook] Trouble while popping ask! (update id: %s)", data['id'])
+        for side in (bid_side, ask_side):
+            if side.far and not side.best_in_ladder():
+                self.logger.debug("[Orderbook] Recentring a %s ladder", self.ccy)
+                side.recentre()
+        self.update_nb += 1
+
+    # Orderbook interface, prices and quantities as floats
+
+    def top(self, n=None):
+        # type: (int) -> {'bids': [(price, qty)], 'asks': [(price, qty)]}
+        price_scale = float(self.price_scale)
+        qty_scale = float(self.qty_scale)
+        return {'bids': [(key / price_scale, lots / qty_scale) for key, lots in self.bid_side.top(n)],
+                'asks': [(-key / price_scale, lots / qty_scale) for key, lots in self.ask_side.top(n)]}
+
+    def bid_prices(self, n=None):
+        price_scale = float(self.price_scale)
+        return [key / price_scale for key, _ in self.bid_side.top(n)]
+
+    def ask_prices(self, n=None):
+        price_scale = float(self.price_scale)
+        return [-key / price_scale for key, _ in self.ask_side.top(n)]
+
+    def best_bid(self):
+        # type: () -> (float, float)
+        side = self.bid_side
+        if side.best_i >= 0 and not side.far_above:
+            return (side.base + side.best_i) / float(self.price_scale), side.lots[side.best_i] / float(self.qty_scale)
+        bids = self.top(1)['bids']
+        return bids[0] if bids else (None, None)
+
+    def best_ask(self):
+        # type: () -> (float, float)
+        side = self.ask_side
+        if side.best_i >= 0 and not side.far_above:
+            return -(side.base + side.best_i) / float(self.price_scale), side.lots[side.best_i] / float(self.qty_scale)
+        asks = self.top(1)['asks']
+        return asks[0] if asks else (None, None)
+
+    def get_sorted(self):
+        top = self.top()
+        return {'bids': OrderedDict(top['bids']), 'asks': OrderedDict(top['asks'])}
+
+    def is_valid(self):
+        return False if self.bid_side.is_empty() or self.ask_side.is_empty() or self.is_crossed() else True
+
+    def is_crossed(self):
+        return False if self.bid_side.best_key() < -self.ask_side.best_key() else True
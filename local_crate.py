@@ -0,0 +1,84 @@
+import re
+import threading
+import time
+
+from crate.client.exceptions import ConnectionError, ProgrammingError
+
+insert_regex = re.compile(r'^\s*INSERT\s+INTO\s+(\w+)\s*\(([^)]*)\)', re.IGNORECASE)
+
+
+class LocalCrateConnection(object):
+    """
+    In-process stand-in for a crate.client connection, for benchmarks and for running without a CrateDB server.
+    INSERTs (plain or bulk) are kept in memory per table, anything else is accepted and ignored.
+    latency: seconds added to every request, per_row_latency: seconds added per bulk row (a slow DB)
+    available: when False every request raises ConnectionError (DB down)
+    keep_rows: when False rows are only counted
+    """
+
+    def __init__(self, latency=0., per_row_latency=0., available=True, keep_rows=True):
+        self.latency = latency
+        self.per_row_latency = per_row_latency
+        self.available = available
+        self.keep_rows = keep_rows
+        # tables: dict(table) -> [dict(column -> value)]
+        self.tables = {}
+        self.row_counts = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def cursor(self):
+        return LocalCrateCursor(self)
+
+    def close(self):
+        pass
+
+    def sql(self, sql, parameters=None, bulk_parameters=None):
+        if not self.available:
+            raise ConnectionError("No more Servers available (local stand-in is down)")
+        rows = bulk_parameters if bulk_parameters is not None else [parameters] if parameters is not None else [None]
+        delay = self.latency + self.per_row_latency * len(rows)
+        if delay > 0:
+            time.sleep(delay)
+        match = insert_regex.match(sql)
+        with self.lock:
+            self.requests += 1
+            if match:
+                table = match.group(1)
+                self.row_counts[table] = self.row_counts.get(table, 0) + len(rows)
+                if self.keep_rows and rows[0] is not None:
+                    columns = [c.strip() for c in match.group(2).split(',')]
+                    self.tables.setdefault(table, []).extend(dict(zip(columns, row)) for row in rows)
+        if bulk_parameters is not None:
+            return {'cols': [], 'results': [{'rowcount': 1}] * len(rows), 'duration': delay * 1000}
+        return {'cols': [], 'rows': [], 'rowcount': len(rows) if match else 0, 'duration': delay * 1000}
+
+
+class LocalCrateCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = iter([])
+        self.rowcount = -1
+        # last response, as crate.client's Cursor keeps it (bulk queries: per row results)
+        self._result = None
+        self._closed = False
+
+    def execute(self, sql, parameters=None, bulk_parameters=None):
+        if self._closed:
+            raise ProgrammingError("Cursor closed")
+        result = self._result = self.connection.sql(sql, parameters, bulk_parameters)
+        self.rows = iter(result.get('rows', []))
+        self.rowcount = result.get('rowcount', -1)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.execute(sql, bulk_parameters=seq_of_parameters)
+
+    def fetchone(self):
+        return next(self.rows, None)
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def close(self):
+        self._closed = True
@@ -1,36 +1,226 @@
 import logging
 from logging.handlers import RotatingFileHandler
+import Queue
+import threading
+import time
 
 import sys, os
 from datetime import datetime
 
+# Everything is configurable outside the code, environment variables taking precedence over configure() arguments
+# (tradebot passes the log_* keys of its config file):
+#   TRADEBOT_LOG_DIR      directory of the log files (logs/ next to this file by default)
+#   TRADEBOT_LOG_LEVEL    default level of the loggers (INFO)
+#   TRADEBOT_LOG_LEVELS   per logger levels, e.g. "Cexio:DEBUG,CrateDB:WARNING"
+#   TRADEBOT_LOG_RATE     per logger max records per second of each message class, e.g. "Cexio:50"
+#   TRADEBOT_LOG_SAMPLE   per logger sampling, 1 record out of N of each message class, e.g. "Cexio:100"
+# A message class is the unformatted message of a logging call, i.e. one call site when using lazy %s formatting:
+#   logger.debug("update for %s", ccy) rather than logger.debug("update for {}".format(ccy))
+# Rate limits and sampling only apply below ERROR.
+
+settings = {
+    'log_dir': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs'),
+    'log_level': 'INFO',
+    'log_levels': '',
+    'log_rate': '',
+    'log_sample': '',
+}
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# loggers: dict(name) -> Logger set up by get_logger
+loggers = {}
+
+
+def parse_mapping(value):
+    # "a:1,b:2" -> {'a': '1', 'b': '2'}
+    return dict(item.strip().split(':', 1) for item in value.split(',') if ':' in item)
+
+
+def get_setting(key):
+    return os.environ.get('TRADEBOT_' + key.upper(), settings[key])
+
+
+def configure(**kwargs):
+    # kwargs: keys of settings, applied to the loggers created afterwards and to the existing ones
+    for key, value in kwargs.iteritems():
+        if key in settings and value is not None:
+            settings[key] = value
+    for logger_name in list(loggers):
+        setup_logger(logging.getLogger(logger_name))
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Per message class sampling (1 record out of sample_every) and rate limiting (at most rate records per second,
+    token bucket with a burst of one second). The next record let through after some were suppressed says how many.
+    At most max_classes classes are tracked: past it, the half seen least recently is forgotten (eagerly formatted
+    messages make a new class per call).
+    """
+
+    def __init__(self, rate=None, sample_every=1, max_classes=1000):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.sample_every = sample_every
+        self.max_classes = max_classes
+        # classes: dict(msg) -> [nb seen, tokens, last refill time, nb suppressed since the last record let through,
+        #                        last seen time]
+        self.classes = {}
+        self.suppressed = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        state = self.classes.get(record.msg)
+        if state is None:
+            if len(self.classes) >= self.max_classes:
+                self.prune()
+            state = self.classes[record.msg] = [0, self.rate or 0., time.time(), 0, 0.]
+        state[4] = record.created
+        # counters are updated without a lock: a race between threads can only let an extra record through
+        state[0] += 1
+        keep = state[0] % self.sample_every == 1 or self.sample_every == 1
+        if keep and self.rate:
+            now = time.time()
+            state[1] = min(self.rate, state[1] + (now - state[2]) * self.rate)
+            state[2] = now
+            if state[1] >= 1:
+                state[1] -= 1
+            else:
+                keep = False
+        if not keep:
+            state[3] += 1
+            self.suppressed += 1
+            return False
+        if state[3]:
+            record.msg = "{} [{} similar messages suppressed]".format(record.getMessage(), state[3])
+            record.args = ()
+            state[3] = 0
+        return True
+
+    def prune(self):
+        # forgets the classes seen least recently, their pending suppressed counts are lost
+        by_last_seen = sorted(self.classes.items(), key=lambda item: item[1][4])
+        for msg, _ in by_last_seen[:len(by_last_seen) // 2 + 1]:
+            self.classes.pop(msg, None)
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Hands the records over to the AsyncLogWriter thread: the calling thread only formats the message (lazily, only for
+    enabled levels) and puts the record in a bounded queue, it never waits on disk or stdout.
+    When the queue is full records are dropped and counted rather than blocking the caller.
+    """
+
+    def __init__(self, writer):
+        logging.Handler.__init__(self)
+        self.writer = writer
+
+    def emit(self, record):
+        try:
+            # args can be mutable objects (books, dicts): the message reflects them at the time of the call
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = formatter.formatException(record.exc_info)
+                record.exc_info = None
+            self.writer.queue.put_nowait(record)
+        except Queue.Full:
+            self.writer.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class AsyncLogWriter(object):
+    """
+    Background thread writing the records of all the loggers to their file and to stdout.
+    Records dropped on a full queue are reported on stdout once the queue is drained, and as the
+    log_records_dropped_total metric (metrics.log_collector).
+    """
+
+    def __init__(self, max_queue=100000):
+        self.queue = Queue.Queue(max_queue)
+        self.dropped = 0
+        self.reported_dropped = 0
+        # handlers: dict(logger name) -> [handlers]
+        self.handlers = {}
+        self.stdout_handler = logging.StreamHandler(sys.stdout)
+        self.stdout_handler.setFormatter(formatter)
+        self.thread = threading.Thread(target=self.run, name="AsyncLogWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            self.write(self.queue.get())
+            if self.dropped != self.reported_dropped and self.queue.empty():
+                self.report_dropped()
+
+    def report_dropped(self):
+        dropped = self.dropped
+        record = logging.LogRecord('AsyncLogWriter', logging.WARNING, __file__, 0,
+                                   "%s log records dropped on a full queue (%s in total)",
+                                   (dropped - self.reported_dropped, dropped), None)
+        self.reported_dropped = dropped
+        self.stdout_handler.handle(record)
+
+    def write(self, record):
+        for handler in self.handlers.get(record.name, ()):
+            handler.handle(record)
+        self.stdout_handler.handle(record)
+
+    def flush(self, timeout=5.):
+        # waits until the queue is drained (or timeout)
+        end = time.time() + timeout
+        while not self.queue.empty() and time.time() < end:
+            time.sleep(0.01)
+
+
+async_writer = None
+writer_lock = threading.Lock()
+
+
+def get_writer():
+    global async_writer
+    with writer_lock:
+        if async_writer is None:
+            async_writer = AsyncLogWriter()
+    return async_writer
+
+
+def setup_logger(logger):
+    name = logger.name
+    logger.setLevel(parse_mapping(get_setting('log_levels')).get(name, get_setting('log_level')).upper())
+    for f in list(logger.filters):
+        if isinstance(f, SamplingFilter):
+            logger.removeFilter(f)
+    rate = parse_mapping(get_setting('log_rate')).get(name)
+    sample_every = parse_mapping(get_setting('log_sample')).get(name)
+    if rate or sample_every:
+        logger.addFilter(SamplingFilter(float(rate) if rate else None, int(sample_every or 1)))
+
 
 def get_logger(logger_name):
     logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.DEBUG)
+    if logger_name in loggers:
+        return logger
+    writer = get_writer()
 
-
-#    filepath = "../logs/{}_{}.log".format(logger_name, datetime.now().strftime('%Y%m%d_%H%M'))
-    filepath = "D:/logs/tradebot/{}_{}.log".format(logger_name, datetime.now().strftime('%Y%m%d_%H%M'))
+    log_dir = get_setting('log_dir')
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    filepath = os.path.join(log_dir, "{}_{}.log".format(logger_name, datetime.now().strftime('%Y%m%d_%H%M')))
     if os.path.isfile(filepath):
         print "Logfile for {} already existing, will try to delete it...".format(logger_name)
         os.remove(filepath)
         print "Logfile for {} deleted".format(logger_name)
 
     handler = RotatingFileHandler(filepath, 'a', maxBytes=10000000, backupCount=1000)
-    handler.setLevel(logging.DEBUG)
-
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     handler.setFormatter(formatter)
+    writer.handlers[logger_name] = [handler]
 
-    logger.addHandler(handler)
+    setup_logger(logger)
+    logger.addHandler(AsyncHandler(writer))
+    loggers[logger_name] = logger
 
-    std_out_handler = logging.StreamHandler(sys.stdout)
-    std_out_handler.setLevel(logging.DEBUG)
-    std_out_handler.setFormatter(formatter)
-    logger.addHandler(std_out_handler)
-
-    logger.debug('Logger {} initiated'.format(logger_name))
+    logger.debug('Logger %s initiated', logger_name)
 
     return logger
-
@@ -0,0 +1,117 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# date_trunc units Crate can downsample to, by resolution in seconds
+resolutions = OrderedDict([(1, 'second'), (60, 'minute'), (3600, 'hour'), (86400, 'day'), (604800, 'week')])
+
+tob_columns = ('timestamp', 'bid', 'bid_qty', 'ask', 'ask_qty')
+downsampled_columns = ('timestamp', 'count', 'bid_mean', 'bid_low', 'bid_high', 'ask_mean', 'ask_low', 'ask_high',
+                       'bid_qty_mean', 'ask_qty_mean')
+bar_columns = ('timestamp', 'bid_open', 'bid_high', 'bid_low', 'bid_close', 'ask_open', 'ask_high', 'ask_low',
+               'ask_close', 'mid_open', 'mid_high', 'mid_low', 'mid_close', 'twa_spread', 'update_count')
+
+
+class MarketDataReader(object):
+    """
+    Read side of the market data tables: a pair's history over [start, end) (timestamps in ms) is returned as
+    columns, dict(column) -> np.array, timestamps as int64 ms and everything else as float64.
+    Results are paged with keyset pagination on the timestamp (no OFFSET, each page is an index range scan) so memory
+    on both sides stays bounded by page_size, and each page is converted to arrays in one go.
+    Downsampling is done by Crate (date_trunc + GROUP BY) so only one row per bucket travels.
+    Results of ranges that are over (end older than settle_time seconds) are kept in an LRU cache of cache_size entries,
+    keyed by (table, pair, start, end, resolution). Cached arrays are read-only.
+    """
+
+    def __init__(self, db_interface, reader_logger, page_size=50000, cache_size=32, settle_time=5.):
+        # type: (CrateDbInterface, Logger, int, int, float) -> object
+        self.db = db_interface
+        self.logger = reader_logger
+        self.page_size = page_size
+        self.cache_size = cache_size
+        self.settle_time = settle_time
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.lock = threading.Lock()
+
+    def top_of_book(self, pair, start, end, resolution=None):
+        # type: (str, int, int, int) -> {str: np.array}
+        # raw rows of raw_market_data_histo, or downsampled to resolution seconds (a key of resolutions):
+        # the timestamp is the start of the bucket, count the nb of raw rows in it (open/close need bars())
+        if resolution is None:
+            query = "SELECT timestamp, bid, bid_qty, ask, ask_qty FROM raw_market_data_histo " \
+                    "WHERE ccy_id = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp LIMIT ?"
+            return self._cached(('raw_market_data_histo', pair, start, end, None),
+                                lambda: self._fetch(query, [pair], start, end, tob_columns, 1))
+        if resolution not in resolutions:
+            raise ValueError("Unsupported resolution {}s, use one of {}".format(resolution, resolutions.keys()))
+        query = "SELECT date_trunc('{0}', timestamp) AS bucket, count(*), avg(bid), min(bid), max(bid), " \
+                "avg(ask), min(ask), max(ask), avg(bid_qty), avg(ask_qty) FROM raw_market_data_histo " \
+                "WHERE ccy_id = ? AND timestamp >= ? AND timestamp < ? " \
+                "GROUP BY date_trunc('{0}', timestamp) ORDER BY bucket LIMIT ?".format(resolutions[resolution])
+        return self._cached(('raw_market_data_histo', pair, start, end, resolution),
+                            lambda: self._fetch(query, [pair], start, end, downsampled_columns, resolution * 1000))
+
+    def bars(self, pair, start, end, interval):
+        # type: (str, int, int, int) -> {str: np.array}
+        # bars of interval seconds aggregated into market_data_histo by BarAggregator
+        query = "SELECT timestamp, {} FROM market_data_histo " \
+                "WHERE ccy_id = ? AND interval_s = ? AND timestamp >= ? AND timestamp < ? " \
+                "ORDER BY timestamp LIMIT ?".format(", ".join(bar_columns[1:]))
+        return self._cached(('market_data_histo', pair, start, end, interval),
+                            lambda: self._fetch(query, [pair, interval], start, end, bar_columns, 1))
+
+    def _fetch(self, query, params, start, end, columns, step):
+        # keyset pagination: the next page starts step ms after the last timestamp of the previous one
+        cursor = self.db.new_cursor()
+        if cursor is None:
+            raise IOError("DB unavailable")
+        pages = []
+        nb_rows = 0
+        t0 = time.time()
+        try:
+            while start < end:
+                cursor.execute(query, params + [start, end, self.page_size])
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                pages.append(np.array(rows, dtype=np.float64))
+                nb_rows += len(rows)
+                if len(rows) < self.page_size:
+                    break
+                start = int(rows[-1][0]) + step
+        finally:
+            cursor.close()
+        # transposed copy: one contiguous buffer per column
+        table = (np.concatenate(pages) if pages else np.empty((0, len(columns)))).T.copy()
+        result = dict(zip(columns, table))
+        result['timestamp'] = result['timestamp'].astype(np.int64)
+        self.logger.debug("[MarketDataReader] Read {} rows in {} pages in {:.3f}s".format(
+            nb_rows, len(pages), time.time() - t0))
+        return result
+
+    def _cached(self, key, fetch):
+        with self.lock:
+            result = self.cache.pop(key, None)
+            if result is not None:
+                self.cache[key] = result
+                self.cache_hits += 1
+                return result
+            self.cache_misses += 1
+        result = fetch()
+        for column in result.itervalues():
+            column.flags.writeable = False
+        # ranges still open may get more rows, they aren't cached
+        if key[3] < (time.time() - self.settle_time) * 1000 and self.cache_size > 0:
+            with self.lock:
+                self.cache[key] = result
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return result
+
+    def clear_cache(self):
+        with self.lock:
+            self.cache.clear()
@@ -0,0 +1,222 @@
+import BaseHTTPServer
+import threading
+import time
+
+
+def format_labels(labels):
+    # type: (tuple) -> str
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+
+class MetricsRegistry(object):
+    """
+    In-process metrics, rendered in the Prometheus text format.
+    Hot paths only call inc()/set(), a dict update under a lock. Everything that already exists elsewhere (queue sizes,
+    books, instrumentation, bulk writer stats) is read at scrape time by collectors instead:
+    functions returning [(name, labels dict, value)].
+        metadata: dict(name) -> (type, help)
+        values: dict((name, labels tuple)) -> value
+    """
+
+    def __init__(self):
+        self.metadata = {}
+        self.values = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def describe(self, name, metric_type, help_text):
+        # metric_type: counter, gauge or summary
+        self.metadata[name] = (metric_type, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.values[(name, tuple(sorted(labels.iteritems())))] = value
+
+    def get(self, name, **labels):
+        return self.values.get((name, tuple(sorted(labels.iteritems()))), 0)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def samples(self):
+        # type: () -> [(name, labels tuple, value)]
+        with self.lock:
+            samples = [(name, labels, value) for (name, labels), value in self.values.iteritems()]
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                samples.append((name, tuple(sorted(labels.iteritems())), value))
+        return samples
+
+    def render(self):
+        # type: () -> str
+        by_name = {}
+        for name, labels, value in self.samples():
+            by_name.setdefault(name, []).append((labels, value))
+        lines = []
+        for name in sorted(by_name):
+            # summaries are exported as name{quantile=...}, name_sum and name_count
+            base = name[:-4] if name.endswith('_sum') else name[:-6] if name.endswith('_count') else name
+            metric_type, help_text = self.metadata.get(name, self.metadata.get(base, ('untyped', '')))
+            if name == base or base not in by_name:
+                lines.append("# HELP {} {}".format(name, help_text))
+                lines.append("# TYPE {} {}".format(name, metric_type))
+            for labels, value in sorted(by_name[name]):
+                lines.append("{}{} {}".format(name, format_labels(labels), float(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+registry.describe('cexio_msg_queue_depth', 'gauge', "Messages waiting in the control queue or a pair worker queue")
+registry.describe('cexio_updates_total', 'counter', "Messages handled per pair")
+registry.describe('cexio_book_valid', 'gauge', "1 if the pair's book is non empty and not crossed")
+registry.describe('cexio_book_update_age_seconds', 'gauge', "Seconds since the pair's book last changed")
+registry.describe('cexio_resubscribes_total', 'counter', "Order book resubscriptions per pair")
+registry.describe('cexio_resyncs_total', 'counter', "Book resyncs per pair, by reason (gap or invalid book)")
+registry.describe('cexio_book_stale_seconds_total', 'counter', "Time the pair's book spent stale waiting for a resync")
+registry.describe('cexio_resync_latency_seconds', 'gauge', "Time from the last snapshot request to the book being rebuilt")
+registry.describe('cexio_book_resyncing', 'gauge', "1 while the pair's book is stale, waiting for a snapshot")
+registry.describe('cexio_subscribe_latency_seconds', 'gauge', "Time from the last subscription of the pair to its snapshot")
+registry.describe('cexio_reconnects_total', 'counter', "Websocket reconnections, by reason")
+registry.describe('cexio_ping_delay_seconds', 'gauge', "Receive time of the last ping minus its server time (includes clock offset)")
+registry.describe('cexio_ping_age_seconds', 'gauge', "Seconds since the last ping from the server")
+registry.describe('cexio_latency_seconds', 'summary', "Pipeline stage latencies per pair and event")
+registry.describe('cexio_requests_in_flight', 'gauge', "Requests waiting for their response")
+registry.describe('cexio_requests_total', 'counter', "Requests by type and outcome (ok, error, timeout, cancelled)")
+registry.describe('cexio_request_latency_seconds', 'summary', "Request/response round trip per request type")
+registry.describe('db_flush_latency_seconds', 'gauge', "Bulk insert latency, last, average and max")
+registry.describe('db_backlog_rows', 'gauge', "Rows waiting in the bulk writer per table")
+registry.describe('db_rows_total', 'counter', "Rows through the bulk writer, by outcome")
+registry.describe('db_down', 'gauge', "1 while the bulk writer spills because the DB is unavailable")
+registry.describe('log_records_dropped_total', 'counter', "Log records dropped because the async log queue was full")
+
+
+def summary_samples(name, labels, histogram):
+    # samples of a summary from an instrumentation.LatencyHistogram
+    summary = histogram.summary()
+    samples = [(name, dict(labels, quantile=quantile), summary[key] / 1e6)
+               for quantile, key in (('0.5', 'p50_us'), ('0.9', 'p90_us'), ('0.99', 'p99_us'), ('0.999', 'p999_us'))]
+    samples.append((name + '_count', labels, summary['count']))
+    samples.append((name + '_sum', labels, summary['mean_us'] * summary['count'] / 1e6))
+    return samples
+
+
+def handler_collector(handler, pipeline=None):
+    # collector of a CexioMarketDataHandler: queues, books and the pipeline instrumentation
+    pipeline = pipeline or handler.instrumentation
+
+    def collect():
+        now = time.time()
+        samples = [('cexio_msg_queue_depth', {'lane': 'control'}, handler.msg_queue.qsize())]
+        for i, depth in enumerate(handler.dispatcher.qsizes()):
+            samples.append(('cexio_msg_queue_depth', {'lane': 'worker{}'.format(i)}, depth))
+        for pair, count in pipeline.update_counts.items():
+            samples.append(('cexio_updates_total', {'pair': pair}, count))
+        for pair, order_book in handler.ccy_order_books.items():
+            try:
+                valid = order_book.is_valid()
+            except Exception:
+                valid = False
+            samples.append(('cexio_book_valid', {'pair': pair}, 1 if valid else 0))
+            sync = handler.book_sync.get(pair)
+            samples.append(('cexio_book_resyncing', {'pair': pair}, 1 if sync is not None and sync.resyncing else 0))
+            if pair in handler.last_update_time:
+                samples.append(('cexio_book_update_age_seconds', {'pair': pair}, now - handler.last_update_time[pair]))
+        if handler.last_ping_time is not None:
+            samples.append(('cexio_ping_age_seconds', {}, now - handler.last_ping_time))
+            if handler.ping_delay is not None:
+                samples.append(('cexio_ping_delay_seconds', {}, handler.ping_delay))
+        for (pair, event, stage), histogram in pipeline.histograms.items():
+            labels = {'pair': pair, 'event': event, 'stage': stage}
+            samples.extend(summary_samples('cexio_latency_seconds', labels, histogram))
+        return samples
+    return collect
+
+
+def request_collector(request_manager):
+    # collector of a request_manager.RequestManager
+    def collect():
+        samples = [('cexio_requests_in_flight', {}, len(request_manager.pending))]
+        for (event, outcome), count in request_manager.counts.items():
+            samples.append(('cexio_requests_total', {'event': event, 'outcome': outcome}, count))
+        for event, histogram in request_manager.latencies.items():
+            samples.extend(summary_samples('cexio_request_latency_seconds', {'event': event}, histogram))
+        return samples
+    return collect
+
+
+def db_collector(db_interface):
+    # collector of a CrateDbInterface's bulk writer
+    def collect():
+        writer = db_interface.bulk_writer
+        if writer is None:
+            return []
+        stats = writer.get_stats()
+        samples = [('db_flush_latency_seconds', {'stat': 'last'}, stats['last_flush_latency']),
+                   ('db_flush_latency_seconds', {'stat': 'avg'}, stats['avg_flush_latency']),
+                   ('db_flush_latency_seconds', {'stat': 'max'}, stats['max_flush_latency']),
+                   ('db_down', {}, 1 if stats['db_down'] else 0),
+                   ('db_backlog_rows', {'table': 'spill'}, stats['spill_pending'])]
+        for table, rows in stats['backlog'].iteritems():
+            samples.append(('db_backlog_rows', {'table': table}, rows))
+        for outcome in ('queued', 'written', 'dropped', 'failed', 'spilled', 'replayed'):
+            samples.append(('db_rows_total', {'outcome': outcome}, stats['rows_' + outcome]))
+        return samples
+    return collect
+
+
+def log_collector(log_writer):
+    # collector of a logger.AsyncLogWriter
+    def collect():
+        return [('log_records_dropped_total', {}, log_writer.dropped)]
+    return collect
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        try:
+            body = self.server.registry.render()
+        except Exception as e:
+            self.server.logger.warning("[Metrics] Couldn't render metrics: {}".format(e))
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(object):
+    """
+    Serves a MetricsRegistry on http://host:port/metrics from a background thread, local only by default.
+    """
+
+    def __init__(self, metrics_logger, metrics_registry=None, port=9108, host='127.0.0.1'):
+        self.logger = metrics_logger
+        self.server = BaseHTTPServer.HTTPServer((host, port), MetricsRequestHandler)
+        self.server.registry = metrics_registry or registry
+        self.server.logger = metrics_logger
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="MetricsServer")
+        self.thread.daemon = True
+        self.thread.start()
+        self.logger.info("[Metrics] Serving metrics on http://{}:{}/metrics".format(*self.server.server_address))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,31 @@
+import json
+import re
+
+try:
+    import ujson as fast_json
+except ImportError:
+    fast_json = None
+
+# Matches the event type of a cex.io frame without decoding it, e.g. {"e":"md_update","data":{...}}
+event_regex = re.compile(r'"e"\s*:\s*"([^"]*)"')
+
+
+class MessageDecoder(object):
+    """
+    Decode stage for websocket frames.
+    peek_event() reads the event type straight from the raw frame so pings and unknown events never get fully decoded,
+    decode() uses ujson when it's installed and falls back to the stdlib json module.
+    """
+
+    def __init__(self):
+        self.loads = fast_json.loads if fast_json is not None else json.loads
+        self.backend = 'ujson' if fast_json is not None else 'json'
+
+    def peek_event(self, message):
+        # type: (str) -> str
+        match = event_regex.search(message)
+        return match.group(1) if match else None
+
+    def decode(self, message):
+        # type: (str) -> dict
+        return self.loads(message)
@@ -1,12 +1,25 @@
 from collections import OrderedDict
+from bisect import bisect_left
 import time
 
 
 class Orderbook(object):
+    """
+    Price levels are kept in sorted arrays as updates arrive, so the top of book is always at hand.
+    Both arrays are ascending with the best level at the end (asks are stored negated): updates
+    around the top of book only shift the few elements after the insertion point.
+        bids: dict(price) -> qty
+        asks: dict(price) -> qty
+        _bid_keys: [price, ...]     ascending, best bid is _bid_keys[-1]
+        _ask_keys: [-price, ...]    ascending, best ask is -_ask_keys[-1]
+    update_nb is incremented by every build/update, so it identifies the state of the book.
+    """
 
     def __init__(self, ccy, depth, logger):
         self.bids = dict()
         self.asks = dict()
+        self._bid_keys = []
+        self._ask_keys = []
         self.ccy = ccy
         self.depth = depth
         self.update_nb = 0
@@ -18,61 +31,95 @@ class Orderbook(object):
             out = "Orderbook for {} is empty!".format(self.ccy)
         else:
             try:
-                zipmap = map(None, sorted(self.bids.keys(), reverse=True), sorted(self.asks.keys()))
+                zipmap = map(None, self.bid_prices(), self.ask_prices())
                 ll = ["\t{}\t{}\t{}\t{}".format(self.bids.get(l[0]), l[0], l[1], self.asks.get(l[1])) for l in zipmap]
-                out = "\n{}".format(l for l in ll)
+                out = "\n{}".format("\n".join(ll))
             except Exception as e:
                 out = "Exception: {}".format(e)
             out += "\nccy: {}\tdepth: {}\tinit_time: {}\t update_nb: {}".format(self.ccy, self.depth, self.init_time, self.update_nb)
         return out
 
+    def _set_level(self, levels, keys, key, price, qty):
+        if price not in levels:
+            keys.insert(bisect_left(keys, key), key)
+        levels[price] = qty
+
+    def _pop_level(self, levels, keys, key, price):
+        # raises KeyError if the level doesn't exist, keys are only touched once the dict pop succeeded
+        levels.pop(price)
+        del keys[bisect_left(keys, key)]
 
     def build(self, data):
-        bid_len = len(data['bids'])
-        ask_len = len(data['asks'])
-        for bid, bidq in data['bids']:
-            self.bids[bid] = bidq
-        for ask, askq in data['asks']:
-            self.asks[ask] = askq
+        self.bids = dict(data['bids'])
+        self.asks = dict(data['asks'])
+        self._bid_keys = sorted(self.bids)
+        self._ask_keys = sorted(-ask for ask in self.asks)
+        self.update_nb += 1
+
+    def bid_prices(self, n=None):
+        # best first
+        keys = self._bid_keys if n is None else self._bid_keys[-n:]
+        return keys[::-1]
+
+    def ask_prices(self, n=None):
+        # best first
+        keys = self._ask_keys if n is None else self._ask_keys[-n:]
+        return [-k for k in reversed(keys)]
+
+    def best_bid(self):
+        # type: () -> (float, float)
+        if not self._bid_keys:
+            return None, None
+        bid = self._bid_keys[-1]
+        return bid, self.bids[bid]
+
+    def best_ask(self):
+        # type: () -> (float, float)
+        if not self._ask_keys:
+            return None, None
+        ask = -self._ask_keys[-1]
+        return ask, self.asks[ask]
+
+    def top(self, n=None):
+        # type: (int) -> {'bids': [(price, qty)], 'asks': [(price, qty)]}
+        # all levels if n is None
+        return {'bids': [(bid, self.bids[bid]) for bid in self.bid_prices(n)],
+                'asks': [(ask, self.asks[ask]) for ask in self.ask_prices(n)]}
 
     def get_sorted(self):
-        sorted_bids = OrderedDict([(bid, self.bids[bid]) for bid in sorted(self.bids.keys(), reverse=True)])
-        sorted_asks = OrderedDict([(ask, self.asks[ask]) for ask in sorted(self.asks.keys())])
+        sorted_bids = OrderedDict([(bid, self.bids[bid]) for bid in self.bid_prices()])
+        sorted_asks = OrderedDict([(ask, self.asks[ask]) for ask in self.ask_prices()])
         return {'bids': sorted_bids, 'asks': sorted_asks}
 
     def is_valid(self):
         return False if len(self.bids) == 0 or len(self.asks) == 0 or self.is_crossed() else True
 
     def is_crossed(self):
-        return False if max(self.bids.keys()) < min(self.asks.keys()) else True
+        return False if self._bid_keys[-1] < -self._ask_keys[-1] else True
 
     def update(self,data):
-        self.logger.debug("[Orderbook] Updating orderbook {} for update message id: {}".format(self.ccy, data['id']))
+        self.logger.debug("[Orderbook] Updating orderbook %s for update message id: %s", self.ccy, data['id'])
         # updating bids
         for bid, bidq in data['bids']:
-            if int(bidq) == 0:
-                self.logger.debug("Popping {}@{}".format(bidq, bid))
+            if bidq == 0:
+                self.logger.debug("Popping %s@%s", bidq, bid)
                 try:
-                    self.bids.pop(bid)
+                    self._pop_level(self.bids, self._bid_keys, bid, bid)
                 except:
-                    self.logger.warning("[Orderbook] Trouble while popping bid! (update id: {})".format(data['id']))
+                    self.logger.warning("[Orderbook] Trouble while popping bid! (update id: %s)", data['id'])
             else:
-                self.logger.debug("Adding {}@{}".format(bidq, bid))
-                self.bids[bid] = bidq
+                self.logger.debug("Adding %s@%s", bidq, bid)
+                self._set_level(self.bids, self._bid_keys, bid, bid, bidq)
 
         # updating asks
         for ask, askq in data['asks']:
-            if int(askq) == 0:
-                self.logger.debug("Popping {}@{}".format(askq, ask))
+            if askq == 0:
+                self.logger.debug("Popping %s@%s", askq, ask)
                 try:
-                    self.asks.pop(ask)
+                    self._pop_level(self.asks, self._ask_keys, -ask, ask)
                 except:
-                    self.logger.warning("[Orderbook] Trouble while popping bid! (update id: {})".format(data['id']))
+                    self.logger.warning("[Orderbook] Trouble while popping ask! (update id: %s)", data['id'])
             else:
-                self.logger.debug("Adding {}@{}".format(askq, ask))
-                self.asks[ask] = askq
-
-
-
-
-
+                self.logger.debug("Adding %s@%s", askq, ask)
+                self._set_level(self.asks, self._ask_keys, -ask, ask, askq)
+        self.update_nb += 1
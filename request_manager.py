@@ -0,0 +1,204 @@
+import itertools
+import json
+import threading
+import time
+
+from instrumentation import LatencyHistogram, monotonic
+
+
+class RequestError(Exception):
+    """
+    Raised by ResponseFuture.result() when the exchange answered with an error, or the request timed out or was
+    cancelled (reason).
+    """
+
+    def __init__(self, reason, data=None):
+        Exception.__init__(self, "{}: {}".format(reason, data) if data is not None else reason)
+        self.reason = reason
+        self.data = data
+
+
+class ResponseFuture(object):
+    """
+    Pending response of a request sent by a RequestManager.
+    Completed once, by the response, the timeout sweeper or cancel(); callbacks(future) are then run by the completing
+    thread (the websocket thread for responses), so they must not block.
+    """
+
+    def __init__(self, oid, event, deadline):
+        # type: (str, str, float) -> object
+        self.oid = oid
+        self.event = event
+        self.deadline = deadline
+        self.sent_at = monotonic()
+        self.latency = None
+        self.response = None
+        self.error = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.completed = threading.Event()
+
+    def done(self):
+        return self.completed.is_set()
+
+    def add_callback(self, callback):
+        # callback(future), called right away if the future is already done
+        with self.lock:
+            if not self.completed.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def complete(self, response=None, error=None):
+        # returns False if the future was already done
+        with self.lock:
+            if self.completed.is_set():
+                return False
+            self.latency = monotonic() - self.sent_at
+            self.response = response
+            self.error = error
+            self.completed.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def wait(self, timeout=None):
+        # type: (float) -> bool
+        return self.completed.wait(timeout)
+
+    def result(self, timeout=None):
+        # type: (float) -> dict
+        # data of the response, raises RequestError on error, timeout or cancellation
+        if not self.completed.wait(timeout):
+            raise RequestError('pending')
+        if self.error is not None:
+            raise self.error
+        return self.response.get('data')
+
+
+class RequestManager(object):
+    """
+    Request/response layer of a CexioInterface: each request gets a unique oid and a ResponseFuture, so any number of
+    requests can be in flight on the connection. Responses are matched on their oid by resolve(), before event
+    dispatch; a sweeper thread fails the requests that got no response within their timeout.
+    Round trip latencies are recorded per request type (event).
+        pending: dict(oid) -> ResponseFuture
+        events: request types sent so far, lets decode_frame skip the other frames without decoding them
+        latencies: dict(event) -> LatencyHistogram
+        counts: dict((event, outcome)) -> nb of requests, outcome in ok, error, timeout, cancelled
+    """
+
+    def __init__(self, send, request_logger, timeout=10., sweep_interval=0.1):
+        # type: (function, Logger, float, float) -> object
+        self.send = send
+        self.logger = request_logger
+        self.timeout = timeout
+        self.sweep_interval = sweep_interval
+        self.pending = {}
+        self.events = set()
+        self.latencies = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.oid_counter = itertools.count(1)
+        self.oid_prefix = str(int(time.time()))
+        self.sweeper = None
+        self.stopping = threading.Event()
+
+    def next_oid(self, event):
+        # unique in the process, and from one run to the next
+        return "{}_{}_{}".format(self.oid_prefix, next(self.oid_counter), event)
+
+    def request(self, event, data=None, timeout=None, callback=None):
+        # type: (str, dict, float, function) -> ResponseFuture
+        oid = self.next_oid(event)
+        future = ResponseFuture(oid, event, monotonic() + (timeout or self.timeout))
+        if callback is not None:
+            future.add_callback(callback)
+        with self.lock:
+            self.pending[oid] = future
+            self.events.add(event)
+        self._start_sweeper()
+        self.logger.debug("[Requests] Sending %s (oid %s)", event, oid)
+        try:
+            self.send(json.dumps({'e': event, 'data': data or {}, 'oid': oid}))
+        except Exception as e:
+            self._finish(oid, error=RequestError('send failed', str(e)), outcome='error')
+        return future
+
+    def waits_for(self, event):
+        # type: (str) -> bool
+        return event in self.events
+
+    def resolve(self, msg):
+        # type: (dict) -> bool
+        # completes the future of a response, returns False if msg isn't a response to one of our requests
+        oid = msg.get('oid')
+        if oid is None or oid not in self.pending:
+            if msg.get('e') in self.events and oid is not None and oid.startswith(self.oid_prefix + '_'):
+                self.logger.debug("[Requests] Discarding late response to %s", oid)
+                return True
+            return False
+        if msg.get('ok', 'ok') == 'ok':
+            self._finish(oid, response=msg, outcome='ok')
+        else:
+            data = msg.get('data')
+            self._finish(oid, error=RequestError('error', data.get('error', data) if isinstance(data, dict) else data),
+                         response=msg, outcome='error')
+        return True
+
+    def cancel(self, future):
+        # type: (ResponseFuture) -> bool
+        # stops waiting for the response (the exchange may still act on the request), False if it was already done
+        return self._finish(future.oid, error=RequestError('cancelled'), outcome='cancelled')
+
+    def cancel_all(self, reason='cancelled'):
+        # e.g. on disconnection, the responses will never come
+        for oid in list(self.pending):
+            self._finish(oid, error=RequestError(reason), outcome='cancelled')
+
+    def _finish(self, oid, response=None, error=None, outcome='ok'):
+        with self.lock:
+            future = self.pending.pop(oid, None)
+            if future is None:
+                return False
+            key = (future.event, outcome)
+            self.counts[key] = self.counts.get(key, 0) + 1
+        if not future.complete(response, error):
+            return False
+        if outcome in ('ok', 'error'):
+            histogram = self.latencies.get(future.event)
+            if histogram is None:
+                histogram = self.latencies.setdefault(future.event, LatencyHistogram())
+            histogram.record(future.latency)
+        elif outcome != 'cancelled':
+            self.logger.warning("[Requests] %s (oid %s) failed: %s", future.event, oid, error)
+        return True
+
+    def _start_sweeper(self):
+        if self.sweeper is None:
+            with self.lock:
+                if self.sweeper is None:
+                    self.sweeper = threading.Thread(target=self.sweep, name="RequestSweeper")
+                    self.sweeper.daemon = True
+                    self.sweeper.start()
+
+    def stop(self):
+        # fails the requests in flight and stops the sweeper
+        self.cancel_all('stopped')
+        self.stopping.set()
+        if self.sweeper is not None and self.sweeper is not threading.current_thread():
+            self.sweeper.join()
+        self.sweeper = None
+
+    def sweep(self):
+        while not self.stopping.wait(self.sweep_interval):
+            now = monotonic()
+            expired = [oid for oid, future in self.pending.items() if future.deadline <= now]
+            for oid in expired:
+                self._finish(oid, error=RequestError('timeout'), outcome='timeout')
+
+    def get_summary(self):
+        # type: () -> dict
+        return {'in_flight': len(self.pending), 'counts': dict(self.counts),
+                'latencies': dict((event, h.summary()) for event, h in self.latencies.items())}
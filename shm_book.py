@@ -0,0 +1,186 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+# Region layout: header | pair directory (max_pairs names) | max_pairs slots of slot_dtype(levels).
+# Each slot is guarded by a seqlock: the writer makes seq odd, writes the slot, then makes seq even again.
+# Readers copy the slot and retry if seq was odd or changed during the copy: they never block the writer
+# and never take a lock. The writer and readers rely on the stores being seen in order (x86-64's model).
+header_struct = struct.Struct('<8sIII')
+magic = 'CXSHM001'
+pair_name_size = 16
+
+
+def default_path(name='cexio_books'):
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else '/tmp'
+    return os.path.join(directory, name)
+
+
+def slot_dtype(levels):
+    return np.dtype([('seq', '<u8'), ('update_id', '<i8'), ('timestamp', '<f8'), ('nb_bids', '<u4'),
+                     ('nb_asks', '<u4'), ('bids', '<f8', (levels, 2)), ('asks', '<f8', (levels, 2))])
+
+
+class ShmBookRegion(object):
+    """
+    Memory-mapped shared region holding the top of book of up to max_pairs pairs, levels levels per side.
+    Opened by the publisher (create=True, initializes the file) and by readers in any process.
+    The publisher creates a new file and renames it over the previous one instead of truncating it, so readers still
+    mapping the previous region (of a publisher that restarted) keep reading its last state rather than taking a
+    SIGBUS; they reopen the path to follow the new publisher.
+    """
+
+    def __init__(self, path, levels=10, max_pairs=64, create=False):
+        # type: (str, int, int, bool) -> object
+        self.path = path
+        if create:
+            dtype = slot_dtype(levels)
+            size = header_struct.size + max_pairs * pair_name_size + max_pairs * dtype.itemsize
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(header_struct.pack(magic, levels, max_pairs, dtype.itemsize))
+                f.write('\0' * (size - header_struct.size))
+            os.rename(tmp_path, path)
+        self.file = open(path, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        file_magic, self.levels, self.max_pairs, slot_size = header_struct.unpack_from(self.mm, 0)
+        if file_magic != magic:
+            raise ValueError("{} isn't a shared book region".format(path))
+        self.dtype = slot_dtype(self.levels)
+        self.names = np.frombuffer(self.mm, dtype='S{}'.format(pair_name_size), count=self.max_pairs,
+                                   offset=header_struct.size)
+        self.slots = np.frombuffer(self.mm, dtype=self.dtype, count=self.max_pairs,
+                                   offset=header_struct.size + self.max_pairs * pair_name_size)
+
+    def slot_of(self, pair):
+        # type: (str) -> int
+        # None if the pair isn't published
+        for i, name in enumerate(self.names):
+            if name == pair:
+                return i
+            if not name:
+                return None
+        return None
+
+    def close(self):
+        self.names = self.slots = None
+        self.mm.close()
+        self.file.close()
+
+
+class ShmBookPublisher(object):
+    """
+    Writes the books of CexioMarketDataHandler to a ShmBookRegion: best bid/ask and the top levels, the update id and
+    the time of the update. A pair gets a slot on its first publication; pairs are pinned to one dispatcher worker,
+    so each slot has a single writer.
+    """
+
+    def __init__(self, path, shm_logger, levels=10, max_pairs=64):
+        # type: (str, Logger, int, int) -> object
+        self.logger = shm_logger
+        self.region = ShmBookRegion(path, levels, max_pairs, create=True)
+        self.slot_index = {}
+        self.lock = threading.Lock()
+        self.logger.info("[ShmBook] Publishing {} levels of up to {} pairs to {}".format(levels, max_pairs, path))
+
+    def _slot(self, pair):
+        index = self.slot_index.get(pair)
+        if index is None:
+            with self.lock:
+                index = self.slot_index.get(pair)
+                if index is None:
+                    if len(pair) > pair_name_size:
+                        raise ValueError("Pair name {} is longer than {} bytes".format(pair, pair_name_size))
+                    index = len(self.slot_index)
+                    if index >= self.region.max_pairs:
+                        raise ValueError("No shared memory slot left for {}".format(pair))
+                    self.region.names[index] = pair
+                    self.slot_index[pair] = index
+        return self.region.slots[index:index + 1]
+
+    def publish(self, pair, order_book, update_id, timestamp=None):
+        # type: (str, Orderbook, int, float) -> None
+        slot = self._slot(pair)
+        top = order_book.top(self.region.levels)
+        bids, asks = top['bids'], top['asks']
+        seq = int(slot['seq'][0])
+        slot['seq'] = seq + 1
+        slot['update_id'] = update_id
+        slot['timestamp'] = timestamp or time.time()
+        slot['nb_bids'] = len(bids)
+        slot['nb_asks'] = len(asks)
+        if bids:
+            slot['bids'][0, :len(bids)] = bids
+        if asks:
+            slot['asks'][0, :len(asks)] = asks
+        slot['seq'] = seq + 2
+
+    def close(self):
+        self.region.close()
+
+
+class ShmBookReader(object):
+    """
+    Reads consistent copies of the published books from any process, without locks nor IPC round trips.
+    """
+
+    def __init__(self, path=None):
+        # type: (str) -> object
+        self.region = ShmBookRegion(path or default_path())
+        self.slot_index = {}
+
+    def pairs(self):
+        # type: () -> [str]
+        return [name for name in self.region.names if name]
+
+    def _slot(self, pair):
+        index = self.slot_index.get(pair)
+        if index is None:
+            index = self.region.slot_of(pair)
+            if index is None:
+                return None
+            self.slot_index[pair] = index
+        return self.region.slots[index:index + 1]
+
+    def read_slot(self, pair, max_retries=10000):
+        # type: (str, int) -> np.ndarray
+        # consistent copy of the pair's slot (record of slot_dtype), None if the pair isn't published or the
+        # writer kept it busy for max_retries attempts
+        slot = self._slot(pair)
+        if slot is None:
+            return None
+        for _ in xrange(max_retries):
+            seq = int(slot['seq'][0])
+            if seq & 1:
+                continue
+            copy = slot.copy()
+            if slot['seq'][0] == seq:
+                return copy[0]
+        return None
+
+    def read(self, pair):
+        # type: (str) -> dict
+        # {'seq', 'update_id', 'timestamp', 'bids': [(price, qty)], 'asks': [(price, qty)]}, best levels first
+        slot = self.read_slot(pair)
+        if slot is None or slot['seq'] == 0:
+            return None
+        return {'seq': int(slot['seq']), 'update_id': int(slot['update_id']), 'timestamp': float(slot['timestamp']),
+                'bids': [tuple(level) for level in slot['bids'][:slot['nb_bids']].tolist()],
+                'asks': [tuple(level) for level in slot['asks'][:slot['nb_asks']].tolist()]}
+
+    def best_bid_ask(self, pair):
+        # type: (str) -> (float, float, float, float)
+        # (bid, bid qty, ask, ask qty), None for an empty side
+        slot = self.read_slot(pair)
+        if slot is None or slot['seq'] == 0:
+            return None
+        bid = slot['bids'][0] if slot['nb_bids'] else (None, None)
+        ask = slot['asks'][0] if slot['nb_asks'] else (None, None)
+        return bid[0], bid[1], ask[0], ask[1]
+
+    def close(self):
+        self.region.close()
@@ -0,0 +1,151 @@
+import cPickle
+import os
+import re
+import struct
+import threading
+import zlib
+
+# Segment files are sequences of records: header (payload length, crc32 of the payload) + payload, the pickled
+# (table, columns, rows) of one batch. A torn record at the end of a segment (crash while appending) fails the
+# length or crc check and is ignored.
+record_header = struct.Struct('<Ii')
+segment_regex = re.compile(r'^spill-(\d{8})\.log$')
+
+
+def segment_path(directory, seq):
+    return os.path.join(directory, "spill-{:08d}.log".format(seq))
+
+
+class SpillLog(object):
+    """
+    Local append-only log of the batches the DB couldn't take, replayed in order once it is back.
+    Batches are appended to the current segment, a new segment is started every segment_size bytes and whenever a
+    replay begins, so replays only ever read closed segments. A segment is deleted once fully replayed; the progress
+    inside the segment being replayed is kept in spill.pos, so a restart resumes where the replay stopped
+    (a batch can be sent twice if the process dies between the insert and the position update, never lost).
+    fsync: sync every append to disk, otherwise the OS decides when the data hits the disk
+    """
+
+    def __init__(self, directory, spill_logger, segment_size=64 * 1024 * 1024, fsync=True):
+        # type: (str, Logger, int, bool) -> object
+        self.directory = directory
+        self.logger = spill_logger
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.replay_lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.pos_path = os.path.join(directory, 'spill.pos')
+        segments = self.segments()
+        self.seq = segments[-1] + 1 if segments else 0
+        self.file = None
+        self.size = 0
+        # rows spilled and not replayed yet, recounted from the segments left by a previous run
+        self.pending_rows = 0
+        self.spilled_rows = 0
+        self.replayed_rows = 0
+        for seq in segments:
+            for _, _, _, rows in self.records(seq, self.position(seq)):
+                self.pending_rows += len(rows)
+        if self.pending_rows:
+            self.logger.warning("[SpillLog] {} rows left to replay in {} from a previous run".format(self.pending_rows, directory))
+
+    def segments(self):
+        # type: () -> [int]
+        return sorted(int(m.group(1)) for m in (segment_regex.match(f) for f in os.listdir(self.directory)) if m)
+
+    def position(self, seq):
+        # type: (int) -> int
+        # offset in segment seq where the replay resumes
+        try:
+            with open(self.pos_path) as f:
+                pos_seq, offset = [int(v) for v in f.read().split()]
+        except (IOError, ValueError):
+            return 0
+        return offset if pos_seq == seq else 0
+
+    def set_position(self, seq, offset):
+        tmp_path = self.pos_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write("{} {}".format(seq, offset))
+        os.rename(tmp_path, self.pos_path)
+
+    def append(self, table, columns, rows):
+        # type: (str, tuple, [tuple]) -> None
+        payload = cPickle.dumps((table, columns, rows), cPickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if self.file is None or self.size >= self.segment_size:
+                self._roll()
+            self.file.write(record_header.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.size += record_header.size + len(payload)
+            self.pending_rows += len(rows)
+            self.spilled_rows += len(rows)
+
+    def _roll(self):
+        # called with the lock held
+        if self.file is not None:
+            self.file.close()
+        self.file = open(segment_path(self.directory, self.seq), 'ab')
+        self.size = self.file.tell()
+        self.seq += 1
+
+    def records(self, seq, offset=0):
+        # yields (offset after the record, table, columns, rows) from offset on
+        with open(segment_path(self.directory, seq), 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(record_header.size)
+                if len(header) < record_header.size:
+                    return
+                length, crc = record_header.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    self.logger.warning("[SpillLog] Torn record in segment %s at offset %s, ignored", seq, offset)
+                    return
+                offset += record_header.size + length
+                table, columns, rows = cPickle.loads(payload)
+                yield offset, table, columns, rows
+
+    def pending(self):
+        # type: () -> int
+        with self.lock:
+            return self.pending_rows
+
+    def replay(self, write_batch, max_batches=None):
+        # type: (function, int) -> int
+        # Sends the spilled batches, oldest first, through write_batch(table, columns, rows) -> bool and stops at the
+        # first failure (the DB is still down) or after max_batches. Returns the nb of rows replayed.
+        with self.replay_lock:
+            with self.lock:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                segments = self.segments()
+            replayed = 0
+            batches = 0
+            for seq in segments:
+                for offset, table, columns, rows in self.records(seq, self.position(seq)):
+                    if max_batches is not None and batches >= max_batches:
+                        return replayed
+                    if not write_batch(table, columns, rows):
+                        return replayed
+                    self.set_position(seq, offset)
+                    batches += 1
+                    replayed += len(rows)
+                    with self.lock:
+                        self.pending_rows -= len(rows)
+                        self.replayed_rows += len(rows)
+                os.remove(segment_path(self.directory, seq))
+            if os.path.exists(self.pos_path):
+                os.remove(self.pos_path)
+            return replayed
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
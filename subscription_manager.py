@@ -0,0 +1,83 @@
+from collections import OrderedDict
+import threading
+import time
+
+from request_manager import ResponseFuture
+
+
+def parse_subscriptions(value):
+    # "BTC:USD:3,BTC:EUR:4" -> OrderedDict([('BTC:USD', 3), ('BTC:EUR', 4)])
+    subscriptions = OrderedDict()
+    for item in value.split(','):
+        item = item.strip()
+        if item:
+            symbol1, symbol2, depth = item.split(':')
+            subscriptions["{}:{}".format(symbol1, symbol2)] = int(depth)
+    return subscriptions
+
+
+class SubscriptionManager(object):
+    """
+    Order book subscriptions of a CexioMarketDataHandler.
+    Pairs are declared with their depth; all subscriptions are sent back to back as soon as the connection is
+    authenticated (and again after each reconnection, restoring the same set), without waiting on each other.
+    ready is a ResponseFuture completed once every declared pair got its snapshot, its data is
+    dict(pair) -> seconds from the subscription to the snapshot.
+        subscriptions: OrderedDict(pair) -> depth
+        pending: dict(pair) -> time the subscription was sent, for pairs still waiting for their snapshot
+    """
+
+    def __init__(self, md_handler, subscription_logger):
+        # type: (CexioMarketDataHandler, Logger) -> object
+        self.handler = md_handler
+        self.logger = subscription_logger
+        self.subscriptions = OrderedDict()
+        self.pending = {}
+        self.latencies = {}
+        self.lock = threading.Lock()
+        self.ready = ResponseFuture('subscriptions', 'order-book-subscribe', None)
+        self.sent_at = None
+
+    def declare(self, pair, depth):
+        # type: (str, int) -> None
+        self.subscriptions[pair] = depth
+
+    def declare_all(self, subscriptions):
+        # type: (dict) -> None
+        for pair, depth in subscriptions.iteritems():
+            self.declare(pair, depth)
+
+    def subscribe_all(self):
+        # fresh books for every declared pair, and one subscription each
+        if not self.subscriptions:
+            return
+        now = time.time()
+        with self.lock:
+            if self.ready.done():
+                self.ready = ResponseFuture('subscriptions', 'order-book-subscribe', None)
+            self.pending = dict((pair, now) for pair in self.subscriptions)
+            self.latencies = {}
+            self.sent_at = now
+        self.logger.info("[Subscriptions] Subscribing to {} pairs".format(len(self.subscriptions)))
+        for pair, depth in self.subscriptions.items():
+            self.handler.reset_orderbook(pair, depth)
+            symbol1, symbol2 = pair.split(':')
+            self.handler.send_orderbook_subscribe(symbol1, symbol2, depth)
+
+    def on_snapshot(self, pair):
+        # type: (str) -> None
+        with self.lock:
+            sent = self.pending.pop(pair, None)
+            if sent is None:
+                return
+            latency = self.latencies[pair] = time.time() - sent
+            done = not self.pending
+        self.handler.metrics.set('cexio_subscribe_latency_seconds', latency, pair=pair)
+        if done:
+            self.logger.info("[Subscriptions] All {} books ready in {:.3f}s".format(
+                len(self.latencies), time.time() - self.sent_at))
+            self.ready.complete({'data': dict(self.latencies)})
+
+    def wait_until_ready(self, timeout=None):
+        # type: (float) -> bool
+        return self.ready.wait(timeout)
@@ -0,0 +1,89 @@
+import json
+import random
+
+
+class SyntheticFeed(object):
+    """
+    Generates cex.io-like order book snapshots and md_update deltas for a set of pairs.
+    Each pair keeps a model book (prices in ticks) so updates stay consistent: levels are only removed if they exist,
+    the book never crosses and keeps `depth` levels per side. Update ids are consecutive per pair.
+    """
+
+    def __init__(self, pairs, depth=10, tick=0.1, start_price=6500., seed=0):
+        # type: ([str], int, float, float, int) -> object
+        self.pairs = list(pairs)
+        self.depth = depth
+        self.tick = tick
+        self.random = random.Random(seed)
+        self.books = {}
+        start_tick = int(round(start_price / tick))
+        for pair in self.pairs:
+            self.books[pair] = {
+                'bids': dict((start_tick - 1 - i, self._qty()) for i in xrange(depth)),
+                'asks': dict((start_tick + 1 + i, self._qty()) for i in xrange(depth)),
+                'id': 0,
+            }
+
+    def _qty(self):
+        return round(self.random.uniform(0.001, 5.), 8)
+
+    def _price(self, t):
+        return round(t * self.tick, 8)
+
+    def _levels(self, side, levels):
+        return [[self._price(t), levels[t]] for t in sorted(levels, reverse=(side == 'bids'))]
+
+    def snapshot(self, pair, advance=True):
+        # type: (str, bool) -> dict
+        # advance=False snapshots the current state under the id of the last update, as a server answering a
+        # subscription does: the next update follows it for every subscriber
+        book = self.books[pair]
+        if advance:
+            book['id'] += 1
+        return {'pair': pair, 'id': book['id'], 'timestamp': 0,
+                'bids': self._levels('bids', book['bids']), 'asks': self._levels('asks', book['asks'])}
+
+    def update(self, pair, changes=2):
+        # type: (str, int) -> dict
+        book = self.books[pair]
+        book['id'] += 1
+        data = {'pair': pair, 'id': book['id'], 'time': 0, 'bids': [], 'asks': []}
+        for _ in xrange(changes):
+            side = 'bids' if self.random.random() < 0.5 else 'asks'
+            levels = book[side]
+            other = book['asks' if side == 'bids' else 'bids']
+            r = self.random.random()
+            if r < 0.6 or len(levels) < 2:
+                # size change on an existing level
+                t = self.random.choice(levels.keys())
+                levels[t] = self._qty()
+                data[side].append([self._price(t), levels[t]])
+            else:
+                # a level goes away and a new one appears, inside the spread if there's room, otherwise behind the book
+                t = self.random.choice(levels.keys())
+                del levels[t]
+                data[side].append([self._price(t), 0])
+                best_other = min(other) if side == 'bids' else max(other)
+                if side == 'bids':
+                    candidates = [max(levels) + 1] if max(levels) + 1 < best_other else []
+                    candidates.append(min(levels) - 1)
+                else:
+                    candidates = [min(levels) - 1] if min(levels) - 1 > best_other else []
+                    candidates.append(max(levels) + 1)
+                new_t = self.random.choice(candidates)
+                levels[new_t] = self._qty()
+                data[side].append([self._price(new_t), levels[new_t]])
+        return data
+
+    def snapshot_frame(self, pair):
+        # type: (str) -> str
+        return json.dumps({'e': 'order-book-subscribe', 'data': self.snapshot(pair), 'oid': "{}_orderbook".format(pair), 'ok': 'ok'})
+
+    def update_frame(self, pair, changes=2):
+        # type: (str, int) -> str
+        return json.dumps({'e': 'md_update', 'data': self.update(pair, changes)})
+
+    def update_frames(self, n, changes=2):
+        # n md_update frames, round robin over the pairs
+        for i in xrange(n):
+            yield self.update_frame(self.pairs[i % len(self.pairs)], changes)
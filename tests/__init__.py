@@ -0,0 +1,24 @@
+import logging
+
+from local_crate import LocalCrateConnection
+
+
+def get_quiet_logger(name='tests'):
+    # logger discarding everything below WARNING and not propagating to the root logger
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    logger.setLevel(logging.WARNING)
+    return logger
+
+
+class RejectingConnection(LocalCrateConnection):
+    # Crate's answer to a bulk insert with duplicate keys: the request succeeds, the duplicate rows have rowcount -2
+    # here the rows with an odd first column
+
+    def sql(self, sql, parameters=None, bulk_parameters=None):
+        result = LocalCrateConnection.sql(self, sql, parameters, bulk_parameters)
+        if bulk_parameters is not None:
+            result['results'] = [{'rowcount': -2 if row[0] % 2 else 1} for row in bulk_parameters]
+        return result
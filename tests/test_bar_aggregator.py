@@ -0,0 +1,52 @@
+import unittest
+
+from bar_aggregator import BarAggregator
+from tests import get_quiet_logger
+
+
+class RowSink(object):
+
+    def __init__(self):
+        self.rows = []
+
+    def write(self, table, row):
+        self.rows.append(row)
+
+
+def row(timestamp, bid=100.):
+    return {'timestamp': timestamp, 'ccy_id': 'BTC:USD', 'bid': bid, 'bid_qty': 1., 'ask': bid + 1., 'ask_qty': 1.}
+
+
+class BarAggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = RowSink()
+        self.now = [0.]
+        self.bars = BarAggregator(self.sink, get_quiet_logger('tests.bar_aggregator'), intervals=(1,),
+                                  clock=lambda: self.now[0], grace=0.5)
+
+    def test_expiry_follows_the_clock(self):
+        self.bars.on_top_of_book('BTC:USD', row(1000000))
+        # the wall clock is far ahead of the rows' clock: nothing is due yet
+        self.now[0] = 1000.9
+        self.bars.close_expired()
+        self.assertEqual(self.sink.rows, [])
+        self.now[0] = 1001.5
+        self.bars.close_expired()
+        self.assertEqual([r['timestamp'] for r in self.sink.rows], [1000000])
+
+    def test_late_rows_are_dropped(self):
+        self.bars.on_top_of_book('BTC:USD', row(1000000))
+        self.bars.on_top_of_book('BTC:USD', row(1000999))
+        self.now[0] = 1001.5
+        self.bars.close_expired()
+        self.bars.on_top_of_book('BTC:USD', row(1000998, 99.))
+        self.bars.on_top_of_book('BTC:USD', row(1001000))
+        self.bars.on_top_of_book('BTC:USD', row(1000500, 98.))
+        self.bars.close_expired(now_ms=1002000)
+        self.assertEqual([(r['timestamp'], r['update_count']) for r in self.sink.rows], [(1000000, 2), (1001000, 1)])
+        self.assertEqual(self.bars.late_rows, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
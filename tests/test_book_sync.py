@@ -0,0 +1,86 @@
+import unittest
+
+from book_sync import BookSync
+
+
+def delta(update_id):
+    return {'id': update_id, 'bids': [], 'asks': []}
+
+
+class BookSyncTest(unittest.TestCase):
+
+    def new_sync(self, **kwargs):
+        # synced on a snapshot of id 10
+        sync = BookSync('BTC:USD', min_interval=1., timeout=5., **kwargs)
+        sync.finish(10, now=100.)
+        return sync
+
+    def test_new_sync_waits_for_its_snapshot(self):
+        sync = BookSync('BTC:USD')
+        self.assertTrue(sync.resyncing)
+        self.assertEqual(sync.reason, 'subscribe')
+        self.assertTrue(sync.request_sent)
+
+    def test_consecutive_ids_apply(self):
+        sync = self.new_sync()
+        self.assertEqual(sync.check(11), 'apply')
+        sync.last_id = 11
+        self.assertEqual(sync.check(12), 'apply')
+
+    def test_gap(self):
+        sync = self.new_sync()
+        self.assertEqual(sync.check(12), 'gap')
+        self.assertEqual(sync.check(50), 'gap')
+
+    def test_duplicates(self):
+        sync = self.new_sync()
+        self.assertEqual(sync.check(10), 'duplicate')
+        self.assertEqual(sync.check(3), 'duplicate')
+
+    def test_buffered_deltas_newer_than_the_snapshot_are_replayed(self):
+        sync = self.new_sync()
+        sync.start('gap', now=200.)
+        for update_id in xrange(12, 20):
+            sync.buffer.append(delta(update_id))
+        replay, stale_time = sync.finish(15, now=202.5)
+        self.assertEqual([data['id'] for data in replay], [16, 17, 18, 19])
+        self.assertEqual(stale_time, 2.5)
+        self.assertEqual(sync.last_id, 15)
+        self.assertFalse(sync.resyncing)
+        self.assertEqual(len(sync.buffer), 0)
+
+    def test_buffer_overflow_keeps_the_latest_deltas(self):
+        sync = self.new_sync(max_buffer=5)
+        sync.start('gap', now=200.)
+        for update_id in xrange(12, 30):
+            sync.buffer.append(delta(update_id))
+        self.assertEqual([data['id'] for data in sync.buffer], range(25, 30))
+        # a snapshot older than the buffer: the deltas in between are lost, the ones buffered are still replayed
+        replay, _ = sync.finish(20, now=201.)
+        self.assertEqual([data['id'] for data in replay], range(25, 30))
+
+    def test_request_rate_limit(self):
+        sync = self.new_sync()
+        self.assertFalse(sync.request_due(now=150.))
+        sync.start('gap', now=200.)
+        self.assertTrue(sync.request_due(now=200.))
+        sync.requested(now=200.)
+        # sent: not again before timeout
+        self.assertFalse(sync.request_due(now=201.))
+        self.assertFalse(sync.request_due(now=204.9))
+        self.assertTrue(sync.request_due(now=205.))
+
+    def test_finish_resets_the_request(self):
+        sync = self.new_sync()
+        sync.start('gap', now=200.)
+        sync.requested(now=200.)
+        sync.finish(30, now=201.)
+        self.assertIsNone(sync.requested_at)
+        self.assertFalse(sync.request_sent)
+        # the next resync may request right away
+        sync.start('invalid', now=201.5)
+        self.assertTrue(sync.request_due(now=201.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
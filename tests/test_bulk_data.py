@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from bulk_data import BulkExporter, BulkImporter, Progress, day_ms
+from db_interface import CrateDbInterface
+from tests import RejectingConnection, get_quiet_logger
+
+
+class DayCursor(object):
+    # answers the export queries of one day with rows
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.result = []
+
+    def execute(self, query, parameters=None):
+        pair, start, end, limit = parameters
+        self.result = [row for row in self.rows if start <= row[0] < end][:limit]
+
+    def fetchall(self):
+        return self.result
+
+
+class BulkDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = get_quiet_logger('tests.bulk_data')
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+    def test_only_complete_days_are_marked_done(self):
+        day = 1500000000000 // day_ms * day_ms
+        rows = [(day + i * 1000, 'BTC:USD', 100., 1., 101., 1.) for i in xrange(10)]
+        exporter = BulkExporter(None, self.logger, self.directory)
+        progress = Progress(self.logger)
+        done = os.path.join(self.directory, 'raw_market_data_histo', 'BTC_USD', '2017-07-14', '_done')
+        exporter.export_day(DayCursor(rows), 'raw_market_data_histo', 'BTC:USD', day, progress, complete=False)
+        self.assertFalse(os.path.exists(done))
+        exporter.export_day(DayCursor(rows), 'raw_market_data_histo', 'BTC:USD', day, progress)
+        self.assertTrue(os.path.exists(done))
+        self.assertEqual(progress.rows, 20)
+
+    def test_rejected_rows_are_counted(self):
+        db = CrateDbInterface(self.logger, RejectingConnection())
+        importer = BulkImporter(db, self.logger, workers=2, batch_size=4)
+        rows = [(1500000000000 + i, 'BTC:USD', 100., 1., 101., 1.) for i in xrange(10)]
+        columns = ('timestamp', 'ccy_id', 'bid', 'bid_qty', 'ask', 'ask_qty')
+        summary = importer.run([('chunk', lambda: ('raw_market_data_histo', columns, rows))])
+        self.assertEqual(summary['rows'], 5)
+        self.assertEqual(summary['failed_rows'], 5)
+        self.assertEqual(summary['failed_chunks'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from bulk_writer import BulkWriter
+from db_interface import CrateDbInterface
+from local_crate import LocalCrateConnection
+from spill_log import SpillLog
+from tests import RejectingConnection, get_quiet_logger
+
+
+def row(i):
+    return {'timestamp': 1500000000000 + i, 'ccy_id': 'BTC:USD', 'bid': 100. + i, 'bid_qty': 1., 'ask': 101. + i,
+            'ask_qty': 2.}
+
+
+class RejectedRowsTest(unittest.TestCase):
+
+    def test_rejected_rows_are_failed_not_written(self):
+        logger = get_quiet_logger('tests.bulk_writer')
+        writer = BulkWriter(CrateDbInterface(logger, RejectingConnection()), logger, max_batch=10)
+        for i in xrange(10):
+            writer.write('raw_market_data_histo', row(i))
+        writer.flush()
+        stats = writer.get_stats()
+        self.assertEqual(stats['rows_written'], 5)
+        self.assertEqual(stats['rows_failed'], 5)
+        self.assertEqual(stats['batches_failed'], 0)
+
+
+class SpillReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = get_quiet_logger('tests.bulk_writer')
+        self.directory = tempfile.mkdtemp()
+        self.connection = LocalCrateConnection(available=False)
+        self.db = CrateDbInterface(self.logger, self.connection)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+    def new_writer(self):
+        spill = SpillLog(self.directory, self.logger, fsync=False)
+        return BulkWriter(self.db, self.logger, max_batch=10, spill=spill)
+
+    def written_timestamps(self):
+        return [r['timestamp'] - 1500000000000 for r in self.connection.tables.get('raw_market_data_histo', [])]
+
+    def test_spill_then_replay(self):
+        writer = self.new_writer()
+        for i in xrange(35):
+            writer.write('raw_market_data_histo', row(i))
+        writer.flush()
+        self.assertTrue(writer.db_down)
+        self.assertEqual(writer.spill.pending(), 35)
+        self.assertEqual(self.written_timestamps(), [])
+
+        self.connection.available = True
+        self.assertEqual(writer.replay(max_batches=0), 35)
+        self.assertFalse(writer.db_down)
+        self.assertEqual(writer.spill.pending(), 0)
+        self.assertEqual(writer.spill.segments(), [])
+        self.assertEqual(self.written_timestamps(), range(35))
+
+    def test_spilled_rows_go_before_live_rows(self):
+        writer = self.new_writer()
+        for i in xrange(25):
+            writer.write('raw_market_data_histo', row(i))
+        writer.flush()
+        # the DB is back but the writer hasn't noticed yet: the next flush replays the spill log first
+        self.connection.available = True
+        writer.db_down = False
+        for i in xrange(25, 40):
+            writer.write('raw_market_data_histo', row(i))
+        writer.flush()
+        self.assertEqual(writer.spill.pending(), 0)
+        self.assertEqual(self.written_timestamps(), range(40))
+
+    def test_replay_resumes_after_restart(self):
+        writer = self.new_writer()
+        for i in xrange(20):
+            writer.write('raw_market_data_histo', row(i))
+        writer.flush()
+        writer.spill.close()
+
+        self.connection.available = True
+        writer = self.new_writer()
+        self.assertEqual(writer.spill.pending(), 20)
+        writer.flush()
+        self.assertEqual(self.written_timestamps(), range(20))
+        self.assertFalse(os.path.exists(writer.spill.pos_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+
+from ladder_orderbook import LadderOrderbook
+from orderbook import Orderbook
+from synthetic_feed import SyntheticFeed
+from tests import get_quiet_logger
+
+
+class LadderOrderbookTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = get_quiet_logger('tests.ladder_orderbook')
+
+    def test_same_books_as_orderbook(self):
+        # differential check against Orderbook on synthetic feeds, after every update
+        depth = 10
+        for seed in xrange(20):
+            feed = SyntheticFeed(['BTC:USD'], depth=depth, seed=seed)
+            reference = Orderbook('BTC:USD', depth, self.logger)
+            ladder = LadderOrderbook('BTC:USD', depth, self.logger)
+            snapshot = feed.snapshot('BTC:USD')
+            reference.build(snapshot)
+            ladder.build(snapshot)
+            for _ in xrange(500):
+                data = feed.update('BTC:USD', changes=3)
+                reference.update(data)
+                ladder.update(data)
+                self.assertEqual(ladder.top(depth), reference.top(depth), "seed {}, update {}".format(seed, data['id']))
+                self.assertEqual(ladder.best_bid(), reference.best_bid())
+                self.assertEqual(ladder.best_ask(), reference.best_ask())
+                self.assertEqual(ladder.is_valid(), reference.is_valid())
+            self.assertEqual(ladder.off_tick, 0)
+
+    def test_off_tick_prices_are_rejected(self):
+        ladder = LadderOrderbook('BTC:USD', 5, self.logger)
+        ladder.build({'bids': [[6500.1, 1.], [6500.15, 2.]], 'asks': [[6500.3, 1.]]})
+        self.assertEqual(ladder.top(5), {'bids': [(6500.1, 1.)], 'asks': [(6500.3, 1.)]})
+        ladder.update({'id': 2, 'bids': [[6500.12, 1.]], 'asks': [[6500.2, 3.]]})
+        self.assertEqual(ladder.top(5), {'bids': [(6500.1, 1.)], 'asks': [(6500.2, 3.), (6500.3, 1.)]})
+        self.assertEqual(ladder.off_tick, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
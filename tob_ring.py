@@ -0,0 +1,122 @@
+import math
+import time
+
+import numpy as np
+
+columns = ('timestamp', 'bid', 'bid_qty', 'ask', 'ask_qty', 'cum_var')
+TIMESTAMP, BID, BID_QTY, ASK, ASK_QTY, CUM_VAR = range(len(columns))
+
+
+class TopOfBookRing(object):
+    """
+    Preallocated circular buffer of the last top of book rows of a pair, one float64 row per column.
+    Each row is written twice, at i and i + capacity, so the last capacity rows are always one contiguous slice:
+    windows are numpy views, never copies, whatever the write position.
+    Statistics are maintained as rows are appended: the EWMA of the mid (time based, ewma_halflife seconds) and the
+    cumulated squared log returns of the mid (cum_var column), so the realized volatility of any window is the
+    difference of two cum_var values.
+    A single thread appends (the pair's dispatcher worker). Once the ring has wrapped, an append overwrites the oldest
+    row, which is in the readers' window: the statistics below check count after reading and compute again if rows of
+    their window were overwritten meanwhile (seqlock style), and windows are at most capacity - 1 rows so the row being
+    written is never one of them. window() returns a view for callers on the appending thread; other threads use
+    copy_window().
+    """
+
+    def __init__(self, capacity=4096, ewma_halflife=10.):
+        # type: (int, float) -> object
+        self.capacity = capacity
+        self.data = np.zeros((len(columns), 2 * capacity), dtype=np.float64)
+        self.ewma_halflife = ewma_halflife
+        self.count = 0
+        self.mid_ewma = None
+        self.last_mid = None
+        self.last_timestamp = None
+        self.cum_var = 0.
+
+    def __len__(self):
+        return min(self.count, self.capacity - 1)
+
+    def append(self, timestamp, bid, bid_qty, ask, ask_qty):
+        mid = (bid + ask) / 2.
+        if self.last_mid is None:
+            self.mid_ewma = mid
+        else:
+            if mid > 0 and self.last_mid > 0:
+                self.cum_var += math.log(mid / self.last_mid) ** 2
+            alpha = 1. - 0.5 ** (max(timestamp - self.last_timestamp, 0.) / self.ewma_halflife)
+            self.mid_ewma += alpha * (mid - self.mid_ewma)
+        self.last_mid = mid
+        self.last_timestamp = timestamp
+        i = self.count % self.capacity
+        row = (timestamp, bid, bid_qty, ask, ask_qty, self.cum_var)
+        self.data[:, i] = row
+        self.data[:, i + self.capacity] = row
+        # published last: readers only look at the rows below count
+        self.count += 1
+
+    def window(self, seconds=None, n=None, now=None, count=None):
+        # type: (float, int, float, int) -> np.ndarray
+        # view (columns, rows) of the last n rows, or of the rows of the last seconds, oldest first, as of count rows
+        if count is None:
+            count = self.count
+        size = min(count, self.capacity - 1)
+        end = count % self.capacity + self.capacity if count >= self.capacity else count
+        rows = self.data[:, end - size:end]
+        if n is not None:
+            rows = rows[:, max(size - n, 0):]
+        if seconds is not None:
+            start = (now or time.time()) - seconds
+            rows = rows[:, np.searchsorted(rows[TIMESTAMP], start):]
+        return rows
+
+    def read(self, f, seconds=None, n=None, now=None, retries=100):
+        # f(window view) computed on rows that weren't overwritten while f ran: the rows of the window stay intact as
+        # long as fewer than capacity - size rows are appended meanwhile
+        for _ in xrange(retries):
+            count = self.count
+            rows = self.window(seconds, n, now, count)
+            result = f(rows)
+            if self.count - count < self.capacity - rows.shape[1]:
+                return result
+        raise RuntimeError("Top of book ring overwritten during {} reads".format(retries))
+
+    def copy_window(self, seconds=None, n=None, now=None):
+        # type: (float, int, float) -> np.ndarray
+        # consistent copy of window(), for readers in other threads than the appending one
+        return self.read(np.copy, seconds, n, now)
+
+    def last(self):
+        # type: () -> dict
+        if not self.count:
+            return None
+        return self.read(lambda rows: dict(zip(columns[:CUM_VAR], rows[:CUM_VAR, 0].tolist())), n=1)
+
+    def spread_percentiles(self, q=(50, 90, 99), seconds=None, n=None, now=None):
+        # type: (tuple, float, int, float) -> [float]
+        def compute(rows):
+            if not rows.shape[1]:
+                return [None] * len(q)
+            return np.percentile(rows[ASK] - rows[BID], q).tolist()
+        return self.read(compute, seconds, n, now)
+
+    def realized_volatility(self, seconds=None, n=None, now=None):
+        # type: (float, int, float) -> float
+        # sqrt of the sum of the squared mid log returns inside the window (not annualized)
+        def compute(rows):
+            if rows.shape[1] < 2:
+                return 0.
+            return math.sqrt(max(rows[CUM_VAR, -1] - rows[CUM_VAR, 0], 0.))
+        return self.read(compute, seconds, n, now)
+
+    def update_rate(self, seconds, now=None):
+        # type: (float, float) -> float
+        # top of book updates per second over the last seconds
+        return self.read(lambda rows: rows.shape[1], seconds, now=now) / float(seconds)
+
+    def summary(self, seconds=60., now=None):
+        # type: (float, float) -> dict
+        now = now or time.time()
+        p50, p90, p99 = self.spread_percentiles((50, 90, 99), seconds, now=now)
+        return {'mid_ewma': self.mid_ewma, 'spread_p50': p50, 'spread_p90': p90, 'spread_p99': p99,
+                'realized_volatility': self.realized_volatility(seconds, now=now),
+                'update_rate': self.update_rate(seconds, now), 'rows': len(self)}
@@ -2,9 +2,22 @@
 
 from cexio_interface import CexioMarketDataHandler, CexioTraderBot
 from db_interface import CrateDbInterface
+from feed_recorder import FeedRecorder
+from event_loop import WebSocketEventLoop
+from book_history import BookHistoryWriter
+from bar_aggregator import BarAggregator
+from conflation import TopOfBookConflator, ConflationPolicy
+from shm_book import ShmBookPublisher
+from cross_view import CrossView
+from ladder_orderbook import LadderOrderbook
+from subscription_manager import parse_subscriptions
 from collections import OrderedDict
 
-from logger import get_logger
+from metrics import MetricsServer, handler_collector, db_collector, log_collector
+from logger import get_logger, get_writer, configure as configure_logging
+import atexit
+import signal
+import sys
 import time
 
 safe_path = "../safe/cex_read_only_credentials.txt"
@@ -50,12 +63,17 @@ def init_db():
         logger.debug("DB has been reset, parameter reset_db_at_startup set back to False")
 
 
+    db.start_bulk_writer(spill_dir=config.get('spill_dir'))
+    logger.info("Bulk writer started")
+
     logger.info("Crate DB initiated successfuly")
     return db
 
 
 if __name__ == "__main__":
 
+    # log_dir, log_level, log_levels, log_rate, log_sample, see logger.py
+    configure_logging(**dict((k, v) for k, v in get_config().iteritems() if k.startswith('log_')))
     crate_interface = init_db()
 
     cexio_logger = get_logger('Cexio')
@@ -63,16 +81,59 @@ if __name__ == "__main__":
 
     cmdh = CexioMarketDataHandler(cred['key'], cred['secret'], crate_interface, cexio_logger)
     assert cmdh
-    cmdh.start()
-    time.sleep(3)
-    cmdh.subscribe_orderbook('BTC', 'USD', 3)
-    cmdh.subscribe_orderbook('BTC', 'EUR', 4)
-    cmdh.subscribe_orderbook('BTC', 'GBP', 5)
-    #cmdh.subscribe_orderbook('BTC', 'EUR', 10)
+    # e.g. ws_url=ws://127.0.0.1:8765/ws/ to run against fake_cexio_server.py
+    cmdh.url = get_config().get('ws_url', cmdh.url)
+    # book_engine=ladder: exact integer prices and quantities (ladder_orderbook), slower than the default Orderbook
+    if get_config().get('book_engine') == 'ladder':
+        cmdh.book_factory = LadderOrderbook
+    cmdh.tob_ring_size = int(get_config().get('tob_ring_size', cmdh.tob_ring_size))
+    cmdh.instrumentation.start_periodic_dump(get_logger('Instrumentation'))
+    metrics_port = get_config().get('metrics_port')
+    if metrics_port:
+        cmdh.metrics.add_collector(handler_collector(cmdh))
+        cmdh.metrics.add_collector(db_collector(crate_interface))
+        cmdh.metrics.add_collector(log_collector(get_writer()))
+        MetricsServer(get_logger('Metrics'), cmdh.metrics, int(metrics_port)).start()
+    feed_record_path = get_config().get('feed_record_path')
+    if feed_record_path:
+        cmdh.feed_recorder = FeedRecorder(feed_record_path, get_logger('FeedRecorder'))
+        # flushes the end of the capture on exit, crash of the main thread or SIGTERM included (see below)
+        atexit.register(cmdh.feed_recorder.close)
+    book_history_dir = get_config().get('book_history_dir')
+    if book_history_dir:
+        cmdh.book_history = BookHistoryWriter(book_history_dir, get_logger('BookHistory'))
+    shm_book_path = get_config().get('shm_book_path')
+    if shm_book_path:
+        cmdh.shm_publisher = ShmBookPublisher(shm_book_path, get_logger('ShmBook'))
+    cross_base = get_config().get('cross_base')
+    if cross_base:
+        cmdh.cross_view = CrossView(get_logger('CrossView'), cross_base, float(get_config().get('cross_threshold', 1e-4)))
+    bar_intervals = get_config().get('bar_intervals')
+    if bar_intervals:
+        # bars close on the handler's clock, the time of the rows
+        cmdh.bar_aggregator = BarAggregator(crate_interface, get_logger('Bars'), [int(i) for i in bar_intervals.split(',')],
+                                            clock=lambda: cmdh.clock())
+        cmdh.bar_aggregator.start()
+    cmdh.conflator = TopOfBookConflator(crate_interface, get_logger('Conflation'),
+                                        ConflationPolicy(window=float(get_config().get('conflation_window', 0))))
+    cmdh.conflator.start()
+    # SIGTERM runs the exit handlers too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # pair:depth list, e.g. subscriptions=BTC:USD:3,BTC:EUR:4, all sent as soon as we are authenticated
+    cmdh.subscriptions.declare_all(parse_subscriptions(get_config().get('subscriptions', 'BTC:USD:3,BTC:EUR:4,BTC:GBP:5')))
+    if get_config().get('transport') == 'event_loop':
+        event_loop = WebSocketEventLoop(get_logger('EventLoop'))
+        event_loop.add(cmdh, cmdh.url)
+        cmdh.start()
+        event_loop.start()
+    else:
+        cmdh.start()
+    if not cmdh.subscriptions.wait_until_ready(30):
+        cexio_logger.warning("Books not ready after 30s, still waiting for {}".format(sorted(cmdh.subscriptions.pending)))
     #ctb = CexioTraderBot(cred['key'], cred['secret'], crate_interface, cexio_logger)
     #assert ctb
     #ctb.start()
-    #time.sleep(3)
+    #ctb.wait_until_ready(30)
     #ctb.update_balance()
 
     while True: